@@ -21,9 +21,31 @@ import re
 import sys
 import json
 
+import numpy as np
+
+from utils import frame_file
+
+
+def iter_frame_bits(fn):
+    """ Yield (frame, frame bit) of each set bit in a dump or frame file. """
+    if frame_file.is_frame_file(fn):
+        for frame, words in frame_file.FrameFile(fn).items():
+            word_idx, bit_idx = np.nonzero(
+                (words[:, np.newaxis] >> np.arange(16, dtype=np.uint16)) & 1)
+            for framebit in (word_idx * 16 + bit_idx).tolist():
+                yield frame, framebit
+        return
 
-def main():
     line_re = re.compile(r'F(0x[0-9A-Fa-f]+)W(\d+)B(\d+)')
+    with open(fn) as df:
+        for line in df:
+            m = line_re.match(line)
+            if not m:
+                continue
+            yield int(m[1], 16), int(m[2]) * 32 + int(m[3])
+
+
+def main():
     frames_to_tiles = {}  # (start, size, tile, tile offset)
 
     with open(sys.argv[1]) as tb_f:
@@ -46,21 +68,15 @@ def main():
         if "INT_INTF_L_IO" in tilename:
             tile_bits[tilename] = set()
 
-    with open(sys.argv[2]) as df:
-        for line in df:
-            m = line_re.match(line)
-            if not m:
-                continue
-            frame = int(m[1], 16)
-            if frame not in frames_to_tiles:
-                continue
-            framebit = int(m[2]) * 32 + int(m[3])
-            for fb in frames_to_tiles[frame]:
-                start, size, tile, toff = fb
-                if framebit >= start and framebit < (start + size):
-                    if tile not in tile_bits:
-                        tile_bits[tile] = set()
-                    tile_bits[tile].add(toff + (framebit - start))
+    for frame, framebit in iter_frame_bits(sys.argv[2]):
+        if frame not in frames_to_tiles:
+            continue
+        for fb in frames_to_tiles[frame]:
+            start, size, tile, toff = fb
+            if framebit >= start and framebit < (start + size):
+                if tile not in tile_bits:
+                    tile_bits[tile] = set()
+                tile_bits[tile].add(toff + (framebit - start))
 
     for tile, bits in sorted(tile_bits.items()):
         print(".tile %s" % tile)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright 2020-2022 F4PGA Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+'''
+Report fasm2frames scaling with the number of --jobs.
+
+Every run must produce output identical to the serial (--jobs 1) run.
+'''
+
+import argparse
+import io
+import time
+
+from utils import fasm2frames, util
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    util.db_root_arg(parser)
+    util.part_arg(parser)
+    parser.add_argument(
+        '--jobs',
+        default='1,2,4,8',
+        help='Comma separated list of job counts to benchmark')
+    parser.add_argument(
+        '--sparse', action='store_true', help="Don't zero fill all frames")
+    parser.add_argument(
+        '--repeat', type=int, default=3, help='Runs per job count')
+    parser.add_argument('fn_in', help='Input FPGA assembly (.fasm) file')
+
+    args = parser.parse_args()
+
+    reference = None
+    serial_time = None
+    print('jobs  time [s]  speedup')
+    for jobs in [int(j) for j in args.jobs.split(',')]:
+        best = None
+        for _ in range(args.repeat):
+            f_out = io.StringIO()
+            start = time.perf_counter()
+            fasm2frames.run(
+                db_root=args.db_root,
+                part=args.part,
+                filename_in=args.fn_in,
+                f_out=f_out,
+                sparse=args.sparse,
+                jobs=jobs)
+            elapsed = time.perf_counter() - start
+
+            if reference is None:
+                reference = f_out.getvalue()
+            assert f_out.getvalue() == reference, (
+                'Output with --jobs {} differs'.format(jobs))
+
+            if best is None or elapsed < best:
+                best = elapsed
+
+        if serial_time is None:
+            serial_time = best
+
+        print('{:4d}  {:8.3f}  {:7.2f}'.format(jobs, best, serial_time / best))
+
+
+if __name__ == '__main__':
+    main()
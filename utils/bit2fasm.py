@@ -21,15 +21,32 @@ Take bitstream .bit files and decode them to FASM.
 '''
 
 import contextlib
+import json
+import multiprocessing
 import os
 import fasm
 import fasm.output
+import numpy as np
 from prjuray.db import Database
 import fasm_disassembler
 import bitstream
+import bitstream_reader
+import frame_file
 import subprocess
+import sys
 import tempfile
 
+# Frame address bits above the minor address (block type, row and column).
+# The frames of a tile are all in one configuration column.
+FAR_COLUMN_SHIFT = 8
+
+# Number of partitions per --jobs process, so partitions with many tiles
+# don't leave the other processes idle.
+PARTITIONS_PER_JOB = 4
+
+# Disassembler of a --jobs worker process, see init_worker.
+WORKER_DISASSEMBLER = None
+
 
 def bit_to_bits(bitread,
                 part_yaml,
@@ -49,35 +66,186 @@ def bit_to_bits(bitread,
         shell=True)
 
 
-def bits_to_fasm(db_root, part, bits_file, verbose, canonical,
-                 suppress_zero_features):
-    db = Database(db_root, part)
+def partition_bitdata(bitdata, partitions):
+    """ Split BitData into at most partitions BitData of whole columns.
+
+    Partitions are contiguous in frame address order, and hold about the
+    same number of set bits.
+    """
+    columns, starts = np.unique(
+        bitdata.frame_addrs >> FAR_COLUMN_SHIFT, return_index=True)
+    column_bits = np.diff(
+        np.append(bitdata.frame_offsets[starts], len(bitdata)))
+
+    total_bits = len(bitdata)
+    result = [[]]
+    partition_bits = 0
+    for column, bits in zip(columns.tolist(), column_bits.tolist()):
+        if result[-1] and partition_bits * partitions >= total_bits * len(
+                result):
+            result.append([])
+
+        result[-1].append(column)
+        partition_bits += bits
+
+    return [
+        bitdata.frame_range(partition[0] << FAR_COLUMN_SHIFT,
+                            ((partition[-1] + 1) << FAR_COLUMN_SHIFT) - 1)
+        for partition in result if partition
+    ]
+
+
+def init_worker(db_root, part):
+    global WORKER_DISASSEMBLER
+    WORKER_DISASSEMBLER = fasm_disassembler.FasmDisassembler(
+        Database(db_root, part))
+
+
+def disassemble_partition(args):
+    """ Return FasmLines of a partition from partition_bitdata. """
+    bitdata, verbose = args
+    return list(
+        WORKER_DISASSEMBLER.find_features_in_bitstream(
+            bitdata, verbose=verbose))
+
+
+def find_features_parallel(db_root, part, bitdata, verbose, jobs):
+    """ Parallel equivalent of FasmDisassembler.find_features_in_bitstream.
+
+    Tiles in different configuration columns are independent, so bitdata
+    is partitioned by column and the partitions are disassembled in a pool
+    of jobs processes.  Lines are returned in partition order, lines
+    already returned by an earlier partition are dropped.
+    """
+    partitions = partition_bitdata(bitdata, jobs * PARTITIONS_PER_JOB)
+
+    lines = []
+    seen_lines = set()
+    with multiprocessing.Pool(
+            processes=jobs, initializer=init_worker, initargs=(db_root,
+                                                               part)) as pool:
+        for partition_lines in pool.imap(disassemble_partition,
+                                         [(partition, verbose)
+                                          for partition in partitions]):
+            for line in partition_lines:
+                if line not in seen_lines:
+                    seen_lines.add(line)
+                    lines.append(line)
+
+    return lines
+
+
+def bits_to_fasm(db_root,
+                 part,
+                 bits_file,
+                 verbose,
+                 canonical,
+                 suppress_zero_features,
+                 f_out=None,
+                 db=None,
+                 segbits_cache=None,
+                 bitdata=None,
+                 jobs=1):
+    """ Write FASM of bits_file, or of BitData bitdata if given, to f_out.
+
+    With jobs > 1, bits are disassembled in a pool of jobs processes, see
+    find_features_parallel.
+    """
+    if db is None:
+        db = Database(db_root, part)
     grid = db.grid()
-    disassembler = fasm_disassembler.FasmDisassembler(db)
+    disassembler = fasm_disassembler.FasmDisassembler(
+        db, segbits_cache=segbits_cache)
 
-    with open(bits_file) as f:
-        bitdata = bitstream.load_bitdata(f, bitstream.WORD_SIZE_BITS)
+    if bitdata is None:
+        bitdata = bitstream.BitData.from_file(bits_file,
+                                              bitstream.WORD_SIZE_BITS)
 
-    model = fasm.output.merge_and_sort(
-        disassembler.find_features_in_bitstream(bitdata, verbose=verbose),
-        zero_function=disassembler.is_zero_feature,
-        sort_key=grid.tile_key,
-    )
+    # Canonical output is sorted by line, which for lines starting with the
+    # tile name is the tile name order of merge_and_sort without a sort key.
+    sort_key = None if canonical else grid.tile_key
+
+    if jobs == 1 and not verbose:
+        # Without the comments on bits not converted, which are by frame,
+        # every line belongs to a tile and tiles are merged one at a time.
+        model = tile_model(disassembler, bitdata, sort_key)
+    else:
+        if jobs > 1:
+            lines = find_features_parallel(db_root, part, bitdata, verbose,
+                                           jobs)
+        else:
+            lines = disassembler.find_features_in_bitstream(
+                bitdata, verbose=verbose)
+
+        model = fasm.output.merge_and_sort(
+            lines,
+            zero_function=disassembler.is_zero_feature,
+            sort_key=sort_key,
+        )
 
     if suppress_zero_features:
-        output_lines = []
+        model = (line for line in model if line.set_feature is None
+                 or not disassembler.is_zero_feature(line.set_feature.feature))
 
-        for line in model:
-            if line.set_feature is None:
-                output_lines.append(line)
-            elif not disassembler.is_zero_feature(line.set_feature.feature):
-                output_lines.append(line)
+    write_fasm(sys.stdout if f_out is None else f_out, model, canonical)
 
-        print(
-            fasm.fasm_tuple_to_string(output_lines, canonical=canonical),
-            end='')
-    else:
-        print(fasm.fasm_tuple_to_string(model, canonical=canonical), end='')
+
+def tile_model(disassembler, bitdata, sort_key):
+    """ Yield the FasmLines of fasm.output.merge_and_sort, tile by tile.
+
+    The features of bitdata are found and merged one tile at a time, see
+    FasmDisassembler.find_features_by_tile, so the lines of only one tile
+    are held at a time.
+    """
+    any_tiles = False
+    for _, lines in disassembler.find_features_by_tile(
+            bitdata, sort_key=sort_key):
+        tile_lines = list(
+            fasm.output.merge_and_sort(
+                lines, zero_function=disassembler.is_zero_feature))
+        if not tile_lines:
+            continue
+
+        # merge_and_sort separates tiles with a blank line.
+        if any_tiles:
+            yield fasm.FasmLine(
+                set_feature=None, annotations=None, comment=None)
+        any_tiles = True
+
+        yield from tile_lines
+
+
+def write_fasm(f_out, model, canonical):
+    """ Write FasmLines to f_out, like fasm.fasm_tuple_to_string.
+
+    Lines are written as they are generated rather than joined into one
+    string first.  With canonical, model must be in tile name order (see
+    fasm.output.merge_and_sort), and the lines of each tile are sorted and
+    deduplicated before it is written.
+    """
+    any_lines = False
+    tile = None
+    tile_lines = set()
+    for fasm_line in model:
+        if canonical and fasm_line.set_feature:
+            line_tile = fasm_line.set_feature.feature.split('.')[0]
+            if line_tile != tile:
+                f_out.writelines(line + '\n' for line in sorted(tile_lines))
+                tile = line_tile
+                tile_lines = set()
+
+        for line in fasm.fasm_line_to_string(fasm_line, canonical=canonical):
+            any_lines = True
+            if canonical:
+                tile_lines.add(line)
+            else:
+                f_out.write(line + '\n')
+
+    f_out.writelines(line + '\n' for line in sorted(tile_lines))
+
+    # fasm_tuple_to_string gives a single newline for an empty model.
+    if not any_lines:
+        f_out.write('\n')
 
 
 def main():
@@ -130,8 +298,16 @@ def main():
         "Name of the device architecture family (e.g. UltraScale, Series7, etc.)",
         default=default_arch)
     parser.add_argument(
-        '--frame_range', help="Frame range to use with bitread.")
-    parser.add_argument('bit_file', help='')
+        '--frame_range',
+        help="Frame range to use with bitread or --native-reader, "
+        "e.g. 0x00000000:0x00ffffff.")
+    parser.add_argument(
+        '--native-reader',
+        action='store_true',
+        help="Read the .bit file directly instead of using bitread.")
+    parser.add_argument(
+        'bit_file',
+        help='Input .bit file, or binary frame file (see frame_file.py)')
     parser.add_argument(
         '--verbose',
         help='Print lines for unknown tiles and bits',
@@ -142,8 +318,43 @@ def main():
         '--suppress_zero_features',
         help='Supress zero features.',
         action='store_true')
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=1,
+        help="Number of processes disassembling configuration columns in "
+        "parallel")
     args = parser.parse_args()
 
+    if frame_file.is_frame_file(args.bit_file):
+        bits_to_fasm(
+            db_root=args.db_root,
+            part=args.part,
+            bits_file=args.bit_file,
+            verbose=args.verbose,
+            canonical=args.canonical,
+            suppress_zero_features=args.suppress_zero_features,
+            jobs=args.jobs)
+        return
+
+    if args.native_reader:
+        with open(os.path.join(args.db_root, args.part, "part.json")) as f:
+            part_json = json.load(f)
+
+        addrs, rows, frame_words = bitstream_reader.read_bit_file(
+            args.bit_file, part_json, frame_range=args.frame_range)
+        bits_to_fasm(
+            db_root=args.db_root,
+            part=args.part,
+            bits_file=None,
+            verbose=args.verbose,
+            canonical=args.canonical,
+            suppress_zero_features=args.suppress_zero_features,
+            bitdata=bitstream.BitData.from_frame_words(
+                addrs, frame_words, bitstream.WORD_SIZE_BITS, rows),
+            jobs=args.jobs)
+        return
+
     with contextlib.ExitStack() as stack:
         if args.bits_file:
             bits_file = stack.enter_context(open(args.bits_file, 'wb'))
@@ -165,7 +376,8 @@ def main():
             bits_file=bits_file.name,
             verbose=args.verbose,
             canonical=args.canonical,
-            suppress_zero_features=args.suppress_zero_features)
+            suppress_zero_features=args.suppress_zero_features,
+            jobs=args.jobs)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright 2020-2022 F4PGA Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+'''
+Feature level difference of two bitstreams of the same part.
+
+Only the tiles with bits that differ between the bitstreams are decoded.
+Removed features (only in the first bitstream) are printed with a "-"
+prefix and added features (only in the second) with "+", one FASM line
+per feature bit in tile order.  Changed bits not set by any feature of
+their tile are printed as unknown_bit annotations, as by bit2fasm
+--verbose.
+
+Inputs are .bits files, binary frame files (see frame_file.py) or .bit
+files, which are read without bitread.  Exits with status 1 if the
+bitstreams differ.
+'''
+
+import argparse
+import json
+import os
+import sys
+
+import fasm
+import numpy as np
+
+from prjuray.db import Database
+from utils import bitstream, bitstream_reader, fasm_disassembler, util
+
+
+def load_bitdata(fn, part_json_fn):
+    """ Return BitData of a .bit, .bits or binary frame file.
+
+    part_json_fn is the part.json of the part, only read for .bit files.
+    """
+    if fn.endswith('.bit'):
+        with open(part_json_fn) as f:
+            part_json = json.load(f)
+
+        addrs, rows, frame_words = bitstream_reader.read_bit_file(
+            fn, part_json)
+        return bitstream.BitData.from_frame_words(
+            addrs, frame_words, bitstream.WORD_SIZE_BITS, rows)
+
+    return bitstream.BitData.from_file(fn, bitstream.WORD_SIZE_BITS)
+
+
+def changed_bits(bitdata_a, bitdata_b):
+    """ Return BitData of the bits that differ between two BitData.
+
+    >>> changed = changed_bits(
+    ...     bitstream.BitData([1, 1], [0, 0], [3, 4], 32),
+    ...     bitstream.BitData([1, 2], [0, 1], [4, 16], 32))
+    >>> changed.frames.tolist(), changed.frame_bits.tolist()
+    ([1, 2], [3, 48])
+    """
+    keys = np.setxor1d((bitdata_a.frames << 32) | bitdata_a.frame_bits,
+                       (bitdata_b.frames << 32) | bitdata_b.frame_bits)
+    frame_bits = keys & 0xFFFFFFFF
+    return bitstream.BitData(
+        keys >> 32, frame_bits // bitstream.WORD_SIZE_BITS,
+        frame_bits % bitstream.WORD_SIZE_BITS, bitstream.WORD_SIZE_BITS)
+
+
+def changed_tiles(segment_map, changed):
+    """ Return the (tile, block_type, bits) of tiles with changed bits. """
+    tiles = set()
+    for frame in changed.frame_addrs.tolist():
+        words = set(changed.words[changed.frame_slice(frame)].tolist())
+        for bits_info in segment_map.segment_info_for_frame(frame):
+            tile_words = range(bits_info.bits.offset,
+                               bits_info.bits.offset + bits_info.bits.words)
+            if any(word in tile_words for word in words):
+                tiles.add((bits_info.tile, bits_info.block_type,
+                           bits_info.bits))
+
+    return tiles
+
+
+def tile_features(tile_segbits, tile, block_type, bits, bitdata):
+    """ Return (features, solved bits) of a tile in BitData bitdata.
+
+    features is a set of fasm.SetFasmFeature and solved bits a set of
+    (frame, bit) set by those features.
+    """
+    features = set()
+    solved = set()
+    for ones_matched, feature in tile_segbits.match_bitdata(
+            block_type, bits, bitdata):
+        features.add(
+            fasm_disassembler.mk_fasm(tile_name=tile,
+                                      feature=feature).set_feature)
+        solved.update(ones_matched)
+
+    return features, solved
+
+
+def unknown_bit_line(frame, bit):
+    return '{{ unknown_bit = "{:08x}_{}_{}" }}'.format(
+        frame, bit // bitstream.WORD_SIZE_BITS, bit % bitstream.WORD_SIZE_BITS)
+
+
+def diff_bitdata(db, bitdata_a, bitdata_b):
+    """ Yield ('-' or '+', line) of the differences of two BitData.
+
+    Feature lines are in tile order, followed by the unknown bits.
+    """
+    disassembler = fasm_disassembler.FasmDisassembler(db)
+    grid = disassembler.grid
+    changed = changed_bits(bitdata_a, bitdata_b)
+
+    removed = set()
+    added = set()
+    solved_a = set()
+    solved_b = set()
+    for tile, block_type, bits in changed_tiles(disassembler.segment_map,
+                                                changed):
+        try:
+            tile_segbits = disassembler.segbits_cache.get(
+                grid.gridinfo_at_tilename(tile).tile_type)
+        except KeyError:
+            # Bits of tile types without segbits are unknown bits.
+            continue
+
+        features_a, tile_solved_a = tile_features(tile_segbits, tile,
+                                                  block_type, bits, bitdata_a)
+        features_b, tile_solved_b = tile_features(tile_segbits, tile,
+                                                  block_type, bits, bitdata_b)
+        removed |= features_a - features_b
+        added |= features_b - features_a
+        solved_a |= tile_solved_a
+        solved_b |= tile_solved_b
+
+    def feature_key(feature):
+        return (grid.tile_key(feature.feature.split('.')[0]), feature.feature,
+                -1 if feature.start is None else feature.start)
+
+    for feature in sorted(removed | added, key=feature_key):
+        yield '-' if feature in removed else '+', fasm.set_feature_to_str(
+            feature)
+
+    for frame, bit in zip(changed.frames.tolist(),
+                          changed.frame_bits.tolist()):
+        in_a = (frame, bit) in bitdata_a
+        if (frame, bit) not in (solved_a if in_a else solved_b):
+            yield '-' if in_a else '+', unknown_bit_line(frame, bit)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    util.db_root_arg(parser)
+    util.part_arg(parser)
+    parser.add_argument(
+        'bits_a', help='First .bit, .bits or binary frame file')
+    parser.add_argument(
+        'bits_b', help='Second .bit, .bits or binary frame file')
+
+    args = parser.parse_args()
+
+    part_json_fn = os.path.join(args.db_root, args.part, 'part.json')
+
+    different = False
+    for sign, line in diff_bitdata(
+            Database(args.db_root, args.part),
+            load_bitdata(args.bits_a, part_json_fn),
+            load_bitdata(args.bits_b, part_json_fn)):
+        print(sign, line)
+        different = True
+
+    sys.exit(1 if different else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,7 +17,7 @@
 #
 # SPDX-License-Identifier: Apache-2.0
 
-from utils import bitstream
+from utils import bitstream, frame_file
 
 
 def write(bits_fn, fnout, tags, bitfilter=None):
@@ -35,17 +35,24 @@ def write(bits_fn, fnout, tags, bitfilter=None):
     # Everything relative to start of bitstream
     line("seg 00000000_000")
 
-    bitdata = bitstream.load_bitdata2(open(bits_fn, "r"))
+    if frame_file.is_frame_file(bits_fn):
+        bitdata = bitstream.BitData.from_file(bits_fn, 32)
+        frames, words, bits = bitdata.frames, bitdata.words, bitdata.bits
+    else:
+        with open(bits_fn, 'rb') as f:
+            frames, words, bits = bitstream.parse_bits(f.read())
 
-    for frame, words in bitdata.items():
-        for word, wbits in words.items():
-            if bitfilter is not None:
-                if not bitfilter(frame, word):
-                    continue
+        order = bitstream.bits_file_order(frames, words, bits)
+        frames, words, bits = frames[order], words[order], bits[order]
 
-            for bitidx in sorted(list(wbits)):
-                # Are the names arbitrary? Lets just re-create
-                line("bit %08X_%03u_%02u" % (frame, word, bitidx))
+    for frame, word, bitidx in zip(frames.tolist(), words.tolist(),
+                                   bits.tolist()):
+        if bitfilter is not None:
+            if not bitfilter(frame, word):
+                continue
+
+        # Are the names arbitrary? Lets just re-create
+        line("bit %08X_%03u_%02u" % (frame, word, bitidx))
 
     for k, v in tags.items():
         line("tag %s %u" % (k, v))
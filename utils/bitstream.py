@@ -19,7 +19,10 @@
 
 import json
 import os
-from utils import util
+
+import numpy as np
+
+from utils import frame_file, util
 
 # Break frames into WORD_SIZE bit words.
 from prjuray.bitstream import WORD_SIZE_BITS
@@ -39,6 +42,259 @@ Where:
 -06: bit index (0-31)
 '''
 
+# Length of a "bit_%08x_%03d_%02d\n" line.
+BITS_LINE_LENGTH = 20
+
+
+def parse_bits(data):
+    """ Return (frames, words, bits) arrays of the contents of a .bits file.
+
+    Words are 32-bit words, and bits the bit index within the word.
+
+    >>> [a.tolist() for a in parse_bits(b'bit_0002000f_079_06\\n')]
+    [[131087], [79], [6]]
+    """
+    if data and not data.endswith(b'\n'):
+        data += b'\n'
+
+    # Lines written by bitread all have the same length, parse those as a
+    # character array.
+    if len(data) % BITS_LINE_LENGTH == 0:
+        chars = np.frombuffer(
+            data, dtype=np.uint8).reshape(-1, BITS_LINE_LENGTH)
+        if ((chars[:, :4] == np.frombuffer(b'bit_', dtype=np.uint8)).all()
+                and (chars[:, [12, 16]] == ord('_')).all()
+                and (chars[:, 19] == ord('\n')).all()):
+            # Convert a column at a time, to keep memory use to a few
+            # arrays of one entry per line.
+            def digits(idx):
+                column = chars[:, idx].astype(np.int64)
+                return np.where(column >= ord('A'),
+                                (column | 0x20) - (ord('a') - 10),
+                                column - ord('0'))
+
+            frames = np.zeros(len(chars), dtype=np.int64)
+            for idx in range(4, 12):
+                frames = (frames << 4) | digits(idx)
+
+            words = digits(13) * 100 + digits(14) * 10 + digits(15)
+            bits = digits(17) * 10 + digits(18)
+            return frames, words, bits
+
+    frames = []
+    words = []
+    bits = []
+    for line in data.decode().splitlines():
+        if not line.strip():
+            continue
+
+        line = line.split("_")
+        frames.append(int(line[1], 16))
+        words.append(int(line[2], 10))
+        bits.append(int(line[3], 10))
+
+    return (np.array(frames, dtype=np.int64), np.array(words, dtype=np.int64),
+            np.array(bits, dtype=np.int64))
+
+
+def bits_file_order(frames, words, bits):
+    """ Return indices of the distinct bits of parse_bits, in file order.
+
+    This is the order of load_bitdata2: frames and the words of each frame
+    in the order they first appear, and the bits of each word sorted.
+
+    >>> bits_file_order(*parse_bits(
+    ...     b'bit_00000002_001_05\\nbit_00000001_000_03\\n'
+    ...     b'bit_00000002_000_01\\nbit_00000002_001_04\\n'
+    ...     b'bit_00000001_000_03\\n')).tolist()
+    [3, 0, 2, 1]
+    """
+    _, frame_first, frame_idx = np.unique(
+        frames, return_index=True, return_inverse=True)
+    _, word_first, word_idx = np.unique(
+        (frames << 32) | words, return_index=True, return_inverse=True)
+    order = np.lexsort((bits, word_first[word_idx], frame_first[frame_idx]))
+
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = ((word_idx[order[1:]] != word_idx[order[:-1]]) |
+                 (bits[order[1:]] != bits[order[:-1]]))
+    return order[first]
+
+
+class BitData(object):
+    """ Set bits of a bitstream as sorted columnar arrays.
+
+    frames, words and bits have one entry per set bit, sorted by frame
+    address, word and bit.  Words are word_size_bits wide, and frame_bits
+    is the bit index within the frame (words * word_size_bits + bits).
+
+    The bits of frame frame_addrs[i] are the range
+    [frame_offsets[i], frame_offsets[i + 1]) of the arrays.
+    """
+
+    def __init__(self, frames, words, bits, word_size_bits):
+        self.word_size_bits = word_size_bits
+
+        frame_bits = (np.asarray(words, dtype=np.int64) * word_size_bits +
+                      np.asarray(bits, dtype=np.int64))
+        keys = np.unique((np.asarray(frames, dtype=np.int64) << 32)
+                         | frame_bits)
+
+        self.frames = keys >> 32
+        self.frame_bits = keys & 0xFFFFFFFF
+        self.words = self.frame_bits // word_size_bits
+        self.bits = self.frame_bits % word_size_bits
+
+        self.frame_addrs, starts = np.unique(self.frames, return_index=True)
+        self.frame_offsets = np.append(starts, len(self.frames))
+
+        # (addrs, rows, frame_words) of frame_array.
+        self.array = None
+
+    @staticmethod
+    def from_bits(data, word_size_bits):
+        """ Return BitData of the contents of a .bits file. """
+        frames, words32, bits32 = parse_bits(data)
+        return BitData(
+            frames,
+            words32 * (32 // word_size_bits) + bits32 // word_size_bits,
+            bits32 % word_size_bits, word_size_bits)
+
+    @staticmethod
+    def from_frame_words(addrs, frame_words, word_size_bits, frame_rows=None):
+        """ Return BitData of a frame array.
+
+        addrs are the frame addresses of the rows of frame_words, an array
+        of 16-bit frame words with one row per frame.  With frame_rows,
+        frame addrs[i] is row frame_rows[i] of frame_words instead, so
+        frames with the same words can share a row.  The frame array is
+        kept, see frame_array.
+
+        >>> bitdata = BitData.from_frame_words(
+        ...     [0x11, 0x10, 0x12], [[0, 0x8001], [0, 0]], 32, [0, 1, 0])
+        >>> bitdata.frames.tolist(), bitdata.frame_bits.tolist()
+        ([17, 17, 18, 18], [16, 31, 16, 31])
+        """
+        addrs = np.asarray(addrs, dtype=np.int64)
+        frame_words = np.asarray(frame_words, dtype=np.uint16)
+        if frame_rows is None:
+            frame_rows = np.arange(len(addrs))
+        frame_rows = np.asarray(frame_rows, dtype=np.int64)
+
+        # Expand only the non-zero words of each row to bits.
+        row_idx, word16idx = np.nonzero(frame_words)
+        word_bits = (frame_words[row_idx, word16idx][:, np.newaxis] >>
+                     np.arange(16, dtype=np.uint16)) & 1
+        nonzero_idx, bit16idx = np.nonzero(word_bits)
+        row_bits = word16idx[nonzero_idx] * 16 + bit16idx
+
+        # Every frame gets the bits of its row.
+        row_counts = np.bincount(
+            row_idx[nonzero_idx], minlength=len(frame_words))
+        counts = row_counts[frame_rows]
+        ends = np.cumsum(counts)
+        bit_idx = np.arange(ends[-1] if len(ends) else 0) + np.repeat(
+            (np.cumsum(row_counts) - row_counts)[frame_rows] - ends + counts,
+            counts)
+        framebits = row_bits[bit_idx]
+
+        bitdata = BitData(
+            np.repeat(addrs, counts), framebits // word_size_bits,
+            framebits % word_size_bits, word_size_bits)
+
+        order = np.argsort(addrs, kind='stable')
+        bitdata.array = addrs[order], frame_rows[order], frame_words
+        return bitdata
+
+    @staticmethod
+    def from_file(fn, word_size_bits):
+        """ Return BitData of a .bits file or a binary frame file. """
+        if frame_file.is_frame_file(fn):
+            frames = frame_file.FrameFile(fn)
+            return BitData.from_frame_words(frames.addrs, frames.words,
+                                            word_size_bits)
+
+        with open(fn, 'rb') as f:
+            return BitData.from_bits(f.read(), word_size_bits)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __contains__(self, frame_bit):
+        """ Return True if (frame, bit index within the frame) is set. """
+        frame, bit = frame_bit
+        s = self.frame_slice(frame)
+        idx = s.start + np.searchsorted(self.frame_bits[s], bit)
+        return idx < s.stop and self.frame_bits[idx] == bit
+
+    def frame_slice(self, frame):
+        ''' Return the range of the bits of a frame in the arrays. '''
+        idx = np.searchsorted(self.frame_addrs, frame)
+        if idx == len(self.frame_addrs) or self.frame_addrs[idx] != frame:
+            return slice(0, 0)
+
+        return slice(self.frame_offsets[idx], self.frame_offsets[idx + 1])
+
+    def bits_in_frame(self, frame, word_start=0, word_end=None):
+        """ Return frame bit indices set in words [word_start, word_end).
+
+        >>> bitdata = BitData([1, 1, 1], [0, 2, 3], [5, 1, 0], 16)
+        >>> bitdata.bits_in_frame(1, 1, 3).tolist()
+        [33]
+        """
+        frame_bits = self.frame_bits[self.frame_slice(frame)]
+        start = np.searchsorted(frame_bits, word_start * self.word_size_bits)
+        end = len(frame_bits)
+        if word_end is not None:
+            end = np.searchsorted(frame_bits, word_end * self.word_size_bits)
+
+        return frame_bits[start:end]
+
+    def frame_range(self, first, last):
+        """ Return BitData of the frames first to last (inclusive).
+
+        >>> bitdata = BitData([1, 2, 3], [0, 0, 0], [0, 1, 2], 32)
+        >>> bitdata.frame_range(2, 3).frames.tolist()
+        [2, 3]
+        """
+        start, end = np.searchsorted(self.frames, [first, last + 1]).tolist()
+        bitdata = BitData(self.frames[start:end], self.words[start:end],
+                          self.bits[start:end], self.word_size_bits)
+
+        if self.array is not None:
+            addrs, rows, frame_words = self.array
+            start, end = np.searchsorted(addrs, [first, last + 1]).tolist()
+            used, rows = np.unique(rows[start:end], return_inverse=True)
+            bitdata.array = addrs[start:end], rows, frame_words[used]
+
+        return bitdata
+
+    def frame_array(self):
+        """ Return (addrs, rows, frame_words) arrays of the frames.
+
+        frame_words holds 16-bit frame words with one row per distinct
+        frame, and frame addrs[i] is row rows[i], addrs being sorted.  This
+        is the frame array from_frame_words was given, otherwise every
+        frame with bits set gets a row of FRAME_WORD_COUNT words.
+
+        >>> addrs, rows, words = BitData([16], [0], [31], 32).frame_array()
+        >>> addrs.tolist(), rows.tolist(), words[0, :3].tolist()
+        ([16], [0], [0, 32768, 0])
+        """
+        if self.array is None:
+            rows = np.repeat(
+                np.arange(len(self.frame_addrs)), np.diff(self.frame_offsets))
+            frame_words = np.zeros((len(self.frame_addrs), FRAME_WORD_COUNT),
+                                   dtype=np.uint16)
+            np.bitwise_or.at(
+                frame_words, (rows, self.frame_bits // 16),
+                np.left_shift(
+                    np.uint16(1), (self.frame_bits % 16).astype(np.uint16)))
+            self.array = (self.frame_addrs, np.arange(len(self.frame_addrs)),
+                          frame_words)
+
+        return self.array
+
 
 def load_bitdata(f, word_size_bits):
     """ Read bit file and return bitdata map.
@@ -49,54 +305,48 @@ def load_bitdata(f, word_size_bits):
     The first sets are the word columns that have any bits set.
     Word columsn are word_size_bits wide.
     The second sets are bit index within the frame and word if it is set.
+
+    This is the dict form of BitData, which new code should use instead.
     """
-    bitdata = dict()
+    data = f.read()
+    if isinstance(data, str):
+        data = data.encode()
 
-    for line in f:
-        line = line.split("_")
-        frame = int(line[1], 16)
-        wordidx = int(line[2], 10) * (32 // word_size_bits) + int(
-            line[3], 10) // word_size_bits
-        bitidx = int(line[3], 10) % word_size_bits
+    frames, words32, bits32 = parse_bits(data)
+    bitdata = BitData(
+        frames,
+        words32 * (32 // word_size_bits) + bits32 // word_size_bits,
+        bits32 % word_size_bits, word_size_bits)
 
-        if frame not in bitdata:
-            bitdata[frame] = set(), set()
+    # Frames in the order they first appear in the file.
+    _, first = np.unique(frames, return_index=True)
+    result = {}
+    for frame in frames[np.sort(first)].tolist():
+        s = bitdata.frame_slice(frame)
+        result[frame] = (set(bitdata.words[s].tolist()),
+                         set(bitdata.frame_bits[s].tolist()))
 
-        bitdata[frame][0].add(wordidx)
-        bitdata[frame][1].add(wordidx * word_size_bits + bitidx)
+    return result
 
-    return bitdata
 
-
-# used by segprint
-# TODO: merge these
 def load_bitdata2(f):
     '''
     return as bitdata[frame][wordidx].add(bitidx)
     ie indexed by frame, word index, and then a set with bit indexes
     Similar to .bits file: bit_00020012_014_20
     '''
+    data = f.read()
+    if isinstance(data, str):
+        data = data.encode()
 
-    bitdata = dict()
-
-    for lineraw in f:
-        lineraw = lineraw.strip()
-        line = lineraw.split("_")
-        try:
-            frame = int(line[1], 16)
-            wordidx = int(line[2], 10)
-            bitidx = int(line[3], 10)
-        except:
-            print("Invalid line %s" % lineraw)
-            raise
-
-        if frame not in bitdata:
-            bitdata[frame] = dict()
+    frames, words, bits = parse_bits(data)
+    order = bits_file_order(frames, words, bits)
 
-        if wordidx not in bitdata[frame]:
-            bitdata[frame][wordidx] = set()
+    bitdata = {}
+    for frame, word, bit in zip(frames[order].tolist(), words[order].tolist(),
+                                bits[order].tolist()):
+        bitdata.setdefault(frame, {}).setdefault(word, set()).add(bit)
 
-        bitdata[frame][wordidx].add(bitidx)
     return bitdata
 
 
@@ -27,286 +27,293 @@ the UG570 Configuration User Guide.
 The tool can be used to derive the initialization, startup and finalization
 sequence as well as the configuration data. The latter is written to a frames
 file which can be used by the bitstream tools such as frames2bit to generate
-a valid bitstream.
+a valid bitstream, or to a binary frame file (see frame_file.py).
+
+The file is memory-mapped and read as big-endian 32-bit words by
+bitstream_reader.iter_packet_records, and frames are array views of the
+FDRI data, so files of any size are analyzed in constant memory.  Files
+with several configuration images are supported.  FDRI writes of several frames, like
+the type 2 FDRI bursts of Vivado bitstreams, are split into frames of
+WORDS_PER_FRAME words at consecutive frame addresses.  The FAR
+auto-increments through the frame addresses of the part given by
+--part_json, skipping the two padding frames at the end of each row.
+Without --part_json the addresses of the frames after the first of such
+a write are unknown; they are counted but not written to frames files.
+MFWR writes of compressed bitstreams replicate the last FDRI frame to the
+address in FAR, and are listed as frames sharing the words of that frame.
 '''
 
 import argparse
-from io import StringIO
-
-conf_regs = {
-    0: "CRC",
-    1: "FAR",
-    2: "FDRI",
-    3: "FDRO",
-    4: "CMD",
-    5: "CTL0",
-    6: "MASK",
-    7: "STAT",
-    8: "LOUT",
-    9: "COR0",
-    10: "MFWR",
-    11: "CBC",
-    12: "IDCODE",
-    13: "AXSS",
-    14: "COR1",
-    16: "WBSTAR",
-    17: "TIMER",
-    22: "BOOTSTS",
-    24: "CTL1",
-    31: "BSPI"
-}
-
-cmd_reg_codes = {
-    0: "NULL",
-    1: "WCFG",
-    2: "MFW",
-    3: "LFRM",
-    4: "RCFG",
-    5: "START",
-    7: "RCRC",
-    8: "AGHIGH",
-    9: "SWITCH",
-    10: "GRESTORE",
-    11: "SHUTDOWN",
-    13: "DESYNC",
-    15: "IPROG",
-    16: "CRCC",
-    17: "LTIMER",
-    18: "BSPI_READ",
-    19: "FALL_EDGE"
-}
+import json
+import mmap
+
+from utils import bitstream_reader, frame_file
+from utils.bitstream_writer import (OPCODE_WRITE, REGS, WORDS_PER_FRAME,
+                                    conf_regs, cmd_reg_codes,
+                                    part_frame_addresses)
 
 opcodes = ("NOP", "READ", "WRITE", "UNKNOWN")
 
 
-def knuth_morris_pratt(text, pattern):
-    '''
-    Yields all starting positions of copies of the pattern in the text.
-    Calling conventions are similar to string.find, but its arguments can be
-    lists or iterators, not just strings, it returns all matches, not just
-    the first one, and it does not need the whole text in memory at once.
-    Whenever it yields, it will have read the text exactly up to and including
-    the match that caused the yield.
-    '''
-
-    # allow indexing into pattern and protect against change during yield
-    pattern = list(pattern)
-
-    # build table of shift amounts
-    shifts = [1] * (len(pattern) + 1)
-    shift = 1
-    for pos in range(len(pattern)):
-        while shift <= pos and pattern[pos] != pattern[pos - shift]:
-            shift += shifts[pos - shift]
-        shifts[pos + 1] = shift
-
-    # do the actual search
-    startPos = 0
-    matchLen = 0
-    for c in text:
-        while matchLen == len(pattern) or \
-              matchLen >= 0 and pattern[matchLen] != c:
-            startPos += shifts[matchLen]
-            matchLen -= shifts[matchLen]
-        matchLen += 1
-        if matchLen == len(pattern):
-            yield startPos
+def print_packet(record):
+    ''' Print a bitstream_reader.PacketRecord with its register values. '''
+    if not record.opcode:
+        print("\n\tNOP")
+    else:
+        print(
+            "\n\tConfiguration Register Word: ", hex(record.header),
+            'Type: {}, Op: {}, Addr: {} ({}), Words: {}'.format(
+                record.type, opcodes[record.opcode], conf_regs[record.reg]
+                if record.reg in conf_regs else "UNKNOWN", record.reg,
+                record.count))
+
+    if not record.opcode or record.reg not in conf_regs:
+        return
+
+    reg = conf_regs[record.reg]
+    for idx, word in enumerate(record.payload.tolist()):
+        if reg == "FDRI":
+            print("\t{:2d}. 0x{:08X}".format(idx, word))
+        elif reg == "CMD":
+            print("\tCommand: {} ({})".format(cmd_reg_codes[word], word))
+        elif reg == "COR0":
+            #TODO Add COR0 options parsing
+            print("\tCOR0 options: {:08X}".format(word))
+        elif reg == "FAR":
+            block_type = (word >> 24) & 0x7
+            row_addr = (word >> 18) & 0x3F
+            col_addr = (word >> 8) & 0x3FF
+            minor_addr = word & 0xFF
+            print("\tFAR address: {:08X}".format(word))
+            print("\tBlock: {:08X}, Row: {:08X}, Col: {:08X}, Minor: {:08X}".
+                  format(block_type, row_addr, col_addr, minor_addr))
+        else:
+            print("\tRegister: {} Value: 0x{:08X}".format(reg, word))
+
+
+def iter_frames(records, frame_addrs=None, words_per_frame=WORDS_PER_FRAME):
+    """ Yield (frame address, frame words) of the FDRI writes of records.
+
+    Frame words are uint32 views of the payload of the FDRI writes, in the
+    order written.  FDRI writes of several frames follow the FAR
+    auto-increment through frame_addrs, the frame addresses of the part,
+    skipping padding frames.  Without frame_addrs the address of the frames
+    after the first of a write is unknown and yielded as None, until the
+    next FAR write.
+
+    MFWR writes replicate the last FDRI frame to the address in FAR, and
+    yield the same view again rather than a copy.
+    """
+    sequence = None
+    if frame_addrs is not None:
+        sequence = bitstream_reader.frame_sequence(frame_addrs)
+        sequence_index = {
+            addr: idx
+            for idx, addr in enumerate(sequence) if addr is not None
+        }
+
+    far = 0
+    far_index = 0
+    last_words = None
+    for record in records:
+        if record.opcode != OPCODE_WRITE:
+            continue
+
+        if record.reg == REGS['FAR']:
+            for far in record.payload.tolist():
+                if sequence is not None:
+                    far_index = sequence_index.get(far)
+        elif record.reg == REGS['FDRI'] and len(record.payload):
+            if len(record.payload) % words_per_frame != 0:
+                raise ValueError(
+                    'FDRI write of {} words is not a whole number of frames'.
+                    format(len(record.payload)))
+
+            for words in record.payload.reshape(-1, words_per_frame):
+                if sequence is None:
+                    # The auto-increment skips the padding frames of the
+                    # part, so the next address can't be derived from FAR.
+                    addr = far
+                    far = None
+                else:
+                    if far_index is None:
+                        raise ValueError(
+                            'FDRI write at unknown frame address 0x{:08X}'.
+                            format(far))
+                    if far_index >= len(sequence):
+                        raise ValueError(
+                            'FDRI write past the last frame address')
+
+                    addr = sequence[far_index]
+                    far_index += 1
+
+                    if addr is None:
+                        # Padding frame.
+                        continue
+
+                last_words = words
+                yield addr, words
+        elif record.reg == REGS['MFWR'] and len(record.payload):
+            if last_words is None:
+                raise ValueError('MFWR write before any FDRI frame')
+            if sequence is not None and far_index is None:
+                raise ValueError(
+                    'MFWR write at unknown frame address 0x{:08X}'.format(far))
+
+            yield far, last_words
 
 
 class Bitstream:
     BITS_PER_WORD = 16
-    WORDS_PER_FRAME = 93
-
-    def __init__(self, file_name, verbose=False):
-        self.frames_data = dict()
-        self.current_far_address = 0
-        self.fdri_write_len = 0
-        self.fdri_in_progress = False
-        self.words = []
-        with open(file_name, "rb") as f:
-            self.bytes = f.read()
-        pos, self.header = self.get_header()
-        for byte3, byte2, byte1, byte0 in zip(
-                self.bytes[pos::4], self.bytes[pos + 1::4],
-                self.bytes[pos + 2::4], self.bytes[pos + 3::4]):
-            self.words.append(
-                int.from_bytes([byte3, byte2, byte1, byte0], byteorder='big'))
-        self.parse_bitstream(verbose)
-
-    def get_header(self):
-        '''Return position and content of header'''
-        pos = next(knuth_morris_pratt(self.bytes, [0xaa, 0x99, 0x55, 0x66]))
-        return pos + 4, self.bytes[:pos + 4]
-
-    def parse_bitstream(self, verbose):
-        payload_len = 0
-        for word in self.words:
-            if payload_len > 0:
-                payload_len = self.parse_reg(reg_addr, word, payload_len,
-                                             verbose)
-                continue
-            else:
-                packet_header = self.parse_packet_header(word)
-                opcode = packet_header["opcode"]
-                reg_addr = packet_header["reg_addr"]
-                words = packet_header["word_count"]
-                type = packet_header["type"]
-                if verbose:
-                    if not opcode:
-                        print("\n\tNOP")
-                    else:
-                        print(
-                            "\n\tConfiguration Register Word: ", hex(word),
-                            'Type: {}, Op: {}, Addr: {} ({}), Words: {}'.
-                            format(
-                                type, opcodes[opcode], conf_regs[reg_addr]
-                                if reg_addr in conf_regs else "UNKNOWN",
-                                reg_addr, words))
-                if opcode and reg_addr in conf_regs:
-                    payload_len = words
-                    if conf_regs[reg_addr] == "FDRI" and type == 1:
-                        self.fdri_in_progress = True
-                        self.frames_data[self.current_far_address] = list()
-                        self.fdri_write_len = payload_len
-                    continue
+    WORDS_PER_FRAME = WORDS_PER_FRAME
 
-    def parse_packet_header(self, word):
-        type = (word >> 29) & 0x7
-        opcode = (word >> 27) & 0x3
-        reg_addr = (word >> 13) & 0x1F
-        if type == 1:
-            word_count = word & 0x7FF
-        elif type == 2:
-            word_count = word & 0x7FFFFFF
-        else:
-            word_count = 0
-        return {
-            "type": type,
-            "opcode": opcode,
-            "reg_addr": reg_addr,
-            "word_count": word_count
-        }
+    def __init__(self, file_name, verbose=False, frame_addrs=None):
+        """ Open the bitstream file_name.
 
-    def parse_command(self, word, verbose):
-        if verbose:
-            print("\tCommand: {} ({})".format(cmd_reg_codes[word], word))
+        frame_addrs are the frame addresses of the part, used to follow the
+        FAR auto-increment of FDRI writes of several frames.  The file stays
+        memory-mapped until close, use the Bitstream as a context manager.
+        """
+        self.frame_addrs = frame_addrs
+        self._frames_data = None
 
-    #TODO Add COR0 options parsing
-    def parse_cor0(self, word, verbose):
-        if verbose:
-            print("\tCOR0 options: {:08X}".format(word))
+        with open(file_name, "rb") as f:
+            self.bytes = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.header = self.bytes[:self.bytes.find(bitstream_reader.
+                                                  SYNC_BYTES) +
+                                 len(bitstream_reader.SYNC_BYTES)]
 
-    def parse_far(self, word, verbose):
-        self.current_far_address = word
-        block_type = (word >> 24) & 0x7
-        row_addr = (word >> 18) & 0x3F
-        col_addr = (word >> 8) & 0x3FF
-        minor_addr = word & 0xFF
         if verbose:
-            print("\tFAR address: {:08X}".format(word))
-            print("\tBlock: {:08X}, Row: {:08X}, Col: {:08X}, Minor: {:08X}".
-                  format(block_type, row_addr, col_addr, minor_addr))
+            for record in self.packets():
+                print_packet(record)
 
-    def parse_reg(self, reg_addr, word, payload_len, verbose):
-        assert reg_addr in conf_regs
-        reg = conf_regs[reg_addr]
-        if reg == "CMD":
-            self.parse_command(word, verbose)
-        elif reg == "COR0":
-            self.parse_cor0(word, verbose)
-        elif reg == "FAR":
-            self.parse_far(word, verbose)
-        elif reg == "FDRI":
-            # We are in progress of a FDRI operation
-            # Keep adding data words
-            if self.fdri_in_progress:
-                if verbose:
-                    print("\t{:2d}. 0x{:08X}".format(
-                        self.fdri_write_len - payload_len, word))
-                # Convert 32-bit word to words with the specified word length
-                byte0 = word & 0xFF
-                byte1 = (word >> 8) & 0xFF
-                byte2 = (word >> 16) & 0xFF
-                byte3 = (word >> 24) & 0xFF
-                if self.BITS_PER_WORD == 32:
-                    self.frames_data[self.current_far_address].append(
-                        int.from_bytes([byte3, byte2, byte1, byte0],
-                                       byteorder='big'))
-                elif self.BITS_PER_WORD == 16:
-                    word0 = int.from_bytes([byte1, byte0], byteorder='big')
-                    self.frames_data[self.current_far_address].append(word0)
-                    word1 = int.from_bytes([byte3, byte2], byteorder='big')
-                    self.frames_data[self.current_far_address].append(word1)
-                else:
-                    assert False
-                if payload_len == 1:
-                    self.fdri_in_progress = False
-                    return 0
-            else:
-                #FIXME add Type 2 FDRI writes
-                assert False
-                #self.curr_fdri_write_len = word
-                #self.fdri_in_progress = True
-                # Check if 0 words actually means read something
-                #payload_len = self.curr_fdri_write_len
-                #if verbose:
-                #    print("\t{}: {}\n".format(reg, self.curr_fdri_write_len))
-                #return payload_len
+    def close(self):
+        ''' Unmap the file. '''
+        self._frames_data = None
+        try:
+            self.bytes.close()
+        except BufferError:
+            # Frame views are still in use, e.g. by a traceback; the file is
+            # unmapped when the last of them is freed.
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def packets(self):
+        ''' Yield bitstream_reader.PacketRecord of every packet. '''
+        return bitstream_reader.iter_packet_records(self.bytes)
+
+    def frames(self):
+        ''' Yield (frame address, uint32 frame words), see iter_frames. '''
+        return iter_frames(
+            self.packets(),
+            frame_addrs=self.frame_addrs,
+            words_per_frame=self.WORDS_PER_FRAME)
+
+    @property
+    def frames_data(self):
+        ''' Map of known frame address to uint32 array view of its words. '''
+        if self._frames_data is None:
+            self._frames_data = {
+                addr: words
+                for addr, words in self.frames() if addr is not None
+            }
+
+        return self._frames_data
+
+    def frame_words(self, words):
+        """ Return uint32 frame words as BITS_PER_WORD bits wide words.
+
+        16-bit words are in the order used by the frames files, the lower
+        half of each 32-bit word first.
+        """
+        if self.BITS_PER_WORD == 32:
+            return words
+        elif self.BITS_PER_WORD == 16:
+            return words.astype('<u4').view('<u2')
         else:
-            if verbose:
-                print("\tRegister: {} Value: 0x{:08X}".format(reg, word))
-        payload_len -= 1
-        return payload_len
+            assert False
+
+    def unknown_frames(self):
+        ''' Return the number of frames written at an unknown address. '''
+        return sum(1 for addr, _ in self.frames() if addr is None)
 
     def write_frames_txt(self, file_name):
         '''Write frame data in a more readable format'''
-        words_per_frame = self.WORDS_PER_FRAME * (32 / self.BITS_PER_WORD)
-        frame_stream = StringIO()
-        for addr, words in self.frames_data.items():
-            assert len(words) == words_per_frame
-            for i in range(len(words)):
-                if i % words_per_frame == 0:
-                    frame_stream.write("0x{:08x}\n".format(addr))
-                frame_stream.write("{}. 0x{:04x}\n".format(i, words[i]))
-                if i % words_per_frame == words_per_frame - 1:
-                    frame_stream.write("\n")
         with open(file_name, "w") as f:
-            print(frame_stream.getvalue(), file=f)
+            for addr, words in self.frames():
+                if addr is None:
+                    f.write("unknown\n")
+                else:
+                    f.write("0x{:08x}\n".format(addr))
+                f.writelines(
+                    "{}. 0x{:04x}\n".format(i, word)
+                    for i, word in enumerate(self.frame_words(words).tolist()))
+                f.write("\n")
+            f.write("\n")
 
     def write_frames(self, file_name):
         '''Write configuration data to frames file'''
-        words_per_frame = self.WORDS_PER_FRAME * (32 / self.BITS_PER_WORD)
-        frame_stream = StringIO()
-        for addr, words in self.frames_data.items():
-            assert len(words) == words_per_frame
-            for i in range(len(words)):
-                if i % words_per_frame == 0:
-                    frame_stream.write("0x{:08x} ".format(addr))
-                frame_stream.write("0x{:04x}".format(words[i]))
-                if i % words_per_frame == words_per_frame - 1:
-                    frame_stream.write("\n")
-                elif i < len(words) - 1:
-                    frame_stream.write(",")
         with open(file_name, "w") as f:
-            print(frame_stream.getvalue(), file=f)
+            for addr, words in self.frames():
+                if addr is None:
+                    continue
+                f.write("0x{:08x} ".format(addr) + ",".join(
+                    "0x{:04x}".format(word)
+                    for word in self.frame_words(words).tolist()) + "\n")
+            f.write("\n")
+
+    def write_frames_bin(self, file_name):
+        '''Write configuration data to a binary frame file'''
+        words_per_frame = self.WORDS_PER_FRAME * 32 // self.BITS_PER_WORD
+        assert self.BITS_PER_WORD == 16
+        with open(file_name, "wb") as f:
+            frame_file.write_frames(
+                f, {
+                    addr: self.frame_words(words)
+                    for addr, words in self.frames() if addr is not None
+                },
+                words_per_frame=words_per_frame)
 
 
 def main(args):
     verbose = not args.silent
-    bitstream = Bitstream(args.bitstream, verbose)
-    print("Frame data length: ", len(bitstream.frames_data))
-    if args.frames_out:
-        bitstream.write_frames(args.frames_out)
-    if args.frames_txt:
-        bitstream.write_frames_txt(args.frames_txt)
+    frame_addrs = None
+    if args.part_json:
+        with open(args.part_json) as f:
+            frame_addrs = list(part_frame_addresses(json.load(f)))
+
+    with Bitstream(
+            args.bitstream, verbose, frame_addrs=frame_addrs) as bitstream:
+        print("Frame data length: ", len(bitstream.frames_data))
+        unknown_frames = bitstream.unknown_frames()
+        if unknown_frames:
+            print("Frames at unknown address: ", unknown_frames,
+                  "(use --part_json to follow the FAR auto-increment)")
+        if args.frames_out:
+            bitstream.write_frames(args.frames_out)
+        if args.frames_txt:
+            bitstream.write_frames_txt(args.frames_txt)
+        if args.frames_bin:
+            bitstream.write_frames_bin(args.frames_bin)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--bitstream', help='Input bitstream')
+    parser.add_argument(
+        '--part_json',
+        help='part.json of the part, to follow the FAR auto-increment of '
+        'multi-frame FDRI writes')
     parser.add_argument('--frames_out', help='Output frames file')
     parser.add_argument(
         '--frames_txt', help='Output frames in more readable form')
+    parser.add_argument(
+        '--frames_bin', help='Output frames to a binary frame file')
     parser.add_argument(
         '--silent', help="Don't print analysis details", action='store_true')
     args = parser.parse_args()
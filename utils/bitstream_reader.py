@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright 2020-2022 F4PGA Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+'''
+UltraScalePlus bitstream (.bit) reader.
+
+Locates the frames of the FDRI writes of a bitstream without copying them:
+configuration words are a big-endian uint32 view of the file contents
+(e.g. a mmap), and frames are found by word index into that view.
+
+FDRI data is laid out as written by bitstream_writer.py: frames in frame
+address order starting at the FAR written before the FDRI write, with two
+padding frames after the last frame of each configuration row.  MFWR
+writes of compressed bitstreams replicate the last FDRI frame to the frame
+address in FAR, and are read as references to that frame.
+'''
+
+from collections import namedtuple
+
+import numpy as np
+
+from utils import bitstream_writer
+from utils.bitstream_writer import (CMDS, REGS, SYNC_WORD, WORDS_PER_FRAME,
+                                    frame_sequence)
+
+SYNC_BYTES = SYNC_WORD.to_bytes(4, 'big')
+
+# Packet of the configuration words: header is the word index of the packet
+# header, and the payload of writes is words[start:start + count].  Type 2
+# packets have the register of the type 1 packet before them.  Read packets
+# have no payload in the bitstream, count is the number of words read.
+Packet = namedtuple('Packet', 'header type opcode reg start count')
+
+# Packet of iter_packet_records: offset is the byte offset of the header in
+# the file, header the header word, payload a view of the payload words
+# (empty for reads), and far the FAR register value when the packet was
+# written, or None if it is unknown.
+PacketRecord = namedtuple('PacketRecord',
+                          'offset header type opcode reg count payload far')
+
+
+def config_words(data):
+    """ Return big-endian uint32 view of the configuration words of data.
+
+    data is the content of a .bit file (bytes, bytearray or mmap), the view
+    starts after the sync word and is writable if data is.
+    """
+    pos = data.find(SYNC_BYTES)
+    if pos == -1:
+        raise ValueError('Sync word not found')
+
+    pos += len(SYNC_BYTES)
+    return np.frombuffer(
+        data, dtype='>u4', offset=pos, count=(len(data) - pos) // 4)
+
+
+def iter_packets(words):
+    ''' Yield Packet for every type 1 and type 2 packet of words. '''
+    idx = 0
+    reg = None
+    while idx < len(words):
+        header = int(words[idx])
+        packet_type = header >> 29
+        opcode = (header >> 27) & 0x3
+        if packet_type == 1:
+            reg = (header >> 13) & 0x1F
+            count = header & 0x7FF
+        elif packet_type == 2:
+            count = header & 0x7FFFFFF
+        else:
+            idx += 1
+            continue
+
+        yield Packet(idx, packet_type, opcode, reg, idx + 1, count)
+        idx += 1
+        if opcode != bitstream_writer.OPCODE_READ:
+            idx += count
+
+
+def iter_packet_records(data):
+    """ Yield PacketRecord for every packet of every image of data.
+
+    data is the content of a .bit file (bytes or a mmap), which may hold
+    several configuration images, each starting with a sync word and
+    ending with a DESYNC command.  Payloads are views into data, so memory
+    use doesn't depend on the size of data.
+
+    far becomes unknown after an FDRI write until the next FAR write, as
+    FDRI writes advance the FAR through the frame addresses of the part.
+    """
+    pos = data.find(SYNC_BYTES)
+    while pos != -1:
+        pos += len(SYNC_BYTES)
+        words = np.frombuffer(
+            data, dtype='>u4', offset=pos, count=(len(data) - pos) // 4)
+
+        far = None
+        for packet in iter_packets(words):
+            if packet.opcode == bitstream_writer.OPCODE_READ:
+                payload = words[packet.start:packet.start]
+            else:
+                payload = words[packet.start:packet.start + packet.count]
+
+            yield PacketRecord(pos + 4 * packet.header,
+                               int(words[packet.header]), packet.type,
+                               packet.opcode, packet.reg, packet.count,
+                               payload, far)
+
+            if is_write(packet, 'FAR') and packet.count == 1:
+                far = int(payload[0])
+            elif is_write(packet, 'FDRI') and packet.count > 0:
+                far = None
+            elif (is_write(packet, 'CMD') and packet.count == 1
+                  and int(payload[0]) == CMDS['DESYNC']):
+                # Words up to the sync word of the next image are not
+                # packets.
+                pos = data.find(SYNC_BYTES, pos + 4 * (packet.start + 1))
+                break
+        else:
+            break
+
+
+def is_write(packet, reg_name):
+    return (packet.opcode == bitstream_writer.OPCODE_WRITE
+            and packet.reg == REGS[reg_name])
+
+
+def frame_word_offsets(words, frame_addrs, words_per_frame=WORDS_PER_FRAME):
+    """ Return map of frame address to the word index of its first word.
+
+    frame_addrs are all frame addresses of the part (see
+    bitstream_writer.part_frame_addresses).  Frames not written by an FDRI
+    write are missing from the map.
+
+    Frames written by multi-frame writes (MFWR, as in compressed
+    bitstreams) repeat the last frame written by FDRI, and map to the word
+    index of that frame: several frame addresses can share the same words.
+    """
+    sequence = frame_sequence(frame_addrs)
+    sequence_index = {
+        addr: idx
+        for idx, addr in enumerate(sequence) if addr is not None
+    }
+
+    offsets = {}
+    far = None
+    next_idx = None
+    last_frame = None
+    for packet in iter_packets(words):
+        if is_write(packet, 'FAR') and packet.count == 1:
+            far = int(words[packet.start])
+        elif is_write(packet, 'FDRI') and packet.count > 0:
+            if far is not None:
+                if far not in sequence_index:
+                    raise ValueError(
+                        'FDRI write at unknown frame address 0x{:08X}'.format(
+                            far))
+                next_idx = sequence_index[far]
+            elif next_idx is None:
+                raise ValueError('FDRI write without a frame address')
+
+            count = packet.count
+            if count % words_per_frame != 0:
+                raise ValueError(
+                    'FDRI write of {} words is not a whole number of frames'.
+                    format(count))
+
+            for frame in range(count // words_per_frame):
+                if next_idx + frame >= len(sequence):
+                    raise ValueError('FDRI write past the last frame address')
+
+                addr = sequence[next_idx + frame]
+                if addr is not None:
+                    last_frame = packet.start + frame * words_per_frame
+                    offsets[addr] = last_frame
+
+            next_idx += count // words_per_frame
+            far = None
+        elif is_write(packet, 'MFWR') and packet.count > 0:
+            # The frame is a copy of the last FDRI frame, so map it to the
+            # same words.
+            if far is None:
+                raise ValueError('MFWR write without a frame address')
+            if far not in sequence_index:
+                raise ValueError(
+                    'MFWR write at unknown frame address 0x{:08X}'.format(far))
+            if last_frame is None:
+                raise ValueError('MFWR write before any FDRI frame')
+
+            offsets[far] = last_frame
+
+    return offsets
+
+
+def parse_frame_range(frame_range):
+    """ Return inclusive (first, last) frame address of a bitread range.
+
+    >>> parse_frame_range('0x00000000:0x01ffffff')
+    (0, 33554431)
+    """
+    first, last = frame_range.split(':')
+    return int(first, 16), int(last, 16)
+
+
+def read_frames(data,
+                frame_addrs,
+                frame_range=None,
+                words_per_frame=WORDS_PER_FRAME):
+    """ Return the frames written by the FDRI writes of a .bit file.
+
+    data is the content of the .bit file and frame_addrs all frame
+    addresses of the part.  Returns (addrs, rows, frame_words): the sorted
+    frame addresses, the row of frame_words of each of them, and an array
+    of the 16-bit frame words of each distinct frame written by FDRI, as
+    taken by bitstream.BitData.from_frame_words.  Frames of MFWR writes
+    share the row of the FDRI frame they repeat.  frame_range is an
+    optional "first:last" hex frame address range, as used by bitread.
+    """
+    words = config_words(data)
+    offsets = frame_word_offsets(words, frame_addrs, words_per_frame)
+
+    addrs = np.array(sorted(offsets), dtype=np.uint32)
+    if frame_range is not None:
+        first, last = parse_frame_range(frame_range)
+        addrs = addrs[(addrs >= first) & (addrs <= last)]
+
+    starts, rows = np.unique(
+        np.array([offsets[addr] for addr in addrs.tolist()], dtype=np.int64),
+        return_inverse=True)
+    words32 = words[starts[:, np.newaxis] +
+                    np.arange(words_per_frame)].astype('<u4')
+
+    return addrs, rows, words32.view('<u2').reshape(
+        len(starts), 2 * words_per_frame)
+
+
+def read_bit_file(fn, part_json, frame_range=None):
+    """ Return (addrs, rows, frame_words) of a .bit file, see read_frames.
+
+    part_json is the part.json of the part, describing its frames.
+    """
+    with open(fn, 'rb') as f:
+        data = f.read()
+
+    return read_frames(
+        data,
+        list(bitstream_writer.part_frame_addresses(part_json)),
+        frame_range=frame_range)
+
+
+def iter_crc_checks(words):
+    """ Yield (word index, crc) of every CRC register write.
+
+    crc is the CRC the configuration logic computes at that point, which
+    the written value is checked against.
+    """
+    crc = 0
+    for packet in iter_packets(words):
+        if packet.opcode != bitstream_writer.OPCODE_WRITE:
+            continue
+
+        if packet.reg == REGS['CRC']:
+            if packet.count == 1:
+                yield packet.start, crc
+            crc = 0
+        elif (packet.reg == REGS['CMD'] and packet.count == 1
+              and int(words[packet.start]) == CMDS['RCRC']):
+            crc = 0
+        else:
+            crc = bitstream_writer.crc_update(
+                crc, packet.reg,
+                words[packet.start:packet.start + packet.count])
+
+
+def check_crc(words):
+    ''' Raise ValueError if a CRC register write doesn't match the data. '''
+    for idx, crc in iter_crc_checks(words):
+        if int(words[idx]) != crc:
+            raise ValueError(
+                'CRC 0x{:08X} at word {} does not match computed CRC 0x{:08X}'.
+                format(int(words[idx]), idx, crc))
+
+
+def update_crc(words):
+    ''' Rewrite every CRC register write of writable words to match. '''
+    for idx, crc in iter_crc_checks(words):
+        words[idx] = crc
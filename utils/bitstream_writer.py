@@ -0,0 +1,539 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright 2020-2022 F4PGA Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+'''
+UltraScalePlus bitstream (.bit) writer.
+
+Writes assembled frames as the FAR/FDRI/CMD packet sequence decoded by
+bitstream_analyzer.py and bitstream_reader.py, in the layout of
+xcframes2bit.  Frames go into type 2 FDRI writes in the frame address order
+of the part, with two zero frames flushing the frame pipeline after each
+configuration row.  A run of frames that are consecutive in that order is
+written by a single FDRI write, and FAR is written again before each run.
+
+The frame ECC is the ICAP frame ECC computed by xcframes2bit: every set bit
+of the frame contributes its bit position, which skips the powers of two,
+and the parity of the low 12 bits of the result goes to bit 12.  It is
+linear over GF(2), and computed for all frames at once with byte tables.
+
+The configuration CRC is the one computed by the ICAP: CRC-32C over the
+5-bit register address and 32-bit data of every register write.  It is
+linear over GF(2) as well, so the CRC of the frame data is computed for
+whole word arrays at once by combining the per-word contributions in a
+binary tree.
+'''
+
+import struct
+import time
+
+import numpy as np
+
+from utils import util
+
+# Configuration registers and commands, see UG570.
+conf_regs = {
+    0: "CRC",
+    1: "FAR",
+    2: "FDRI",
+    3: "FDRO",
+    4: "CMD",
+    5: "CTL0",
+    6: "MASK",
+    7: "STAT",
+    8: "LOUT",
+    9: "COR0",
+    10: "MFWR",
+    11: "CBC",
+    12: "IDCODE",
+    13: "AXSS",
+    14: "COR1",
+    16: "WBSTAR",
+    17: "TIMER",
+    22: "BOOTSTS",
+    24: "CTL1",
+    31: "BSPI"
+}
+
+cmd_reg_codes = {
+    0: "NULL",
+    1: "WCFG",
+    2: "MFW",
+    3: "LFRM",
+    4: "RCFG",
+    5: "START",
+    7: "RCRC",
+    8: "AGHIGH",
+    9: "SWITCH",
+    10: "GRESTORE",
+    11: "SHUTDOWN",
+    13: "DESYNC",
+    15: "IPROG",
+    16: "CRCC",
+    17: "LTIMER",
+    18: "BSPI_READ",
+    19: "FALL_EDGE"
+}
+
+CRC32C_POLY = 0x82F63B78
+CRC_INPUT_BITS = 37
+
+WORDS_PER_FRAME = 93
+
+# Frame address bits above the configuration row (block type and row).
+FAR_ROW_SHIFT = 18
+
+REGS = {name: addr for addr, name in conf_regs.items()}
+CMDS = {name: code for code, name in cmd_reg_codes.items()}
+
+NOP = 0x20000000
+SYNC_WORD = 0xAA995566
+BUS_WIDTH_WORDS = [0x000000BB, 0x11220044]
+DUMMY_WORD = 0xFFFFFFFF
+
+OPCODE_READ = 1
+OPCODE_WRITE = 2
+
+BIT_HEADER = bytes([
+    0x00, 0x09, 0x0F, 0xF0, 0x0F, 0xF0, 0x0F, 0xF0, 0x0F, 0xF0, 0x00, 0x00,
+    0x01
+])
+
+# 32-bit frame word holding the frame ECC, in the ECC halfwords between
+# the INT and RCLK words of the frame (see fuzzers/002-tilegrid).
+ECC_WORD = 45
+ECC_MASK = 0x1FFF
+
+COR0_VALUE = 0x38003FE5
+CTL0_VALUE = 0x501
+CTL0_MASK = 0x401
+FAR_END = 0x07FC0000
+
+
+def crc_step(crc, val):
+    ''' Feed the 37 input bits of val (register << 32 | data) into the CRC. '''
+    for _ in range(CRC_INPUT_BITS):
+        if (val ^ crc) & 1:
+            crc = (crc >> 1) ^ CRC32C_POLY
+        else:
+            crc >>= 1
+        val >>= 1
+
+    return crc
+
+
+class Gf2Map(object):
+    """ Linear map of 32-bit vectors, applied to arrays with byte tables. """
+
+    def __init__(self, columns):
+        # columns[k] is the image of bit k.
+        self.columns = columns
+
+        self.tables = np.zeros((4, 256), dtype=np.uint32)
+        for byte in range(4):
+            for bit in range(8):
+                column = columns[byte * 8 + bit]
+                self.tables[byte, 1 << bit:2 << bit] = (
+                    self.tables[byte, :1 << bit] ^ column)
+
+    def __call__(self, x):
+        x = np.asarray(x, dtype=np.uint32)
+        return (self.tables[0][x & 0xFF] ^ self.tables[1][(x >> 8) & 0xFF] ^
+                self.tables[2][(x >> 16) & 0xFF] ^ self.tables[3][x >> 24])
+
+    def compose(self, other):
+        ''' Return the map self(other(x)). '''
+        return Gf2Map(self(np.array(other.columns, dtype=np.uint32)).tolist())
+
+
+# CRC register after 37 zero input bits, and CRC contribution of the input.
+CRC_SHIFT = Gf2Map([crc_step(1 << k, 0) for k in range(32)])
+CRC_DATA = Gf2Map([crc_step(0, 1 << k) for k in range(32)])
+CRC_ADDR = [crc_step(0, 1 << (32 + k)) for k in range(5)]
+
+# XOR of the indices of the set bits of a word, and parity of a word.
+BIT_INDEX_XOR = Gf2Map(list(range(32)))
+WORD_PARITY = Gf2Map([1] * 32)
+
+
+def ecc_word_positions(count):
+    """ Return the ECC bit position of bit 0 of each of count frame words.
+
+    Positions start at 0x320 and skip 0x400 and 0x800, so the position of
+    every bit of a frame is unique, not a power of two and fits the 12 bits
+    of the ECC.
+
+    >>> positions = (ecc_word_positions(WORDS_PER_FRAME)[:, np.newaxis] +
+    ...              np.arange(32, dtype=np.uint32)).reshape(-1)
+    >>> len(np.unique(positions)) == len(positions)
+    True
+    >>> bool((positions & (positions - 1)).all())
+    True
+    >>> int(positions.min()), int(positions.max()) < 0x1000
+    (800, True)
+    """
+    idx = np.arange(count, dtype=np.uint32)
+    return idx * 32 + np.where(
+        idx > 0x25, 0x360, np.where(idx > 6, 0x340, 0x320)).astype(np.uint32)
+
+
+def frame_ecc(words):
+    """ Return the ECC of every row of an array of 32-bit frame words.
+
+    The ECC bits of the rows must be clear.
+
+    >>> def icap_ecc(words):
+    ...     ecc = 0
+    ...     for idx, word in enumerate(words):
+    ...         val = idx * 32 + (0x360 if idx > 0x25 else
+    ...                           0x340 if idx > 6 else 0x320)
+    ...         for bit in range(32):
+    ...             if (word >> bit) & 1:
+    ...                 ecc ^= val + bit
+    ...     v = ecc & 0xFFF
+    ...     v ^= v >> 8
+    ...     v ^= v >> 4
+    ...     v ^= v >> 2
+    ...     v ^= v >> 1
+    ...     return ecc ^ ((v & 1) << 12)
+    >>> words = np.random.RandomState(0).randint(
+    ...     0, 2**32, size=(4, WORDS_PER_FRAME), dtype=np.uint64).astype(
+    ...         np.uint32)
+    >>> update_frame_ecc(words)
+    >>> ecc = words[:, ECC_WORD] & ECC_MASK
+    >>> words[:, ECC_WORD] ^= ecc
+    >>> ecc.tolist() == [icap_ecc(row) for row in words.tolist()]
+    True
+
+    Flipping a single bit changes the low 12 bits of the ECC by the
+    position of the bit:
+
+    >>> flipped = words.copy()
+    >>> flipped[0, 7] ^= 1
+    >>> hex(int(frame_ecc(flipped[:1])[0] ^ frame_ecc(words[:1])[0]) & 0xFFF)
+    '0x420'
+    """
+    words = np.asarray(words, dtype=np.uint32)
+
+    # Bit positions of a word are its bit 0 position plus the bit index,
+    # as bit 0 positions are multiples of 32.
+    contributions = BIT_INDEX_XOR(words) ^ (
+        WORD_PARITY(words) * ecc_word_positions(words.shape[-1]))
+    ecc = np.bitwise_xor.reduce(contributions, axis=-1)
+
+    parity = ecc & 0xFFF
+    for shift in (8, 4, 2, 1):
+        parity ^= parity >> shift
+
+    return ecc ^ ((parity & 1) << 12)
+
+
+def update_frame_ecc(words):
+    ''' Rewrite the ECC of every row of a writable array of frame words. '''
+    words[..., ECC_WORD] &= ~np.uint32(ECC_MASK)
+    words[..., ECC_WORD] |= frame_ecc(words)
+
+
+def crc_shift_power(count):
+    ''' Return the map of count CRC updates with zero input. '''
+    result = Gf2Map([1 << k for k in range(32)])
+    power = CRC_SHIFT
+    while count:
+        if count & 1:
+            result = power.compose(result)
+        count >>= 1
+        if count:
+            power = power.compose(power)
+
+    return result
+
+
+def crc_update(crc, reg, words):
+    ''' Return crc after writing words to register reg.
+
+    >>> crc = 0
+    >>> for word in range(1000):
+    ...     crc = crc_step(crc, (REGS['FDRI'] << 32) | word)
+    >>> crc == crc_update(0, REGS['FDRI'], np.arange(1000))
+    True
+    '''
+    words = np.asarray(words, dtype=np.uint32)
+    count = len(words)
+    if count == 0:
+        return crc
+
+    addr_contribution = 0
+    for k in range(5):
+        if (reg >> k) & 1:
+            addr_contribution ^= CRC_ADDR[k]
+
+    contributions = CRC_DATA(words) ^ np.uint32(addr_contribution)
+
+    # Pad in front to a power of 2, leading zero contributions don't
+    # change the result.
+    padded = 1 << (count - 1).bit_length()
+    contributions = np.concatenate((np.zeros(padded - count, dtype=np.uint32),
+                                    contributions))
+
+    shift = CRC_SHIFT
+    while len(contributions) > 1:
+        contributions = shift(contributions[0::2]) ^ contributions[1::2]
+        shift = shift.compose(shift)
+
+    return int(crc_shift_power(count)(crc) ^ contributions[0])
+
+
+def type1_header(reg, count):
+    return (1 << 29) | (OPCODE_WRITE << 27) | (reg << 13) | count
+
+
+def type2_header(count):
+    return (2 << 29) | (OPCODE_WRITE << 27) | count
+
+
+def part_frame_addresses(part_json):
+    ''' Yield every frame address of the part described by part_json. '''
+    for row, buses in part_json.get('rows', {}).items():
+        for bus, columns in buses['configuration_buses'].items():
+            for column, column_info in columns['configuration_columns'].items(
+            ):
+                base_address = ((util.block_type_s2i[bus] << 24) |
+                                (int(row) << FAR_ROW_SHIFT) |
+                                (int(column) << 8))
+                for minor in range(column_info['frame_count']):
+                    yield base_address + minor
+
+
+def add_missing_frames(frames, part_json, words_per_frame=WORDS_PER_FRAME):
+    ''' Add zero frames for frame addresses of the part missing in frames. '''
+    for addr in part_frame_addresses(part_json):
+        if addr not in frames:
+            frames[addr] = np.zeros(2 * words_per_frame, dtype=np.uint16)
+
+
+def frame_sequence(frame_addrs):
+    """ Return frame addresses in FDRI order, with None for padding frames.
+
+    >>> frame_sequence([0x40001, 0x40000, 0x1])
+    [1, None, None, 262144, 262145, None, None]
+    """
+    frame_addrs = sorted(frame_addrs)
+
+    sequence = []
+    for idx, addr in enumerate(frame_addrs):
+        sequence.append(addr)
+        if (idx + 1 == len(frame_addrs)
+                or (frame_addrs[idx + 1] >> FAR_ROW_SHIFT) !=
+            (addr >> FAR_ROW_SHIFT)):
+            sequence.extend([None, None])
+
+    return sequence
+
+
+def frame_runs(addrs, part_frame_addrs):
+    """ Split frame addresses into runs written by a single FDRI write.
+
+    part_frame_addrs are all frame addresses of the part.  Returns a list of
+    (start, end) ranges of frame_sequence(part_frame_addrs): the frames of
+    a run are consecutive in FDRI order, and each run ends with the padding
+    frames that follow its last frame.
+
+    >>> frame_runs([0x1, 0x40000, 0x40002], [0x0, 0x1, 0x40000, 0x40001, 0x40002])
+    [(1, 5), (6, 9)]
+    """
+    sequence = frame_sequence(part_frame_addrs)
+    sequence_index = {
+        addr: idx
+        for idx, addr in enumerate(sequence) if addr is not None
+    }
+
+    indices = []
+    for addr in addrs:
+        if addr not in sequence_index:
+            raise ValueError(
+                'Frame 0x{:08X} is not a frame of the part'.format(addr))
+        indices.append(sequence_index[addr])
+    indices.sort()
+
+    runs = []
+    for idx in indices:
+        if runs and all(addr is None for addr in sequence[runs[-1][1]:idx]):
+            runs[-1][1] = idx + 1
+        else:
+            runs.append([idx, idx + 1])
+
+        # Padding frames after the frame belong to the run.
+        while runs[-1][1] < len(sequence) and sequence[runs[-1][1]] is None:
+            runs[-1][1] += 1
+
+    return [tuple(run) for run in runs]
+
+
+def frame_packet_data(frames,
+                      part_frame_addrs,
+                      words_per_frame=WORDS_PER_FRAME):
+    """ Return the FDRI writes of frames as a list of (FAR, uint32 payload).
+
+    frames is a map of frame address to 16-bit frame words, and
+    part_frame_addrs all frame addresses of the part.  The frame ECC is
+    computed for every frame of frames.
+    """
+    sequence = frame_sequence(part_frame_addrs)
+    sequence_index = {
+        addr: idx
+        for idx, addr in enumerate(sequence) if addr is not None
+    }
+
+    addrs = sorted(
+        frames.keys(), key=lambda addr: sequence_index.get(addr, -1))
+    runs = frame_runs(addrs, part_frame_addrs)
+
+    words = np.zeros((len(addrs), 2 * words_per_frame), dtype='<u2')
+    for idx, addr in enumerate(addrs):
+        words[idx] = frames[addr]
+    words = words.view('<u4').astype(np.uint32)
+    update_frame_ecc(words)
+
+    indices = np.array([sequence_index[addr] for addr in addrs],
+                       dtype=np.int64)
+
+    writes = []
+    first = 0
+    for start, end in runs:
+        last = np.searchsorted(indices, end)
+        data = np.zeros((end - start, words_per_frame), dtype=np.uint32)
+        data[indices[first:last] - start] = words[first:last]
+        writes.append((sequence[start], data.reshape(-1)))
+        first = last
+
+    return writes
+
+
+class BitstreamWriter(object):
+    """ Builds configuration packets and tracks the running CRC. """
+
+    def __init__(self):
+        self.chunks = []
+        self.crc = 0
+
+    def words(self, *words):
+        self.chunks.append(np.array(words, dtype=np.uint32))
+
+    def nop(self, count=1):
+        self.chunks.append(np.full(count, NOP, dtype=np.uint32))
+
+    def write_reg(self, reg_name, value):
+        reg = REGS[reg_name]
+        self.words(type1_header(reg, 1), value)
+
+        if reg_name == 'CRC':
+            self.crc = 0
+        elif reg_name == 'CMD' and value == CMDS['RCRC']:
+            self.crc = 0
+        else:
+            self.crc = crc_update(self.crc, reg, [value])
+
+    def command(self, cmd_name):
+        self.write_reg('CMD', CMDS[cmd_name])
+
+    def write_crc(self):
+        self.write_reg('CRC', self.crc)
+
+    def write_fdri(self, data):
+        self.words(type1_header(REGS['FDRI'], 0), type2_header(len(data)))
+        self.chunks.append(np.asarray(data, dtype=np.uint32))
+        self.crc = crc_update(self.crc, REGS['FDRI'], data)
+
+    def to_bytes(self):
+        return np.concatenate(self.chunks).astype('>u4').tobytes()
+
+
+def configuration_packets(writes, idcode):
+    ''' Return the configuration bytes loading the (FAR, FDRI payload) writes. '''
+    writer = BitstreamWriter()
+
+    writer.words(
+        *([DUMMY_WORD] * 8 + BUS_WIDTH_WORDS + [DUMMY_WORD] * 2 + [SYNC_WORD]))
+
+    # Initialization
+    writer.nop()
+    writer.write_reg('TIMER', 0)
+    writer.write_reg('WBSTAR', 0)
+    writer.command('NULL')
+    writer.nop()
+    writer.command('RCRC')
+    writer.nop(2)
+    writer.write_reg('COR0', COR0_VALUE)
+    writer.write_reg('COR1', 0)
+    writer.write_reg('IDCODE', idcode)
+    writer.command('SWITCH')
+    writer.nop()
+    writer.write_reg('MASK', CTL0_MASK)
+    writer.write_reg('CTL0', CTL0_VALUE)
+    writer.write_reg('MASK', 0)
+    writer.write_reg('CTL1', 0)
+    writer.nop(8)
+
+    # Frame data
+    for far, data in writes:
+        writer.write_reg('FAR', far)
+        writer.command('WCFG')
+        writer.nop()
+        writer.write_fdri(data)
+    writer.write_crc()
+
+    # Startup
+    writer.command('GRESTORE')
+    writer.nop()
+    writer.command('LFRM')
+    writer.nop(100)
+    writer.command('START')
+    writer.nop()
+    writer.write_reg('FAR', FAR_END)
+    writer.write_reg('MASK', CTL0_VALUE)
+    writer.write_reg('CTL0', CTL0_VALUE)
+    writer.write_crc()
+    writer.nop(2)
+    writer.command('DESYNC')
+    writer.nop(400)
+
+    return writer.to_bytes()
+
+
+def bit_header_field(key, value):
+    value = value.encode() + b'\0'
+    return key + struct.pack('>H', len(value)) + value
+
+
+def write_bit(f, frames, part, idcode, part_frame_addrs, design_name=''):
+    """ Write frames to binary file object f as a .bit file.
+
+    frames is a map of frame address to 16-bit frame words, e.g. the output
+    of FasmAssembler.get_frames, and part_frame_addrs all frame addresses of
+    the part (see part_frame_addresses).
+    """
+    config = configuration_packets(
+        frame_packet_data(frames, part_frame_addrs), idcode)
+
+    now = time.localtime()
+    f.write(BIT_HEADER)
+    f.write(bit_header_field(b'a', design_name))
+    f.write(bit_header_field(b'b', part))
+    f.write(bit_header_field(b'c', time.strftime('%Y/%m/%d', now)))
+    f.write(bit_header_field(b'd', time.strftime('%H:%M:%S', now)))
+    f.write(b'e' + struct.pack('>I', len(config)))
+    f.write(config)
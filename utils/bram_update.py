@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright 2020-2022 F4PGA Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+'''
+Replace the BRAM contents of an existing bitstream, like updatemem.
+
+Only the INIT_xx / INITP_xx bits of the given BRAMs are rewritten, directly
+in the memory-mapped .bit file, and the configuration CRC is updated to
+match.  The FASM and the rest of the bitstream are not needed.
+
+The memory map file has one BRAM per line:
+
+  <site> <memory file> [<word width>]
+
+e.g. "RAMB18_X0Y12 firmware.mem 32".  Memory files are $readmemh style
+(.mem/.hex): hex words separated by whitespace, "@<hex address>" to set
+the word address, and "//" comments.  Relative file names are relative to
+the memory map file.  The word width defaults to 32 bits; widths that are
+a multiple of 9 hold parity bits (the upper width / 9 bits of each word),
+which go to INITP.  Addresses missing from the memory file are zero.
+'''
+
+import argparse
+import collections
+import json
+import mmap
+import os
+import re
+import shutil
+
+import numpy as np
+
+from prjuray.db import Database
+from utils import bitstream_reader, bitstream_writer, util
+from utils.segbits_cache import CompiledSegbits, SegbitsCache
+
+INIT_BITS_PER_FEATURE = 256
+
+# Number of INIT_xx and INITP_xx features of each BRAM primitive.
+INIT_FEATURES = {
+    'RAMB18': (64, 8),
+    'RAMB36': (128, 16),
+}
+
+# BEL names of the BRAM sites of a tile, RAMB18 sites in order of their Y
+# coordinate.  The INIT_xx and INITP_xx features of a BRAM are prefixed
+# with the BEL name, see dump_bram_dsp_features in tools/dump_features.tcl.
+BRAM_BELS = {
+    'RAMB18': ('RAMB18E2_L', 'RAMB18E2_U'),
+    'RAMB36': ('RAMB36E2', ),
+}
+
+DEFAULT_WIDTH = 32
+
+BRAM_SITE_RE = re.compile(r'^(RAMB18|RAMB36)_X[0-9]+Y([0-9]+)$')
+
+
+def site_kind(site):
+    """ Return the BRAM primitive of a site, RAMB18 or RAMB36.
+
+    >>> site_kind('RAMB36_X1Y20')
+    'RAMB36'
+    """
+    m = BRAM_SITE_RE.match(site)
+    if m is None:
+        raise ValueError('{} is not a BRAM site'.format(site))
+
+    return m.group(1)
+
+
+def site_feature_prefix(site, tile_sites):
+    """ Return the feature prefix of a BRAM site, the name of its BEL.
+
+    tile_sites are the sites of the tile of the BRAM.
+
+    >>> sites = ['RAMB36_X0Y20', 'RAMB18_X0Y41', 'RAMB18_X0Y40']
+    >>> site_feature_prefix('RAMB18_X0Y41', sites)
+    'RAMB18E2_U'
+    >>> site_feature_prefix('RAMB36_X0Y20', sites)
+    'RAMB36E2'
+    """
+    kind = site_kind(site)
+    same_kind = sorted((int(BRAM_SITE_RE.match(s).group(2)), s)
+                       for s in tile_sites
+                       if BRAM_SITE_RE.match(s) and site_kind(s) == kind)
+
+    idx = [s for _, s in same_kind].index(site)
+    if idx >= len(BRAM_BELS[kind]):
+        raise ValueError('Unexpected {} sites {}'.format(
+            kind, ', '.join(s for _, s in same_kind)))
+
+    return BRAM_BELS[kind][idx]
+
+
+def read_mem_map(fn):
+    ''' Yield (site, memory file, width) of a memory map file. '''
+    with open(fn) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+
+            fields = line.split()
+            if len(fields) not in (2, 3):
+                raise ValueError('Invalid memory map line "{}"'.format(line))
+
+            width = DEFAULT_WIDTH
+            if len(fields) == 3:
+                width = int(fields[2])
+
+            yield fields[0], os.path.join(os.path.dirname(fn),
+                                          fields[1]), width
+
+
+def read_mem(fn):
+    ''' Return map of word address to word of a $readmemh style file. '''
+    words = {}
+    address = 0
+    with open(fn) as f:
+        for line in f:
+            for token in line.split('//')[0].split():
+                if token.startswith('@'):
+                    address = int(token[1:], 16)
+                else:
+                    words[address] = int(token.replace('_', ''), 16)
+                    address += 1
+
+    return words
+
+
+def mem_init_bits(words, width, init_count, initp_count):
+    """ Return the INIT and INITP bits of memory words, as uint8 arrays.
+
+    >>> init, initp = mem_init_bits({0: 0x1ff, 2: 0x100}, 9, 1, 1)
+    >>> np.flatnonzero(init).tolist(), np.flatnonzero(initp).tolist()
+    ([0, 1, 2, 3, 4, 5, 6, 7], [0, 2])
+    """
+    parity_width = width // 9 if width % 9 == 0 else 0
+    data_width = width - parity_width
+
+    init = np.zeros(init_count * INIT_BITS_PER_FEATURE, dtype=np.uint8)
+    initp = np.zeros(initp_count * INIT_BITS_PER_FEATURE, dtype=np.uint8)
+    depth = len(init) // data_width
+    if not words:
+        return init, initp
+
+    if max(words) >= depth:
+        raise ValueError(
+            'Word address 0x{:X} is past the {} words of {} bits'.format(
+                max(words), depth, width))
+    if max(words.values()).bit_length() > width:
+        raise ValueError('Word wider than {} bits'.format(width))
+
+    word_bytes = (width + 7) // 8
+    word_bits = np.zeros((depth, word_bytes * 8), dtype=np.uint8)
+    word_bits[list(words)] = np.unpackbits(
+        np.frombuffer(
+            b''.join(
+                word.to_bytes(word_bytes, 'little')
+                for word in words.values()),
+            dtype=np.uint8),
+        bitorder='little').reshape(len(words), word_bytes * 8)
+
+    init[:depth * data_width] = word_bits[:, :data_width].reshape(-1)
+    if parity_width:
+        initp[:depth *
+              parity_width] = word_bits[:, data_width:width].reshape(-1)
+
+    return init, initp
+
+
+def bram_site_tiles(grid):
+    ''' Return map of BRAM site name to its tile. '''
+    site_tiles = {}
+    for tile in grid.tiles():
+        for site in grid.gridinfo_at_tilename(tile).sites:
+            if site.startswith('RAMB'):
+                site_tiles[site] = tile
+
+    return site_tiles
+
+
+def init_feature_bits(segbits, prefix, init, initp):
+    """ Return the segbits of the INIT_xx and INITP_xx features of a BEL.
+
+    Returns arrays (bit_idx, values), bit_idx indexing the bits of segbits
+    and values being whether each bit is set in the frames.
+
+    >>> segbits = CompiledSegbits(
+    ...     'BRAM', ['RAMB18E2_L.INIT_00[0]', 'RAMB18E2_L.INIT_00[1]',
+    ...     'RAMB18E2_U.INIT_00[1]'], np.zeros(3, dtype=np.uint8), [],
+    ...     np.array([0, 1, 2, 3]), ['CLB_IO_CLK'], np.zeros(3, dtype=np.uint8),
+    ...     np.arange(3), np.zeros(3), np.arange(3), np.ones(3, dtype=bool))
+    >>> init = np.zeros(INIT_BITS_PER_FEATURE, dtype=np.uint8)
+    >>> init[1] = 1
+    >>> bit_idx, values = init_feature_bits(
+    ...     segbits, 'RAMB18E2_L', init, init[:0])
+    >>> bit_idx.tolist(), values.tolist()
+    ([0, 1], [False, True])
+    >>> init_feature_bits(segbits, 'RAMB36E2', init, init[:0])
+    Traceback (most recent call last):
+    ...
+    ValueError: Segment DB BRAM has no RAMB36E2.INIT_xx features
+    """
+    try:
+        segbits.address_table('{}.INIT_00'.format(prefix))
+    except KeyError:
+        raise ValueError('Segment DB {} has no {}.INIT_xx features'.format(
+            segbits.tile_type, prefix))
+
+    bit_idx = [np.zeros(0, dtype=np.int64)]
+    values = [np.zeros(0, dtype=bool)]
+    for kind, bits in (('INIT', init), ('INITP', initp)):
+        for n in range(len(bits) // INIT_BITS_PER_FEATURE):
+            feature = '{}.{}_{:02X}'.format(prefix, kind, n)
+            feature_bits = bits[n * INIT_BITS_PER_FEATURE:(n + 1) *
+                                INIT_BITS_PER_FEATURE]
+            try:
+                addresses, starts, ends = segbits.address_table(feature)
+            except KeyError:
+                addresses = np.zeros(0, dtype=np.int64)
+
+            missing = np.setdiff1d(
+                np.flatnonzero(feature_bits), addresses, assume_unique=True)
+            if len(missing):
+                raise ValueError('Segment DB {} has no bits for {}[{}]'.format(
+                    segbits.tile_type, feature, missing[0]))
+            if len(addresses) == 0:
+                continue
+
+            _, feature_bit_idx = segbits.address_bits(feature, addresses)
+            bit_idx.append(feature_bit_idx)
+            values.append(
+                np.repeat(feature_bits[addresses].astype(bool), ends - starts))
+
+    bit_idx = np.concatenate(bit_idx)
+    return bit_idx, np.concatenate(values) == segbits.isset[bit_idx]
+
+
+def bram_frame_bits(grid, segbits_cache, tile, site, width, words):
+    """ Return the frame bits of the INIT_xx and INITP_xx features of a BRAM.
+
+    Returns arrays (frame_addrs, word_addrs, bit_indices, values), with
+    16-bit frame word addresses as used by FasmAssembler.
+    """
+    gridinfo = grid.gridinfo_at_tilename(tile)
+    segbits = segbits_cache.get(gridinfo.tile_type)
+    prefix = site_feature_prefix(site, gridinfo.sites)
+
+    init_count, initp_count = INIT_FEATURES[site_kind(site)]
+    init, initp = mem_init_bits(words, width, init_count, initp_count)
+    try:
+        bit_idx, values = init_feature_bits(segbits, prefix, init, initp)
+    except ValueError as e:
+        raise ValueError('{} ({}): {}'.format(site, tile, e))
+
+    frame_addrs = segbits.frame_offsets[bit_idx].astype(np.int64)
+    word_addrs = segbits.word_offsets[bit_idx].astype(np.int64)
+    block_type_idx = segbits.block_types[bit_idx]
+    for idx in set(block_type_idx.tolist()):
+        bits = gridinfo.bits[segbits.block_type_enums[idx]]
+        sel = block_type_idx == idx
+        frame_addrs[sel] += bits.base_address
+        word_addrs[sel] += bits.offset
+
+    return frame_addrs, word_addrs, segbits.bit_indices[bit_idx], values
+
+
+def patch_frame_bits(words, frame_offsets, frame_addrs, word_addrs,
+                     bit_indices, values):
+    """ Set or clear bits of the frames of configuration words.
+
+    frame_offsets is the map of frame address to word index returned by
+    bitstream_reader.frame_word_offsets.  Word addresses are of 16-bit frame
+    words, 16-bit word 2 * i being the lower half of 32-bit word i.
+
+    Frames replicated by MFWR writes share their words with other frames
+    and can't be patched in place.  The frame ECC word is left as it is.
+
+    Patching the original values back restores the bitstream:
+
+    >>> import io
+    >>> part_frame_addrs = [0x100, 0x101]
+    >>> frames = {
+    ...     addr: np.random.RandomState(addr).randint(
+    ...         0, 2**16, size=2 * bitstream_writer.WORDS_PER_FRAME).astype(
+    ...             np.uint16)
+    ...     for addr in part_frame_addrs
+    ... }
+    >>> f = io.BytesIO()
+    >>> bitstream_writer.write_bit(f, frames, 'xczu3eg', 0, part_frame_addrs)
+    >>> data = bytearray(f.getvalue())
+    >>> words = bitstream_reader.config_words(data)
+    >>> offsets = bitstream_reader.frame_word_offsets(words, part_frame_addrs)
+    >>> bits = (np.array([0x101, 0x101]), np.array([3, 4]), np.array([5, 6]))
+    >>> old = np.array([(frames[0x101][3] >> 5) & 1,
+    ...                 (frames[0x101][4] >> 6) & 1], dtype=bool)
+    >>> patch_frame_bits(words, offsets, *bits, ~old)
+    >>> bitstream_reader.update_crc(words)
+    >>> bytes(data) == f.getvalue()
+    False
+    >>> patch_frame_bits(words, offsets, *bits, old)
+    >>> bitstream_reader.update_crc(words)
+    >>> bytes(data) == f.getvalue()
+    True
+    """
+    shared = collections.Counter(frame_offsets.values())
+
+    frames, frame_idx = np.unique(frame_addrs, return_inverse=True)
+    starts = []
+    for addr in frames.tolist():
+        if addr not in frame_offsets:
+            raise ValueError(
+                'Frame 0x{:08X} is not written by the bitstream'.format(addr))
+        if shared[frame_offsets[addr]] > 1:
+            raise ValueError(
+                'Frame 0x{:08X} is written by a multi-frame write'.format(
+                    addr))
+        starts.append(frame_offsets[addr])
+
+    word_idx = np.array(starts, dtype=np.int64)[frame_idx] + word_addrs // 2
+    masks = np.left_shift(
+        np.uint32(1), (bit_indices + 16 * (word_addrs % 2)).astype(np.uint32))
+
+    word_idx, inverse = np.unique(word_idx, return_inverse=True)
+    set_masks = np.zeros(len(word_idx), dtype=np.uint32)
+    clear_masks = np.zeros(len(word_idx), dtype=np.uint32)
+    np.bitwise_or.at(set_masks, inverse[values], masks[values])
+    np.bitwise_or.at(clear_masks, inverse[~values], masks[~values])
+
+    words[word_idx] = (words[word_idx] & ~clear_masks) | set_masks
+
+
+def update_bram(db_root, part, bit_file, mem_map):
+    """ Rewrite BRAM contents of bit_file in place.
+
+    mem_map is a list of (site, memory file, width).
+    """
+    db = Database(db_root, part)
+    grid = db.grid()
+    segbits_cache = SegbitsCache(db)
+    site_tiles = bram_site_tiles(grid)
+
+    with open(os.path.join(db_root, part, 'part.json')) as f:
+        frame_addrs = list(bitstream_writer.part_frame_addresses(json.load(f)))
+
+    # Resolve all bits before touching the bitstream.
+    frame_bits = []
+    for site, mem_file, width in mem_map:
+        if site not in site_tiles:
+            raise ValueError('Unknown BRAM site {}'.format(site))
+
+        frame_bits.append(
+            bram_frame_bits(grid, segbits_cache, site_tiles[site], site, width,
+                            read_mem(mem_file)))
+
+    with open(bit_file, 'r+b') as f, mmap.mmap(f.fileno(), 0) as mm:
+        words = bitstream_reader.config_words(mm)
+        bitstream_reader.check_crc(words)
+        frame_offsets = bitstream_reader.frame_word_offsets(words, frame_addrs)
+
+        for bits in frame_bits:
+            patch_frame_bits(words, frame_offsets, *bits)
+
+        bitstream_reader.update_crc(words)
+
+        # Release the view before the mmap is closed.
+        del words
+        mm.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    util.db_root_arg(parser)
+    util.part_arg(parser)
+    parser.add_argument(
+        '--mem_map',
+        required=True,
+        help='Memory map file, lines of "<site> <memory file> [<width>]"')
+    parser.add_argument('bit_in', help='Input bitstream (.bit) file')
+    parser.add_argument(
+        'bit_out',
+        nargs='?',
+        help='Output bitstream (.bit) file, default is to update bit_in')
+
+    args = parser.parse_args()
+
+    bit_file = args.bit_in
+    if args.bit_out is not None:
+        shutil.copyfile(args.bit_in, args.bit_out)
+        bit_file = args.bit_out
+
+    update_bram(
+        db_root=args.db_root,
+        part=args.part,
+        bit_file=bit_file,
+        mem_map=list(read_mem_map(args.mem_map)))
+
+
+if __name__ == '__main__':
+    main()
@@ -18,7 +18,7 @@
 # SPDX-License-Identifier: Apache-2.0
 """ Utility to convert from dump features TCL to segmaker. """
 import argparse
-from utils.segmaker import Segmaker
+from utils.segmaker import Segmaker, SegmakerContext
 from utils import util
 from prjuray.db import Database
 from prjuray.grid_types import BlockType
@@ -145,6 +145,12 @@ def run():
     parser.add_argument('--features_file', default='design.features')
     parser.add_argument('--extent_features_file', default=None)
     parser.add_argument('--block_type', default='CLB_IO_CLK')
+    parser.add_argument(
+        '--segdata_store',
+        default=None,
+        help=
+        "Directory of the segdata stores to append to, instead of writing segdata text files."
+    )
     parser.add_argument(
         '--zero_feature_enums',
         help=
@@ -206,8 +212,11 @@ def run():
     for _, tile_type in all_features.keys():
         tile_types.add(tile_type)
 
+    # The grid and bits are the same for every tile type, load them once.
+    context = SegmakerContext(args.bits_file, bits_per_word=16)
+
     for tile_type in tile_types:
-        segmk = Segmaker(args.bits_file, bits_per_word=16)
+        segmk = Segmaker(args.bits_file, context=context)
         segmk.set_def_bt(args.block_type)
 
         tree = feature_trees[tile_type]
@@ -327,7 +336,8 @@ def run():
         segmk.write(
             allow_empty=True,
             extra_tags=output_empty_pips(tree, pip_sources,
-                                         pip_active_per_tile))
+                                         pip_active_per_tile),
+            store_dir=args.segdata_store)
 
 
 if __name__ == "__main__":
@@ -20,11 +20,15 @@
 import contextlib
 import fasm
 import argparse
+import json
 import os
 import tempfile
 import subprocess
+import sys
 
-from utils import fasm_assembler, util
+import numpy as np
+
+from utils import bitstream_reader, bitstream_writer, fasm_assembler, util
 from utils.bitstream import WORD_SIZE_BITS
 from prjuray.db import Database
 
@@ -35,9 +39,8 @@ def dump_frm(f, frames):
         words = frames[addr]
 
         # FIXME: Convert from 16 to 32 bit words for the bits format.
-        words32 = []
-        for word0, word1 in zip(words[::2], words[1::2]):
-            words32.append((word1 << WORD_SIZE_BITS) | word0)
+        words = np.asarray(words, dtype=np.uint32)
+        words32 = (words[1::2] << WORD_SIZE_BITS) | words[::2]
 
         f.write('0x%08X ' % addr + ','.join(['0x%08X' % w
                                              for w in words32]) + '\n')
@@ -90,7 +93,10 @@ def fasm_to_frames(
     if bits_file:
         output_bits(bits_file, frames)
 
-    dump_frm(frames_file, frames)
+    if frames_file:
+        dump_frm(frames_file, frames)
+
+    return frames
 
 
 def frames_to_bit(xcframes2bit, arch, part, part_yaml, frames_filename,
@@ -107,6 +113,45 @@ def frames_to_bit(xcframes2bit, arch, part, part_yaml, frames_filename,
         shell=True)
 
 
+def frames_to_bit_native(frames, part, part_json, design_name, bit_filename):
+    '''Write frames to a .bit file without the .frm round-trip'''
+    with open(part_json) as f:
+        part_j = json.load(f)
+
+    bitstream_writer.add_missing_frames(frames, part_j)
+
+    with open(bit_filename, 'wb') as f:
+        bitstream_writer.write_bit(
+            f,
+            frames,
+            part=part,
+            idcode=part_j['idcode'],
+            part_frame_addrs=list(
+                bitstream_writer.part_frame_addresses(part_j)),
+            design_name=design_name)
+
+
+def compare_bit_files(fn_a, fn_b):
+    """ Return the index of the first configuration word that differs.
+
+    Words are counted from the sync word, the .bit headers (design name,
+    date) are not compared.  Returns None if both files are the same.
+    """
+    with open(fn_a, 'rb') as f:
+        words_a = bitstream_reader.config_words(f.read())
+    with open(fn_b, 'rb') as f:
+        words_b = bitstream_reader.config_words(f.read())
+
+    count = min(len(words_a), len(words_b))
+    different = np.flatnonzero(words_a[:count] != words_b[:count])
+    if len(different):
+        return int(different[0])
+    if len(words_a) != len(words_b):
+        return count
+
+    return None
+
+
 def main():
     parser = argparse.ArgumentParser(
         description=
@@ -149,21 +194,37 @@ def main():
         '--xcframes2bit',
         help="Path to xcframes2bit executable.",
         default=default_xcframes2bit)
+    parser.add_argument(
+        '--native-writer',
+        action='store_true',
+        help="Write the bitstream directly instead of using xcframes2bit.")
+    parser.add_argument(
+        '--compare-xcframes2bit',
+        action='store_true',
+        help="Write the bitstream with xcframes2bit and check that the "
+        "native writer produces the same configuration data.")
 
     args = parser.parse_args()
+    if args.native_writer and args.compare_xcframes2bit:
+        parser.error(
+            '--native-writer and --compare-xcframes2bit are mutually exclusive'
+        )
 
     with contextlib.ExitStack() as stack:
         if args.frames_file:
             frames_file = stack.enter_context(open(args.frames_file, 'w'))
+        elif args.native_writer:
+            frames_file = None
         else:
-            frames_file = stack.enter_context(tempfile.NamedTemporaryFile())
+            frames_file = stack.enter_context(
+                tempfile.NamedTemporaryFile('w', suffix='.frm'))
 
         if args.bits_file:
             bits_file = stack.enter_context(open(args.bits_file, 'w'))
         else:
             bits_file = None
 
-        fasm_to_frames(
+        frames = fasm_to_frames(
             db_root=args.db_root,
             part=args.part,
             filename_in=args.fn_in,
@@ -172,6 +233,17 @@ def main():
             bits_file=bits_file,
         )
 
+        if args.native_writer:
+            frames_to_bit_native(
+                frames=frames,
+                part=args.part,
+                part_json=os.path.join(args.db_root, args.part, "part.json"),
+                design_name=os.path.basename(args.fn_in),
+                bit_filename=args.fn_out)
+            return
+
+        # xcframes2bit reads the frames file while it is still open.
+        frames_file.flush()
         frames_to_bit(
             xcframes2bit=args.xcframes2bit,
             arch=args.architecture,
@@ -180,6 +252,24 @@ def main():
             frames_filename=frames_file.name,
             bit_filename=args.fn_out)
 
+        if args.compare_xcframes2bit:
+            native_file = stack.enter_context(
+                tempfile.NamedTemporaryFile(suffix='.bit'))
+            frames_to_bit_native(
+                frames=frames,
+                part=args.part,
+                part_json=os.path.join(args.db_root, args.part, "part.json"),
+                design_name=os.path.basename(args.fn_in),
+                bit_filename=native_file.name)
+
+            word = compare_bit_files(args.fn_out, native_file.name)
+            if word is not None:
+                print(
+                    'Native writer output differs from xcframes2bit at '
+                    'configuration word {}'.format(word),
+                    file=sys.stderr)
+                sys.exit(1)
+
 
 if __name__ == '__main__':
     main()
@@ -22,9 +22,13 @@ from __future__ import print_function
 import fasm
 import argparse
 import json
+import multiprocessing
+import os
 
-from utils import fasm_assembler, util
-from utils.bitstream import WORD_SIZE_BITS
+import numpy as np
+
+from utils import fasm_assembler, frame_file, util
+from utils.bitstream import FRAME_WORD_COUNT, WORD_SIZE_BITS
 from prjuray.db import Database
 from utils.roi import Roi
 
@@ -39,6 +43,10 @@ class FASMSyntaxError(SyntaxError):
     pass
 
 
+# Database of a --jobs worker process, see init_worker.
+WORKER_DB = None
+
+
 def dump_frames_verbose(frames):
     print()
     print("Frames: %d" % len(frames))
@@ -75,6 +83,31 @@ def dump_frm(f, frames):
                                              for w in words]) + '\n')
 
 
+def read_frm(f):
+    '''Read a .frm file written by dump_frm'''
+    frames = {}
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+
+        addr, words = line.split(' ')
+        frames[int(addr,
+                   16)] = np.array([int(w, 16) for w in words.split(',')],
+                                   dtype=np.uint16)
+
+    return frames
+
+
+def read_frames(fn):
+    '''Read frames from a binary frame file or a .frm file'''
+    if frame_file.is_frame_file(fn):
+        return frame_file.load_frames(fn)
+
+    with open(fn) as f:
+        return read_frm(f)
+
+
 def output_bits(f, frames):
     """Write a .bits file given a list of frames, with each set bit written as bit_%08x_%03d_%02d """
     for addr in sorted(frames.keys()):
@@ -88,6 +121,156 @@ def output_bits(f, frames):
                         addr, word32_idx, bit32_idx))
 
 
+def tile_features(lines):
+    '''Return map of tile name to the set of its canonical features'''
+    tiles = {}
+    for line in lines:
+        if not line.set_feature:
+            continue
+
+        tile = line.set_feature.feature.split('.')[0]
+        tiles.setdefault(tile, set()).update(
+            fasm.canonical_features(line.set_feature))
+
+    return tiles
+
+
+def assemble_delta(assembler, base_filename, filename_in, base_frames,
+                   extra_features):
+    """ Reassemble only the frames of tiles whose features changed.
+
+    base_frames are the frames previously assembled from base_filename.
+    Returns map of frame address to frame words for every frame owned by a
+    changed tile, with the words of unchanged tiles kept from base_frames.
+    """
+    base_lines = list(fasm.parse_fasm_filename(base_filename))
+    base_lines.extend(extra_features)
+    lines = list(fasm.parse_fasm_filename(filename_in))
+    lines.extend(extra_features)
+
+    base_tiles = tile_features(base_lines)
+    tiles = tile_features(lines)
+    changed_tiles = set(
+        tile for tile in set(base_tiles) | set(tiles)
+        if base_tiles.get(tile) != tiles.get(tile))
+
+    changed_frames = set()
+    for tile in changed_tiles:
+        gridinfo = assembler.grid.gridinfo_at_tilename(tile)
+        for bits in gridinfo.bits.values():
+            changed_frames.update(
+                range(bits.base_address, bits.base_address + bits.frames))
+
+    assembler.load_frames({
+        addr: base_frames[addr]
+        for addr in changed_frames if addr in base_frames
+    })
+    for tile in changed_tiles:
+        assembler.clear_tile(tile)
+
+    missing_features = []
+    for line in lines:
+        if line.set_feature and line.set_feature.feature.split(
+                '.')[0] in changed_tiles:
+            assembler.add_fasm_line(line, missing_features)
+
+    if missing_features:
+        raise fasm_assembler.FasmLookupError('\n'.join(missing_features))
+
+    return {
+        addr: assembler.frame_words[assembler.frame_slot(addr)]
+        for addr in sorted(changed_frames)
+    }
+
+
+def split_fasm_text(text, chunks):
+    """ Split FASM text into at most chunks ranges of whole lines.
+
+    FASM statements never span lines, so each range can be parsed on its
+    own.
+
+    >>> split_fasm_text('A.B\\nA.C\\n\\nD.E\\n', 2)
+    ['A.B\\nA.C\\n', '\\nD.E\\n']
+    """
+    lines = text.splitlines(keepends=True)
+    size = max(1, -(-len(lines) // chunks))
+    return [''.join(lines[i:i + size]) for i in range(0, len(lines), size)]
+
+
+def init_worker(db_root, part):
+    global WORKER_DB
+    WORKER_DB = Database(db_root, part)
+
+
+def assemble_shard(text):
+    """ Parse and assemble a range of FASM lines in a worker process.
+
+    Returns the partial frames (see FasmAssembler.used_frames), the frames
+    in use, the features set and the missing features.
+    """
+    # Conflicts are reported by assembling again serially, so the lines of
+    # bits aren't needed here.
+    assembler = fasm_assembler.FasmAssembler(WORKER_DB, track_lines=False)
+
+    set_features = []
+    assembler.set_feature_callback(set_features.append)
+
+    missing_features = []
+    for line in fasm.parse_fasm_string(text):
+        assembler.add_fasm_line(line, missing_features)
+
+    frame_addrs, set_mask, clear_mask = assembler.used_frames()
+    return (frame_addrs, set_mask, clear_mask, assembler.frames_in_use,
+            set_features, missing_features)
+
+
+def parse_fasm_parallel(assembler, db_root, part, filename_in, extra_features,
+                        jobs):
+    """ Parallel equivalent of FasmAssembler.parse_fasm_filename.
+
+    The FASM file is split into ranges of lines, which are parsed and
+    assembled in a pool of jobs processes, and the partial frames are
+    merged into assembler.  Raises FasmInconsistentBits on any conflict,
+    within or across ranges.
+    """
+    with open(filename_in) as f:
+        text = f.read()
+
+    # More ranges than jobs, so workers finishing early pick up more work.
+    shards = split_fasm_text(text, 4 * jobs)
+
+    missing_features = []
+    with multiprocessing.Pool(
+            processes=jobs, initializer=init_worker, initargs=(db_root,
+                                                               part)) as pool:
+        # imap returns the ranges in file order, so set features and
+        # missing features are in input order.
+        for (frame_addrs, set_mask, clear_mask, frames_in_use, set_features,
+             shard_missing_features) in pool.imap(assemble_shard, shards):
+            for set_feature in set_features:
+                assembler.feature_callback(set_feature)
+            assembler.merge_frames(frame_addrs, set_mask, clear_mask)
+            assembler.frames_in_use |= frames_in_use
+            missing_features.extend(shard_missing_features)
+
+    for line in extra_features:
+        assembler.add_fasm_line(line, missing_features)
+
+    if missing_features:
+        raise fasm_assembler.FasmLookupError('\n'.join(missing_features))
+
+
+def raise_inconsistent_bits(db, segbits_cache, filename_in, extra_features):
+    """ Assemble serially, tracking the FASM line of every bit.
+
+    Used after an assembly without line tracking found inconsistent bits,
+    to raise FasmInconsistentBits naming both offending FASM lines.
+    """
+    fasm_assembler.FasmAssembler(
+        db, segbits_cache=segbits_cache).parse_fasm_filename(
+            filename_in, extra_features=extra_features)
+
+
 def run(db_root,
         part,
         filename_in,
@@ -95,9 +278,22 @@ def run(db_root,
         sparse=False,
         roi=None,
         debug=False,
-        dump_bits=False):
-    db = Database(db_root, part)
-    assembler = fasm_assembler.FasmAssembler(db)
+        dump_bits=False,
+        binary=False,
+        jobs=1,
+        base_fasm=None,
+        base_frames=None,
+        fast=False,
+        db=None,
+        segbits_cache=None):
+    if base_fasm is not None and jobs > 1:
+        raise ValueError('Assembly from a base FASM is always serial')
+
+    if db is None:
+        db = Database(db_root, part)
+    # Bits merged from the parallel workers have no FASM line recorded.
+    assembler = fasm_assembler.FasmAssembler(
+        db, segbits_cache=segbits_cache, track_lines=not fast and jobs == 1)
 
     set_features = set()
 
@@ -126,14 +322,38 @@ def run(db_root,
     extra_features += list(
         fasm.parse_fasm_string('\n'.join(required_features)))
 
-    assembler.parse_fasm_filename(filename_in, extra_features=extra_features)
-
-    frames = assembler.get_frames(sparse=sparse)
+    try:
+        if base_fasm is not None:
+            frames = assemble_delta(assembler, base_fasm, filename_in,
+                                    read_frames(base_frames), extra_features)
+        elif jobs > 1:
+            parse_fasm_parallel(assembler, db_root, part, filename_in,
+                                extra_features, jobs)
+        else:
+            assembler.parse_fasm_filename(
+                filename_in, extra_features=extra_features)
+    except fasm_assembler.FasmInconsistentBits:
+        # Assemble again serially, so the error points at the same
+        # offending FASM lines as a serial assembly tracking lines.
+        if jobs > 1 or fast:
+            raise_inconsistent_bits(db, segbits_cache, filename_in,
+                                    extra_features)
+        raise
+
+    if base_fasm is None:
+        frames = assembler.get_frames(sparse=sparse)
 
     if debug:
         dump_frames_sparse(frames)
 
-    if dump_bits:
+    if binary:
+        frame_file.write_frames(
+            f_out,
+            frames,
+            part=part,
+            arch=os.getenv('URAY_ARCH', ''),
+            words_per_frame=FRAME_WORD_COUNT)
+    elif dump_bits:
         output_bits(f_out, frames)
     else:
         dump_frm(f_out, frames)
@@ -158,6 +378,29 @@ def main():
         '--dump_bits',
         action='store_true',
         help="Output in bits format (bit_%08x_%03d_%02d)")
+    parser.add_argument(
+        '--binary',
+        action='store_true',
+        help="Output in binary frame file format (see frame_file.py)")
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=1,
+        help="Number of processes parsing and assembling FASM lines in "
+        "parallel")
+    parser.add_argument(
+        '--base_fasm',
+        help="FASM file --base_frames were assembled from. "
+        "Only frames of tiles whose features differ from it are output.")
+    parser.add_argument(
+        '--base_frames',
+        help=
+        "Frame (.frm or binary) file previously assembled from --base_fasm.")
+    parser.add_argument(
+        '--fast',
+        action='store_true',
+        help="Don't record the FASM line of every bit.  Inconsistent bits "
+        "are reported by assembling again with the lines recorded.")
     parser.add_argument('fn_in', help='Input FPGA assembly (.fasm) file')
     parser.add_argument(
         'fn_out',
@@ -166,14 +409,26 @@ def main():
         help='Output FPGA frame (.frm) file')
 
     args = parser.parse_args()
+    if (args.base_fasm is None) != (args.base_frames is None):
+        parser.error('--base_fasm and --base_frames must be used together')
+    if args.base_fasm is not None and args.jobs > 1:
+        parser.error('--jobs can not be used with --base_fasm')
+    if args.binary and args.dump_bits:
+        parser.error('--binary and --dump_bits are mutually exclusive')
+
     run(db_root=args.db_root,
         part=args.part,
         filename_in=args.fn_in,
-        f_out=open(args.fn_out, 'w'),
+        f_out=open(args.fn_out, 'wb' if args.binary else 'w'),
         sparse=args.sparse,
         roi=args.roi,
         dump_bits=args.dump_bits,
-        debug=args.debug)
+        binary=args.binary,
+        debug=args.debug,
+        jobs=args.jobs,
+        base_fasm=args.base_fasm,
+        base_frames=args.base_frames,
+        fast=args.fast)
 
 
 if __name__ == '__main__':
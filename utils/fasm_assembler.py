@@ -18,7 +18,10 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import fasm
+import itertools
+import numpy as np
 import bitstream
+from segbits_cache import SegbitsCache
 
 
 class FasmLookupError(Exception):
@@ -29,134 +32,335 @@ class FasmInconsistentBits(Exception):
     pass
 
 
-def init_frame_at_address(frames, addr):
-    '''Set given frame to 0 if not initialized '''
-    if not addr in frames:
-        frames[addr] = [0 for _i in range(bitstream.FRAME_WORD_COUNT)]
+class FasmAssembler(object):
+    """ Assembles FASM features into frames.
 
+    Frame contents are kept in three parallel uint16 arrays indexed by a
+    dense frame slot (see frame_slot):
 
-class FasmAssembler(object):
-    def __init__(self, db):
+    - frame_words: the assembled frame data,
+    - frame_set_mask: bits explicitly set by a FASM line,
+    - frame_clear_mask: bits explicitly cleared by a FASM line.
+
+    A bit that ends up in both masks is an inconsistency.
+
+    With track_lines, the FASM line setting or clearing each bit is kept in
+    frames_line, so inconsistencies name both offending lines.  Without it
+    nothing is recorded per bit, and only the second line is named; callers
+    wanting the full message assemble again with track_lines on conflict.
+    """
+
+    # Initial number of frame slots, grown by doubling as needed.
+    INITIAL_FRAME_SLOTS = 1024
+
+    def __init__(self, db, segbits_cache=None, track_lines=True):
         self.db = db
         self.grid = db.grid()
+        self.segbits_cache = segbits_cache
+        if self.segbits_cache is None:
+            self.segbits_cache = SegbitsCache(db)
 
         self.seen_tile = set()
         self.frames_in_use = set()
 
-        self.frames = {}
+        self.frame_slots = {}
+        self.frame_addrs = []
+        self.frame_words = self._alloc_frames(self.INITIAL_FRAME_SLOTS)
+        self.frame_set_mask = self._alloc_frames(self.INITIAL_FRAME_SLOTS)
+        self.frame_clear_mask = self._alloc_frames(self.INITIAL_FRAME_SLOTS)
+        self.track_lines = track_lines
         self.frames_line = {}
+        self.tile_slots = {}
 
         self.feature_callback = lambda feature: None
 
+    @staticmethod
+    def _alloc_frames(count):
+        return np.zeros((count, bitstream.FRAME_WORD_COUNT), dtype=np.uint16)
+
+    def _grow_frames(self, count):
+        used = len(self.frame_addrs)
+        for name in ('frame_words', 'frame_set_mask', 'frame_clear_mask'):
+            arr = self._alloc_frames(count)
+            arr[:used] = getattr(self, name)[:used]
+            setattr(self, name, arr)
+
+    def frame_slot(self, frame_addr):
+        """ Return the dense slot of a frame address, allocating it if needed.
+
+        Note that allocating a slot may reallocate the frame arrays, which
+        invalidates views previously returned by get_frames.
+        """
+        slot = self.frame_slots.get(frame_addr)
+        if slot is None:
+            slot = len(self.frame_addrs)
+            if slot == len(self.frame_words):
+                self._grow_frames(2 * slot)
+            self.frame_slots[frame_addr] = slot
+            self.frame_addrs.append(frame_addr)
+
+        return slot
+
+    def used_frames(self):
+        '''Return frame addresses, set masks and clear masks of all allocated frames'''
+        used = len(self.frame_addrs)
+        return (list(self.frame_addrs), self.frame_set_mask[:used],
+                self.frame_clear_mask[:used])
+
+    def merge_frames(self, frame_addrs, set_mask, clear_mask):
+        """ Merge frames assembled by another assembler (see used_frames).
+
+        Raises FasmInconsistentBits if any bit is set on one side and cleared
+        on the other.
+        """
+        slots = np.array([self.frame_slot(addr) for addr in frame_addrs],
+                         dtype=np.int64)
+
+        conflicts = (self.frame_set_mask[slots] & clear_mask) | (
+            self.frame_clear_mask[slots] & set_mask)
+        if conflicts.any():
+            idx, word_addr = np.argwhere(conflicts)[0]
+            raise FasmInconsistentBits(
+                'Frame 0x{:08X} word {} bits 0x{:04X} are both set and cleared'
+                .format(frame_addrs[idx], word_addr,
+                        conflicts[idx, word_addr]))
+
+        self.frame_set_mask[slots] |= set_mask
+        self.frame_clear_mask[slots] |= clear_mask
+        self.frame_words[slots] = (
+            self.frame_words[slots] & ~clear_mask) | set_mask
+
     def set_feature_callback(self, feature_callback):
         self.feature_callback = feature_callback
 
     def get_frames(self, sparse=False):
+        """ Return map of frame address to frame words.
+
+        Frame words are uint16 array views into frame_words, not copies.
+        """
         if not sparse:
-            frames = self.frames_init()
+            self.frames_init()
+            addrs = self.frame_addrs
         else:
             # Even in sparse mode, zero all frames for any tile that is
             # setting a bit.  This handles the case where the tile has
             # multiple frames, but the FASM only specifies some of the frames.
-            frames = {}
             for frame in self.frames_in_use:
-                init_frame_at_address(frames, frame)
-
-        for (frame_addr, word_addr, bit_index), is_set in self.frames.items():
-            init_frame_at_address(frames, frame_addr)
-
-            if is_set:
-                frames[frame_addr][word_addr] |= 1 << bit_index
-
-        return frames
+                self.frame_slot(frame)
+
+            used = len(self.frame_addrs)
+            touched = np.any(
+                self.frame_set_mask[:used] | self.frame_clear_mask[:used],
+                axis=1)
+            addrs = [
+                addr for addr, is_touched in zip(self.frame_addrs, touched)
+                if is_touched or addr in self.frames_in_use
+            ]
+
+        return {
+            addr: self.frame_words[self.frame_slots[addr]]
+            for addr in addrs
+        }
 
     def frames_init(self):
-        '''Set all frames to 0'''
-        frames = {}
-
+        '''Allocate slots for all frames in the grid'''
         for bits_info in self.grid.iter_all_frames():
             for coli in range(bits_info.bits.frames):
-                init_frame_at_address(frames,
-                                      bits_info.bits.base_address + coli)
+                self.frame_slot(bits_info.bits.base_address + coli)
 
-        return frames
+    def bit_line_description(self, key):
+        '''Describe the FASM line that set or cleared bit key'''
+        if key in self.frames_line:
+            return 'FASM line "{}"'.format(self.frames_line[key])
+        else:
+            return 'an earlier FASM line'
 
     def frame_set(self, frame_addr, word_addr, bit_index, line):
         '''Set given bit in given frame address and word'''
         assert bit_index is not None
 
-        key = (frame_addr, word_addr, bit_index)
-        if key in self.frames:
-            if self.frames[key] != 1:
-                raise FasmInconsistentBits(
-                    'FASM line "{}" wanted to set bit {} but was cleared by FASM line "{}"'
-                    .format(
-                        line,
-                        key,
-                        self.frames_line[key],
-                    ))
+        slot = self.frame_slot(frame_addr)
+        mask = 1 << bit_index
+        if self.frame_clear_mask[slot, word_addr] & mask:
+            key = (frame_addr, word_addr, bit_index)
+            raise FasmInconsistentBits(
+                'FASM line "{}" wanted to set bit {} but was cleared by {}'.
+                format(line, key, self.bit_line_description(key)))
+
+        if self.frame_set_mask[slot, word_addr] & mask:
             return
 
-        self.frames[key] = 1
-        self.frames_line[key] = line
+        self.frame_set_mask[slot, word_addr] |= mask
+        self.frame_words[slot, word_addr] |= mask
+        if self.track_lines:
+            self.frames_line[(frame_addr, word_addr, bit_index)] = line
 
     def frame_clear(self, frame_addr, word_addr, bit_index, line):
         '''Set given bit in given frame address and word'''
         assert bit_index is not None
 
-        key = (frame_addr, word_addr, bit_index)
-        if key in self.frames:
-            if self.frames[key] != 0:
-                raise FasmInconsistentBits(
-                    'FASM line "{}" wanted to clear bit {} but was set by FASM line "{}"'
-                    .format(
-                        line,
-                        key,
-                        self.frames_line[key],
-                    ))
+        slot = self.frame_slot(frame_addr)
+        mask = 1 << bit_index
+        if self.frame_set_mask[slot, word_addr] & mask:
+            key = (frame_addr, word_addr, bit_index)
+            raise FasmInconsistentBits(
+                'FASM line "{}" wanted to clear bit {} but was set by {}'.
+                format(line, key, self.bit_line_description(key)))
+
+        if self.frame_clear_mask[slot, word_addr] & mask:
             return
 
-        self.frames[key] = 0
-        self.frames_line[key] = line
+        self.frame_clear_mask[slot, word_addr] |= mask
+        self.frame_words[slot, word_addr] &= 0xFFFF ^ mask
+        if self.track_lines:
+            self.frames_line[(frame_addr, word_addr, bit_index)] = line
 
     def enable_feature(self, tile, feature, address, line):
         gridinfo = self.grid.gridinfo_at_tilename(tile)
-
-        def update_segbit(bit):
-            '''Set or clear a single bit in a segment at the given word column and word bit position'''
-
-            frame_addr = bit.word_column
-            word_addr = bit.word_bit // bitstream.WORD_SIZE_BITS
-            bit_index = bit.word_bit % bitstream.WORD_SIZE_BITS
-            if bit.isset:
-                self.frame_set(frame_addr, word_addr, bit_index, line)
-            else:
-                self.frame_clear(frame_addr, word_addr, bit_index, line)
-
-        segbits = self.grid.get_tile_segbits_at_tilename(tile)
+        segbits = self.segbits_cache.get(gridinfo.tile_type)
 
         self.seen_tile.add(tile)
 
-        db_k = '%s.%s' % (gridinfo.tile_type, feature)
-
         any_bits = set()
 
         try:
-            for block_type, bit in segbits.feature_to_bits(
-                    gridinfo.bits, db_k, address):
+            feature_bits = segbits.feature_bits(feature, address)
+            for (block_type, frame_offset, word_offset, bit_index,
+                 isset) in feature_bits:
+                bits = gridinfo.bits[block_type]
                 any_bits.add(block_type)
-                update_segbit(bit)
+
+                frame_addr = bits.base_address + frame_offset
+                word_addr = bits.offset + word_offset
+                if isset:
+                    self.frame_set(frame_addr, word_addr, bit_index, line)
+                else:
+                    self.frame_clear(frame_addr, word_addr, bit_index, line)
         except KeyError:
             raise FasmLookupError(
-                "Segment DB %s, key %s not found from line '%s'" %
-                (gridinfo.tile_type, db_k, line))
+                "Segment DB %s, key %s.%s not found from line '%s'" %
+                (gridinfo.tile_type, gridinfo.tile_type, feature, line))
 
         for block_type in any_bits:
             # Mark all frames used by this tile as in use.
             bits = gridinfo.bits[block_type]
-            for frame in range(bits.base_address,
-                               bits.base_address + bits.frames):
-                self.frames_in_use.add(frame)
+            self.frames_in_use.update(
+                range(bits.base_address, bits.base_address + bits.frames))
+
+    def tile_frame_slots(self, tile, bits):
+        '''Return array of the frame slots of a tile block type'''
+        key = (tile, bits.base_address)
+        slots = self.tile_slots.get(key)
+        if slots is None:
+            slots = np.array([
+                self.frame_slot(frame)
+                for frame in range(bits.base_address, bits.base_address +
+                                   bits.frames)
+            ],
+                             dtype=np.int64)
+            self.tile_slots[key] = slots
+
+        return slots
+
+    def enable_feature_addresses(self, tile, feature, addresses, line,
+                                 missing_features):
+        """ Enable a feature at many addresses, like enable_feature.
+
+        The bits of all addresses are resolved and applied as arrays.  If
+        they are inconsistent, or the tile lacks a block type of the
+        feature, falls back to enable_feature per address to report the
+        error exactly as it would.
+        """
+        if len(addresses) == 0:
+            return
+
+        gridinfo = self.grid.gridinfo_at_tilename(tile)
+        segbits = self.segbits_cache.get(gridinfo.tile_type)
+
+        def enable_per_address():
+            for address in addresses.tolist():
+                try:
+                    self.enable_feature(tile, feature, address, line)
+                except FasmLookupError as e:
+                    missing_features.append(str(e))
+
+        try:
+            missing, bit_idx = segbits.address_bits(feature, addresses)
+        except KeyError:
+            enable_per_address()
+            return
+
+        block_type_idx = segbits.block_types[bit_idx]
+        frame_offsets = segbits.frame_offsets[bit_idx].astype(np.int64)
+        word_addrs = segbits.word_offsets[bit_idx].astype(np.int64)
+        slots = np.zeros(len(bit_idx), dtype=np.int64)
+        frame_addrs = np.zeros(len(bit_idx), dtype=np.int64)
+
+        block_types = []
+        for idx in set(block_type_idx.tolist()):
+            block_type = segbits.block_type_enums[idx]
+            if block_type not in gridinfo.bits:
+                enable_per_address()
+                return
+
+            bits = gridinfo.bits[block_type]
+            block_types.append(block_type)
+            sel = block_type_idx == idx
+            slots[sel] = self.tile_frame_slots(tile, bits)[frame_offsets[sel]]
+            frame_addrs[sel] = bits.base_address + frame_offsets[sel]
+            word_addrs[sel] += bits.offset
+
+        bit_indices = segbits.bit_indices[bit_idx]
+        masks = segbits.masks[bit_idx]
+        isset = segbits.isset[bit_idx]
+
+        set_before = (self.frame_set_mask[slots, word_addrs] & masks) != 0
+        clear_before = (self.frame_clear_mask[slots, word_addrs] & masks) != 0
+        if isset.all():
+            inconsistent = clear_before.any()
+        else:
+            bit_keys = (slots * bitstream.FRAME_WORD_COUNT +
+                        word_addrs) * bitstream.WORD_SIZE_BITS + bit_indices
+            inconsistent = (
+                np.any(isset & clear_before) or np.any(~isset & set_before)
+                or len(np.intersect1d(bit_keys[isset], bit_keys[~isset])) > 0)
+        if inconsistent:
+            enable_per_address()
+            return
+
+        self.seen_tile.add(tile)
+        missing_features.extend(
+            "Segment DB %s, key %s.%s not found from line '%s'" %
+            (gridinfo.tile_type, gridinfo.tile_type, feature, line)
+            for _ in range(len(missing)))
+
+        set_slots, set_words = slots[isset], word_addrs[isset]
+        np.bitwise_or.at(self.frame_set_mask, (set_slots, set_words),
+                         masks[isset])
+        np.bitwise_or.at(self.frame_words, (set_slots, set_words),
+                         masks[isset])
+
+        if not isset.all():
+            clear_slots, clear_words = slots[~isset], word_addrs[~isset]
+            np.bitwise_or.at(self.frame_clear_mask, (clear_slots, clear_words),
+                             masks[~isset])
+            np.bitwise_and.at(self.frame_words, (clear_slots, clear_words),
+                              0xFFFF ^ masks[~isset])
+
+        if self.track_lines:
+            new_bits = np.where(isset, ~set_before, ~clear_before)
+            self.frames_line.update(
+                zip(
+                    zip(frame_addrs[new_bits].tolist(),
+                        word_addrs[new_bits].tolist(),
+                        bit_indices[new_bits].tolist()),
+                    itertools.repeat(line)))
+
+        for block_type in block_types:
+            # Mark all frames used by this tile as in use.
+            bits = gridinfo.bits[block_type]
+            self.frames_in_use.update(
+                range(bits.base_address, bits.base_address + bits.frames))
 
     def add_fasm_line(self, line, missing_features):
         if not line.set_feature:
@@ -172,6 +376,22 @@ class FasmAssembler(object):
         tile = parts[0]
         feature = '.'.join(parts[1:])
 
+        set_feature = line.set_feature
+        if set_feature.end is not None and set_feature.value != 0:
+            # Multi-bit feature, enable the addresses of its set bits at
+            # once, as canonical_features would one by one.
+            width = set_feature.end - set_feature.start + 1
+            value_bytes = set_feature.value.to_bytes(
+                (max(width, set_feature.value.bit_length()) + 7) // 8,
+                'little')
+            value_bits = np.unpackbits(
+                np.frombuffer(value_bytes, dtype=np.uint8),
+                bitorder='little')[:width]
+            self.enable_feature_addresses(
+                tile, feature, set_feature.start + np.flatnonzero(value_bits),
+                line_str, missing_features)
+            return
+
         # canonical_features flattens multibit feature enables to only
         # single bit features, which is what enable_feature expects.
         #
@@ -207,3 +427,24 @@ class FasmAssembler(object):
                 for frame in range(bits.base_address,
                                    bits.base_address + bits.frames):
                     self.frames_in_use.add(frame)
+
+    def load_frames(self, frames):
+        '''Initialize frame words from previously assembled frames'''
+        for addr, words in frames.items():
+            self.frame_words[self.frame_slot(addr)] = words
+
+    def clear_tile(self, tile):
+        """ Zero all words owned by a tile, in all of its frames.
+
+        Used before re-enabling the features of a tile on top of frames
+        loaded with load_frames.
+        """
+        gridinfo = self.grid.gridinfo_at_tilename(tile)
+
+        for block_type in gridinfo.bits:
+            bits = gridinfo.bits[block_type]
+            for frame in range(bits.base_address,
+                               bits.base_address + bits.frames):
+                slot = self.frame_slot(frame)
+                self.frame_words[slot, bits.offset:bits.offset +
+                                 bits.words] = 0
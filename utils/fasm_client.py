@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright 2020-2022 F4PGA Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+'''
+Client of fasm_server.py.
+
+Sends assemble (fasm2frames), disassemble (bit2fasm from a .bits or binary
+frame file) and stats requests to a running server.
+'''
+
+import argparse
+import json
+import os
+import socket
+import sys
+
+from utils import util
+
+
+def request(socket_path, req):
+    ''' Send one request to the server and return its response. '''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socket_path)
+        s.sendall(json.dumps(req).encode() + b'\n')
+
+        with s.makefile('rb') as f:
+            return json.loads(f.readline().decode())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--socket', required=True, help='Unix socket of fasm_server.py.')
+    subparsers = parser.add_subparsers(dest='op')
+    subparsers.required = True
+
+    assemble = subparsers.add_parser(
+        'assemble', help='Convert FASM to frames, like fasm2frames.py')
+    util.db_root_arg(assemble)
+    util.part_arg(assemble)
+    assemble.add_argument(
+        '--sparse', action='store_true', help="Don't zero fill all frames")
+    assemble.add_argument(
+        '--roi',
+        help="ROI design.json file defining which tiles are within the ROI.")
+    assemble.add_argument(
+        '--dump_bits',
+        action='store_true',
+        help="Output in bits format (bit_%%08x_%%03d_%%02d)")
+    assemble.add_argument(
+        '--binary',
+        action='store_true',
+        help="Output in binary frame file format (see frame_file.py)")
+    assemble.add_argument(
+        '--fast',
+        action='store_true',
+        help="Don't record the FASM line of every bit, see fasm2frames.py")
+    assemble.add_argument('fn_in', help='Input FPGA assembly (.fasm) file')
+    assemble.add_argument('fn_out', help='Output FPGA frame (.frm) file')
+
+    disassemble = subparsers.add_parser(
+        'disassemble', help='Convert bits to FASM, like bit2fasm.py')
+    util.db_root_arg(disassemble)
+    util.part_arg(disassemble)
+    disassemble.add_argument(
+        '--verbose',
+        help='Print lines for unknown tiles and bits',
+        action='store_true')
+    disassemble.add_argument(
+        '--canonical', help='Output canonical bitstream.', action='store_true')
+    disassemble.add_argument(
+        '--suppress_zero_features',
+        help='Supress zero features.',
+        action='store_true')
+    disassemble.add_argument(
+        'bits_file', help='Input .bits file or binary frame file')
+    disassemble.add_argument(
+        'fn_out', nargs='?', help='Output FASM file, default is stdout')
+
+    subparsers.add_parser('stats', help='Print server latency and cache stats')
+
+    args = parser.parse_args()
+
+    if args.op == 'assemble':
+        req = {
+            'op': 'assemble',
+            'db_root': os.path.abspath(args.db_root),
+            'part': args.part,
+            'fasm': os.path.abspath(args.fn_in),
+            'output': os.path.abspath(args.fn_out),
+            'sparse': args.sparse,
+            'roi': os.path.abspath(args.roi) if args.roi else None,
+            'dump_bits': args.dump_bits,
+            'binary': args.binary,
+            'fast': args.fast,
+        }
+    elif args.op == 'disassemble':
+        req = {
+            'op': 'disassemble',
+            'db_root': os.path.abspath(args.db_root),
+            'part': args.part,
+            'bits': os.path.abspath(args.bits_file),
+            'output': os.path.abspath(args.fn_out) if args.fn_out else None,
+            'verbose': args.verbose,
+            'canonical': args.canonical,
+            'suppress_zero_features': args.suppress_zero_features,
+        }
+    else:
+        req = {'op': 'stats'}
+
+    response = request(args.socket, req)
+    if not response['ok']:
+        print(response['error'], file=sys.stderr)
+        sys.exit(1)
+
+    if args.op == 'stats':
+        print(json.dumps(response, indent=2, sort_keys=True))
+    elif 'fasm' in response:
+        print(response['fasm'], end='')
+
+
+if __name__ == '__main__':
+    main()
@@ -20,6 +20,7 @@
 import re
 import fasm
 import bitstream
+from segbits_cache import SegbitsCache
 
 
 def mk_fasm(tile_name, feature):
@@ -50,12 +51,58 @@ def mk_fasm(tile_name, feature):
 class FasmDisassembler(object):
     """ Given a Project X-ray data, outputs FasmLine tuples for bits set. """
 
-    def __init__(self, db):
+    def __init__(self, db, segbits_cache=None):
         self.db = db
         self.grid = self.db.grid()
+        self.segbits_cache = segbits_cache
+        if self.segbits_cache is None:
+            self.segbits_cache = SegbitsCache(db)
         self.segment_map = self.grid.get_segment_map()
         self.decode_warnings = set()
 
+        # Tiles of every (tile type, block type), and the frames of the
+        # bitstream being disassembled with the matches found in them.
+        self.tile_instances = None
+        self.frames = None
+        self.tile_matches = {}
+
+        # Zero feature table of every tile seen by is_zero_feature.
+        self.tile_zero_features = {}
+
+    def tile_type_instances(self, tile_type, block_type):
+        """ Return list of (tile, bits) of tile_type with block_type bits. """
+        if self.tile_instances is None:
+            self.tile_instances = {}
+            for tile in self.grid.tiles():
+                gridinfo = self.grid.gridinfo_at_tilename(tile)
+                for tile_block_type, bits in gridinfo.bits.items():
+                    self.tile_instances.setdefault(
+                        (gridinfo.tile_type, tile_block_type), []).append(
+                            (tile, bits))
+
+        return self.tile_instances.get((tile_type, block_type), [])
+
+    def match_tile(self, tile_name, tile_type, block_type, tile_segbits):
+        """ Return indices into the match table of the matches of a tile.
+
+        All tiles of tile_type are matched at once on first use, see
+        CompiledSegbits.match_frames.
+        """
+        key = (tile_type, block_type)
+        matches = self.tile_matches.get(key)
+        if matches is None:
+            instances = self.tile_type_instances(tile_type, block_type)
+            tile_matches = tile_segbits.match_frames(
+                block_type, [bits.base_address for _, bits in instances],
+                [bits.offset for _, bits in instances], *self.frames)
+            matches = {
+                tile: tile_match
+                for (tile, _), tile_match in zip(instances, tile_matches)
+            }
+            self.tile_matches[key] = matches
+
+        return matches[tile_name]
+
     def find_features_in_tile(self,
                               tile_name,
                               block_type,
@@ -66,7 +113,7 @@ class FasmDisassembler(object):
         gridinfo = self.grid.gridinfo_at_tilename(tile_name)
 
         try:
-            tile_segbits = self.grid.get_tile_segbits_at_tilename(tile_name)
+            tile_segbits = self.segbits_cache.get(gridinfo.tile_type)
         except KeyError as e:
             if not verbose:
                 return
@@ -93,18 +140,72 @@ class FasmDisassembler(object):
             self.decode_warnings.add(gridinfo.tile_type)
             return
 
-        for ones_matched, feature in tile_segbits.match_bitdata(
-                block_type, bits, bitdata):
-            for frame, bit in ones_matched:
-                if frame not in solved_bitdata:
-                    solved_bitdata[frame] = set()
-                solved_bitdata[frame].add(bit)
+        if self.frames is None or (
+                block_type.name not in tile_segbits.block_type_names):
+            for ones_matched, feature in tile_segbits.match_bitdata(
+                    block_type, bits, bitdata):
+                for frame, bit in ones_matched:
+                    if frame not in solved_bitdata:
+                        solved_bitdata[frame] = set()
+                    solved_bitdata[frame].add(bit)
+
+                yield mk_fasm(tile_name=tile_name, feature=feature)
+            return
+
+        table = tile_segbits.match_table(
+            tile_segbits.block_type_names.index(block_type.name))
+        bit_offset = bits.offset * bitstream.WORD_SIZE_BITS
+        for idx in self.match_tile(tile_name, gridinfo.tile_type, block_type,
+                                   tile_segbits):
+            feature, feature_bits = table[idx]
+            for frame_offset, word_bit, isset in feature_bits:
+                if isset:
+                    frame = bits.base_address + frame_offset
+                    if frame not in solved_bitdata:
+                        solved_bitdata[frame] = set()
+                    solved_bitdata[frame].add(bit_offset + word_bit)
 
             yield mk_fasm(tile_name=tile_name, feature=feature)
 
+    def find_features_by_tile(self, bitdata, sort_key=None):
+        """ Yield (tile, FasmLines) of the tiles with bits in a BitData.
+
+        Tiles are in tile name order, or sorted by sort_key, and only the
+        features of one tile are held at a time.  Unlike
+        find_features_in_bitstream, bits not converted aren't reported.
+        """
+        self.frames = bitdata.frame_array()
+        self.tile_matches = {}
+
+        for tile in sorted(self.grid.tiles(), key=sort_key):
+            gridinfo = self.grid.gridinfo_at_tilename(tile)
+
+            # Features in the order found, without duplicates.
+            lines = {}
+            for block_type, bits in gridinfo.bits.items():
+                word_start = bits.offset
+                word_end = word_start + bits.words
+                if not any(
+                        len(
+                            bitdata.bits_in_frame(frame, word_start, word_end))
+                        for frame in range(bits.base_address,
+                                           bits.base_address + bits.frames)):
+                    continue
+
+                lines.update((line, None)
+                             for line in self.find_features_in_tile(
+                                 tile, block_type, bits, {}, bitdata))
+
+            if lines:
+                yield tile, list(lines)
+
     def find_features_in_bitstream(self, bitdata, verbose=False):
+        """ Yield FasmLines of the features set in a bitstream.BitData. """
+        self.frames = bitdata.frame_array()
+        self.tile_matches = {}
+
         solved_bitdata = {}
-        frames = set(bitdata.keys())
+        frames = set(bitdata.frame_addrs.tolist())
         tiles_checked = set()
 
         emitted_features = set()
@@ -112,10 +213,6 @@ class FasmDisassembler(object):
         while len(frames) > 0:
             frame = frames.pop()
 
-            # Skip frames that were emptied in a previous iteration.
-            if not bitdata[frame]:
-                continue
-
             # Iterate over all tiles that use this frame.
             for bits_info in self.segment_map.segment_info_for_frame(frame):
                 # Don't examine a tile twice
@@ -123,13 +220,9 @@ class FasmDisassembler(object):
                     continue
 
                 # Check if this frame has any data for the relevant tile.
-                any_column = False
-                for word_idx in range(bits_info.bits.words):
-                    if word_idx + bits_info.bits.offset in bitdata[frame][0]:
-                        any_column = True
-                        break
-
-                if not any_column:
+                word_start = bits_info.bits.offset
+                word_end = word_start + bits_info.bits.words
+                if not len(bitdata.bits_in_frame(frame, word_start, word_end)):
                     continue
 
                 tiles_checked.add((bits_info.tile, bits_info.block_type))
@@ -145,7 +238,7 @@ class FasmDisassembler(object):
                         emitted_features.add(fasm_line)
                         yield fasm_line
 
-            remaining_bits = bitdata[frame][1]
+            remaining_bits = set(bitdata.bits_in_frame(frame).tolist())
             if frame in solved_bitdata:
                 remaining_bits -= solved_bitdata[frame]
 
@@ -185,18 +278,20 @@ class FasmDisassembler(object):
                         comment=None,
                     )
 
+    def zero_feature_table(self, tile_type):
+        """ Return map of feature to whether it sets no bits, for tile_type.
+
+        Features are without the tile prefix, see
+        CompiledSegbits.is_zero_feature.
+        """
+        return self.segbits_cache.get(tile_type).zero_features
+
     def is_zero_feature(self, feature):
-        parts = feature.split('.')
-        tile = parts[0]
-        gridinfo = self.grid.gridinfo_at_tilename(tile)
-        feature = '.'.join(parts[1:])
-
-        db_k = '%s.%s' % (gridinfo.tile_type, feature)
-        segbits = self.grid.get_tile_segbits_at_tilename(tile)
-        any_bits = False
-        for block_type, bit in segbits.feature_to_bits(gridinfo.bits, db_k):
-            if bit.isset:
-                any_bits = True
-                break
-
-        return not any_bits
+        tile, _, feature = feature.partition('.')
+        table = self.tile_zero_features.get(tile)
+        if table is None:
+            table = self.zero_feature_table(
+                self.grid.gridinfo_at_tilename(tile).tile_type)
+            self.tile_zero_features[tile] = table
+
+        return table[feature]
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright 2020-2022 F4PGA Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+'''
+Long-lived FASM assembler/disassembler server.
+
+Keeps the Database and compiled segbits of every part it has served
+resident, so batch flows load each database once instead of once per
+fasm2frames/bit2fasm invocation.  Requests are served concurrently over a
+Unix socket, see fasm_client.py.
+
+The protocol is newline delimited JSON, with one response per request:
+
+  {"op": "assemble", "db_root": ..., "part": ..., "fasm": "in.fasm",
+   "output": "out.frm", "sparse": false, "dump_bits": false,
+   "binary": false, "fast": false}
+  {"op": "disassemble", "db_root": ..., "part": ..., "bits": "in.bits",
+   "output": null, "verbose": false, "canonical": false,
+   "suppress_zero_features": false}
+  {"op": "stats"}
+
+File names are resolved by the server, so clients send absolute paths.
+Responses are {"ok": true, "latency": seconds, ...} or
+{"ok": false, "error": message}.  A disassemble request without "output"
+returns the FASM in "fasm".
+'''
+
+import argparse
+import concurrent.futures
+import contextlib
+import fasm.parser
+import io
+import json
+import os
+import signal
+import socketserver
+import sys
+import threading
+import time
+import traceback
+
+from prjuray.db import Database
+from utils import bit2fasm, fasm2frames
+from utils.segbits_cache import SegbitsCache
+
+
+class PartContext(object):
+    """ Database and compiled segbits of one part. """
+
+    def __init__(self, db_root, part):
+        self.db = Database(db_root, part)
+        self.segbits_cache = SegbitsCache(self.db)
+
+        # Load the grid now rather than in the first request.
+        self.db.grid()
+
+
+class FasmServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, verbose=False):
+        self.verbose = verbose
+        self.contexts = {}
+        self.contexts_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.context_hits = 0
+        self.context_misses = 0
+        self.op_stats = {}
+
+        # The pure Python textX FASM parser is not thread safe, so assemble
+        # requests run one at a time without the antlr parser.
+        if fasm.parser.implementation == 'textx':
+            self.parse_lock = threading.Lock()
+        else:
+            self.parse_lock = contextlib.nullcontext()
+
+        super().__init__(socket_path, FasmRequestHandler)
+
+    def get_context(self, db_root, part):
+        """ Return (PartContext, whether it was loaded before) of a part.
+
+        contexts maps each part to a future of its PartContext.  Parts are
+        loaded without holding contexts_lock, so a cold load only blocks
+        the requests for the same part.
+        """
+        key = (os.path.abspath(db_root), part)
+        with self.contexts_lock:
+            future = self.contexts.get(key)
+            hit = future is not None
+            if hit:
+                self.context_hits += 1
+            else:
+                self.context_misses += 1
+                future = concurrent.futures.Future()
+                self.contexts[key] = future
+
+        if not hit:
+            try:
+                future.set_result(PartContext(*key))
+            except BaseException as e:
+                # Let the next request for the part try again.
+                with self.contexts_lock:
+                    del self.contexts[key]
+                future.set_exception(e)
+                raise
+
+        return future.result(), hit
+
+    def record(self, op, latency):
+        with self.stats_lock:
+            stats = self.op_stats.setdefault(op, {
+                'count': 0,
+                'total_latency': 0.0,
+                'max_latency': 0.0,
+            })
+            stats['count'] += 1
+            stats['total_latency'] += latency
+            stats['max_latency'] = max(stats['max_latency'], latency)
+
+    def stats(self):
+        with self.stats_lock:
+            ops = {
+                op: dict(
+                    stats,
+                    mean_latency=stats['total_latency'] / stats['count'])
+                for op, stats in self.op_stats.items()
+            }
+
+        with self.contexts_lock:
+            contexts = list(self.contexts.items())
+
+        # Parts still loading, or that failed to load, are not reported.
+        parts = {
+            '{}:{}'.format(db_root, part): {
+                'tile_types': len(future.result().segbits_cache.compiled),
+                'segbits_disk_hits': future.result().segbits_cache.hits,
+                'segbits_disk_misses': future.result().segbits_cache.misses,
+            }
+            for (db_root, part), future in contexts
+            if future.done() and future.exception() is None
+        }
+
+        return {
+            'requests': ops,
+            'database_hits': self.context_hits,
+            'database_misses': self.context_misses,
+            'parts': parts,
+        }
+
+    def assemble(self, request):
+        context, hit = self.get_context(request['db_root'], request['part'])
+
+        binary = request.get('binary', False)
+        with self.parse_lock, open(request['output'],
+                                   'wb' if binary else 'w') as f_out:
+            fasm2frames.run(
+                db_root=request['db_root'],
+                part=request['part'],
+                filename_in=request['fasm'],
+                f_out=f_out,
+                sparse=request.get('sparse', False),
+                roi=request.get('roi'),
+                dump_bits=request.get('dump_bits', False),
+                binary=binary,
+                fast=request.get('fast', False),
+                db=context.db,
+                segbits_cache=context.segbits_cache)
+
+        return {'database_hit': hit}
+
+    def disassemble(self, request):
+        context, hit = self.get_context(request['db_root'], request['part'])
+
+        f_out = io.StringIO()
+        bit2fasm.bits_to_fasm(
+            db_root=request['db_root'],
+            part=request['part'],
+            bits_file=request['bits'],
+            verbose=request.get('verbose', False),
+            canonical=request.get('canonical', False),
+            suppress_zero_features=request.get('suppress_zero_features',
+                                               False),
+            f_out=f_out,
+            db=context.db,
+            segbits_cache=context.segbits_cache)
+
+        response = {'database_hit': hit}
+        if request.get('output'):
+            with open(request['output'], 'w') as f:
+                f.write(f_out.getvalue())
+        else:
+            response['fasm'] = f_out.getvalue()
+
+        return response
+
+    def handle_request_json(self, request):
+        op = request.get('op')
+        start = time.perf_counter()
+        try:
+            if op == 'assemble':
+                response = self.assemble(request)
+            elif op == 'disassemble':
+                response = self.disassemble(request)
+            elif op == 'stats':
+                response = self.stats()
+            else:
+                raise ValueError('Unknown op {}'.format(op))
+        except Exception as e:
+            if self.verbose:
+                traceback.print_exc()
+            return {'ok': False, 'error': '{}: {}'.format(type(e).__name__, e)}
+
+        latency = time.perf_counter() - start
+        if op != 'stats':
+            self.record(op, latency)
+            if self.verbose:
+                print(
+                    '{} {} {:.3f}s database {}'.format(
+                        op, request['part'], latency,
+                        'hit' if response['database_hit'] else 'miss'),
+                    file=sys.stderr)
+
+        response['ok'] = True
+        response['latency'] = latency
+        return response
+
+
+class FasmRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+
+            try:
+                request = json.loads(line.decode())
+            except ValueError as e:
+                response = {
+                    'ok': False,
+                    'error': 'Invalid request: {}'.format(e)
+                }
+            else:
+                response = self.server.handle_request_json(request)
+
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            self.wfile.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--socket', required=True, help='Unix socket path to listen on.')
+    parser.add_argument('--db-root', help='Database root of --preload parts.')
+    parser.add_argument(
+        '--preload',
+        action='append',
+        default=[],
+        help='Part to load at startup, may be repeated.')
+    parser.add_argument(
+        '--verbose',
+        action='store_true',
+        help='Print per-request latency to stderr.')
+
+    args = parser.parse_args()
+    if args.preload and args.db_root is None:
+        parser.error('--preload requires --db-root')
+
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+
+    # Exit through the finally below on SIGTERM too, removing the socket.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    with FasmServer(args.socket, verbose=args.verbose) as server:
+        for part in args.preload:
+            server.get_context(args.db_root, part)
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(args.socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -21,23 +21,20 @@ import argparse
 import re
 
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--input_rdb', required=True)
-    parser.add_argument('--output_rdb', required=True)
-    parser.add_argument('--filters', required=True)
+def filter_features(input_rdb, output_rdb, filters):
+    """ Write the lines of input_rdb not matching any filter to output_rdb.
 
-    args = parser.parse_args()
-
-    filters = []
-    with open(args.filters) as f:
+    filters is a file of regular expressions, one per line.
+    """
+    filter_res = []
+    with open(filters) as f:
         for l in f:
-            filters.append(re.compile(l.strip()))
+            filter_res.append(re.compile(l.strip()))
 
-    with open(args.input_rdb) as f_in, open(args.output_rdb, 'w') as f_out:
+    with open(input_rdb) as f_in, open(output_rdb, 'w') as f_out:
         for l in f_in:
             filter_out = False
-            for filt in filters:
+            for filt in filter_res:
                 if filt.fullmatch(l.strip()) is not None:
                     filter_out = True
                     break
@@ -48,5 +45,16 @@ def main():
             f_out.write(l)
 
 
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_rdb', required=True)
+    parser.add_argument('--output_rdb', required=True)
+    parser.add_argument('--filters', required=True)
+
+    args = parser.parse_args()
+
+    filter_features(args.input_rdb, args.output_rdb, args.filters)
+
+
 if __name__ == "__main__":
     main()
@@ -58,18 +58,16 @@ def parse_solution_widths(solution_widths):
     return default_width, filters
 
 
-def main():
-    parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument('--input_rdb', required=True)
-    parser.add_argument('--solution_widths', required=True)
-    parser.add_argument('--output_rdb', required=True)
-    parser.add_argument('--filtered_features', required=True)
+def filter_solution_width(input_rdb, solution_widths, output_rdb,
+                          filtered_features):
+    """ Write the solutions of input_rdb within the solution widths.
 
-    args = parser.parse_args()
-    default_width, filters = parse_solution_widths(args.solution_widths)
+    Solutions with more bits than allowed go to filtered_features instead.
+    """
+    default_width, filters = parse_solution_widths(solution_widths)
 
-    with open(args.input_rdb) as f, open(args.output_rdb, 'w') as f_out, open(
-            args.filtered_features, 'w') as f_filtered:
+    with open(input_rdb) as f, open(output_rdb, 'w') as f_out, open(
+            filtered_features, 'w') as f_filtered:
         for l in f:
             if '<' in l:
                 print(l.strip(), file=f_out)
@@ -95,5 +93,17 @@ def main():
                     print(l.strip(), file=f_out)
 
 
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--input_rdb', required=True)
+    parser.add_argument('--solution_widths', required=True)
+    parser.add_argument('--output_rdb', required=True)
+    parser.add_argument('--filtered_features', required=True)
+
+    args = parser.parse_args()
+    filter_solution_width(args.input_rdb, args.solution_widths,
+                          args.output_rdb, args.filtered_features)
+
+
 if __name__ == '__main__':
     main()
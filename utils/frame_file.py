@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright 2020-2022 F4PGA Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+'''
+Binary, memory-mappable frame file format.
+
+All values are little-endian:
+
+  offset   size           content
+  0        8              magic b'URAYFRM\\0'
+  8        4              format version
+  12       4              frame count (N)
+  16       4              16-bit words per frame (W)
+  20       4              reserved
+  24       64             part name, NUL padded
+  88       40             architecture name, NUL padded
+  128      4 * N          frame addresses (FAR), sorted ascending
+  align 8  2 * N * W      frame words, one row of W uint16 per frame address
+
+Words are in the same order as the FasmAssembler frames: 16-bit word 2 * i
+is the lower half of 32-bit frame word i.
+'''
+
+import struct
+
+import numpy as np
+
+MAGIC = b'URAYFRM\0'
+VERSION = 1
+
+HEADER = struct.Struct('<8sIII4x64s40s')
+
+
+def data_offset(frame_count):
+    ''' Return file offset of the frame words.
+
+    >>> data_offset(0)
+    128
+    >>> data_offset(3)
+    144
+    '''
+    offset = HEADER.size + 4 * frame_count
+    return (offset + 7) & ~7
+
+
+def is_frame_file(fn):
+    ''' Return True if fn is a binary frame file. '''
+    with open(fn, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def write_frames(f, frames, part='', arch='', words_per_frame=None):
+    """ Write frames to binary file object f.
+
+    frames is a map of frame address to 16-bit frame words, e.g. the output
+    of FasmAssembler.get_frames or a FrameFile.
+    """
+    addrs = np.array(sorted(frames.keys()), dtype='<u4')
+
+    if words_per_frame is None:
+        words_per_frame = len(frames[addrs[0]]) if len(addrs) else 0
+
+    words = np.zeros((len(addrs), words_per_frame), dtype='<u2')
+    for idx, addr in enumerate(addrs.tolist()):
+        words[idx] = frames[addr]
+
+    f.write(
+        HEADER.pack(MAGIC, VERSION, len(addrs), words_per_frame, part.encode(),
+                    arch.encode()))
+    f.write(addrs.tobytes())
+    f.write(b'\0' * (data_offset(len(addrs)) - HEADER.size - addrs.nbytes))
+    f.write(words.tobytes())
+
+
+class FrameFile(object):
+    """ Memory-mapped binary frame file.
+
+    Behaves like a read-only map of frame address to frame words, where the
+    frame words are uint16 array views into the file.  With mode='r+',
+    writes to the frame words go to the file.
+    """
+
+    def __init__(self, fn, mode='r'):
+        with open(fn, 'rb') as f:
+            header = f.read(HEADER.size)
+
+        if len(header) != HEADER.size:
+            raise ValueError('{} is too short for a frame file'.format(fn))
+
+        (magic, version, frame_count, words_per_frame, part,
+         arch) = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError('{} is not a frame file'.format(fn))
+        if version != VERSION:
+            raise ValueError('{} has unsupported frame file version {}'.format(
+                fn, version))
+
+        self.fn = fn
+        self.part = part.rstrip(b'\0').decode()
+        self.arch = arch.rstrip(b'\0').decode()
+        self.words_per_frame = words_per_frame
+
+        if frame_count == 0:
+            self.addrs = np.zeros((0, ), dtype='<u4')
+            self.words = np.zeros((0, words_per_frame), dtype='<u2')
+        else:
+            self.addrs = np.memmap(
+                fn,
+                dtype='<u4',
+                mode='r',
+                offset=HEADER.size,
+                shape=(frame_count, ))
+            self.words = np.memmap(
+                fn,
+                dtype='<u2',
+                mode=mode,
+                offset=data_offset(frame_count),
+                shape=(frame_count, words_per_frame))
+
+    def slot(self, addr):
+        ''' Return row of frame address in words, or None if not present. '''
+        idx = int(np.searchsorted(self.addrs, addr))
+        if idx < len(self.addrs) and self.addrs[idx] == addr:
+            return idx
+
+        return None
+
+    def __len__(self):
+        return len(self.addrs)
+
+    def __contains__(self, addr):
+        return self.slot(addr) is not None
+
+    def __getitem__(self, addr):
+        idx = self.slot(addr)
+        if idx is None:
+            raise KeyError(addr)
+
+        return self.words[idx]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return self.addrs.tolist()
+
+    def items(self):
+        for idx, addr in enumerate(self.addrs.tolist()):
+            yield addr, self.words[idx]
+
+    def flush(self):
+        if isinstance(self.words, np.memmap):
+            self.words.flush()
+
+
+def load_frames(fn):
+    ''' Return map of frame address to frame words from a binary frame file. '''
+    return dict(FrameFile(fn).items())
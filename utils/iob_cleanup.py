@@ -496,17 +496,15 @@ def process_site(iob_features, f_out, site, site_lines):
         iob_features.add_iostandard(iostd_obj)
 
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--rdb_in', required=True)
-    parser.add_argument('--rdb_out', required=True)
-    parser.add_argument('--iob_features', required=True)
-
-    args = parser.parse_args()
+def iob_cleanup(rdb_in, rdb_out, iob_features_file):
+    """ Write rdb_in to rdb_out with the IOB features cleaned up.
 
+    iob_features_file is a file of regular expressions matching the IOB
+    features, one per line.  A report is printed to stdout.
+    """
     feature_filters = []
 
-    with open(args.iob_features) as f:
+    with open(iob_features_file) as f:
         for l in f:
             feature_filters.append(re.compile(l.strip()))
 
@@ -518,7 +516,7 @@ def main():
 
     prefix = None
 
-    with open(args.rdb_in) as f, open(args.rdb_out, 'w') as f_out:
+    with open(rdb_in) as f, open(rdb_out, 'w') as f_out:
         for l in f:
             if '<const1>' in l or '<const0>' in l:
                 f_out.write(l)
@@ -590,5 +588,16 @@ def main():
         iob_features.output_all_standards(prefix, f_out)
 
 
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rdb_in', required=True)
+    parser.add_argument('--rdb_out', required=True)
+    parser.add_argument('--iob_features', required=True)
+
+    args = parser.parse_args()
+
+    iob_cleanup(args.rdb_in, args.rdb_out, args.iob_features)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,626 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright 2020-2022 F4PGA Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+'''
+Compiled segbits tables with an on-disk cache.
+
+The segbits (and ppips) of a tile type are flattened into per-feature bit
+arrays, relative to the tile:
+
+- block_types: index into block_type_names,
+- frame_offsets: frame offset from the tile base address,
+- word_offsets: word offset from the tile word offset,
+- bit_indices / masks: bit within the word,
+- isset: whether the bit is set or cleared by the feature.
+
+Bits of feature i are in the range [offsets[i], offsets[i + 1]), and all of
+them belong to block type feature_block_types[i].
+
+Compiled tables are stored as .npz files in URAY_SEGBITS_CACHE (default
+~/.cache/prjuray/segbits), keyed by a hash of the tile type DB files, so
+that repeated runs do not parse the text segbits files.  Setting
+URAY_SEGBITS_CACHE to an empty string disables the on-disk cache.
+
+Run this module to precompile every tile type of a database.
+'''
+
+import argparse
+import glob
+import hashlib
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+import bitstream
+from prjuray.db import Database
+from prjuray.grid_types import BlockType
+from utils import util
+
+# Bump when the compiled format changes to invalidate existing caches.
+CACHE_VERSION = 1
+
+
+def default_cache_dir():
+    cache_dir = os.getenv('URAY_SEGBITS_CACHE')
+    if cache_dir is None:
+        cache_dir = os.path.join(
+            os.path.expanduser('~'), '.cache', 'prjuray', 'segbits')
+
+    return cache_dir
+
+
+def segbits_files(db_root, tile_type):
+    ''' Return the DB files holding segbits and ppips of given tile type. '''
+    tile_type = tile_type.lower()
+    fns = glob.glob(os.path.join(db_root, 'segbits_{}.db'.format(tile_type)))
+    fns += glob.glob(
+        os.path.join(db_root, 'segbits_{}.*.db'.format(tile_type)))
+    fns += glob.glob(os.path.join(db_root, 'ppips_{}.db'.format(tile_type)))
+    return sorted(fns)
+
+
+def segbits_hash(fns):
+    ''' Return hash of given DB files names and content. '''
+    h = hashlib.sha256('v{}'.format(CACHE_VERSION).encode())
+    for fn in fns:
+        h.update(os.path.basename(fn).encode())
+        h.update(b'\0')
+        with open(fn, 'rb') as f:
+            h.update(f.read())
+        h.update(b'\0')
+
+    return h.hexdigest()
+
+
+def split_address(feature):
+    ''' Split address from feature name.
+
+    >>> split_address('SLICE.ALUT.INIT[12]')
+    ('SLICE.ALUT.INIT', 12)
+    >>> split_address('PIP.A.B')
+    ('PIP.A.B', None)
+    '''
+    sidx = feature.rfind('[')
+    eidx = feature.rfind(']')
+    if sidx == -1:
+        return feature, None
+
+    assert eidx != -1, feature
+    return feature[:sidx], int(feature[sidx + 1:eidx])
+
+
+def expand_ranges(starts, lengths):
+    """ Return the concatenation of ranges starts[i]:starts[i] + lengths[i].
+
+    >>> expand_ranges(np.array([5, 0, 2]), np.array([2, 0, 3])).tolist()
+    [5, 6, 2, 3, 4]
+    """
+    range_starts = np.cumsum(lengths) - lengths
+    return np.arange(lengths.sum()) + np.repeat(starts - range_starts, lengths)
+
+
+class CompiledSegbits(object):
+    """ Flattened segbits of a single tile type. """
+
+    def __init__(self, tile_type, features, feature_block_types, ppips,
+                 offsets, block_type_names, block_types, frame_offsets,
+                 word_offsets, bit_indices, isset):
+        self.tile_type = tile_type
+        self.features = list(features)
+        self.feature_block_types = feature_block_types
+        self.ppips = set(ppips)
+        self.offsets = offsets
+        self.block_type_names = list(block_type_names)
+        self.block_type_enums = [
+            BlockType[name] for name in self.block_type_names
+        ]
+        self.block_types = block_types
+        self.frame_offsets = frame_offsets
+        self.word_offsets = word_offsets
+        self.bit_indices = bit_indices
+        self.masks = np.left_shift(np.uint16(1), bit_indices)
+        self.isset = isset
+
+        # Same resolution order as TileSegbits.feature_to_bits: a plain
+        # feature wins at address 0, otherwise use the addressed feature.
+        # Plain features are indexed last so they replace F[0].
+        self.feature_index = {}
+        for idx, feature in enumerate(self.features):
+            base, address = split_address(feature)
+            if address is not None:
+                self.feature_index[base, address] = idx
+        for idx, feature in enumerate(self.features):
+            if split_address(feature)[1] is None:
+                self.feature_index[feature, 0] = idx
+
+        # Whether each feature at address 0 sets no bits, see
+        # is_zero_feature.
+        ones = np.concatenate(([0], np.cumsum(self.isset, dtype=np.int64)))
+        is_zero = (ones[self.offsets[1:]] == ones[self.offsets[:-1]]).tolist()
+        self.zero_features = {
+            feature: is_zero[idx]
+            for (feature, address), idx in self.feature_index.items()
+            if address == 0
+        }
+        self.zero_features.update((ppip, True) for ppip in self.ppips)
+
+        # Tables built on first use.  Compiled segbits are shared by the
+        # threads of fasm_server, so they are filled under lock.
+        self.lock = threading.Lock()
+        self.bits_cache = {}
+        self.match_tables = {}
+        self.address_tables = None
+
+    @staticmethod
+    def compile(tile_type, tile_segbits):
+        """ Compile a prjuray TileSegbits object. """
+        prefix = tile_type + '.'
+
+        features = []
+        feature_block_types = []
+        block_type_names = []
+        offsets = [0]
+        block_types = []
+        frame_offsets = []
+        word_offsets = []
+        bit_indices = []
+        isset = []
+
+        for block_type, segbits in tile_segbits.segbits.items():
+            if block_type.name not in block_type_names:
+                block_type_names.append(block_type.name)
+            block_type_idx = block_type_names.index(block_type.name)
+
+            for feature, bits in segbits.items():
+                # Features are always looked up with the tile type prefix.
+                if not feature.startswith(prefix):
+                    continue
+
+                features.append(feature[len(prefix):])
+                feature_block_types.append(block_type_idx)
+                for bit in bits:
+                    block_types.append(block_type_idx)
+                    frame_offsets.append(bit.word_column)
+                    word_offsets.append(
+                        bit.word_bit // bitstream.WORD_SIZE_BITS)
+                    bit_indices.append(bit.word_bit % bitstream.WORD_SIZE_BITS)
+                    isset.append(bit.isset)
+                offsets.append(len(block_types))
+
+        ppips = [
+            feature[len(prefix):] for feature in tile_segbits.ppips
+            if feature.startswith(prefix)
+        ]
+
+        return CompiledSegbits(
+            tile_type=tile_type,
+            features=features,
+            feature_block_types=np.array(feature_block_types, dtype=np.uint8),
+            ppips=ppips,
+            offsets=np.array(offsets, dtype=np.int64),
+            block_type_names=block_type_names,
+            block_types=np.array(block_types, dtype=np.uint8),
+            frame_offsets=np.array(frame_offsets, dtype=np.uint32),
+            word_offsets=np.array(word_offsets, dtype=np.uint16),
+            bit_indices=np.array(bit_indices, dtype=np.uint8),
+            isset=np.array(isset, dtype=bool),
+        )
+
+    def save(self, fn):
+        np.savez(
+            fn,
+            tile_type=np.array(self.tile_type),
+            features=np.array(self.features, dtype=str),
+            feature_block_types=self.feature_block_types,
+            ppips=np.array(sorted(self.ppips), dtype=str),
+            offsets=self.offsets,
+            block_type_names=np.array(self.block_type_names, dtype=str),
+            block_types=self.block_types,
+            frame_offsets=self.frame_offsets,
+            word_offsets=self.word_offsets,
+            bit_indices=self.bit_indices,
+            isset=self.isset,
+        )
+
+    @staticmethod
+    def load(fn):
+        with np.load(fn, allow_pickle=False) as data:
+            return CompiledSegbits(
+                tile_type=str(data['tile_type']),
+                features=data['features'].tolist(),
+                feature_block_types=data['feature_block_types'],
+                ppips=data['ppips'].tolist(),
+                offsets=data['offsets'],
+                block_type_names=data['block_type_names'].tolist(),
+                block_types=data['block_types'],
+                frame_offsets=data['frame_offsets'],
+                word_offsets=data['word_offsets'],
+                bit_indices=data['bit_indices'],
+                isset=data['isset'],
+            )
+
+    def feature_slice(self, feature, address=0):
+        """ Return the bit range of a feature (without the tile type prefix).
+
+        Returns None for pseudo pips, which have no bits.
+        Raises KeyError if the feature is unknown.
+
+        A plain feature F is used at address 0 over F[0], as by
+        TileSegbits.feature_to_bits:
+
+        >>> segbits = CompiledSegbits(
+        ...     'T', ['F[0]', 'F', 'F[1]'], np.zeros(3, dtype=np.uint8),
+        ...     [], np.array([0, 1, 3, 4]), ['CLB_IO_CLK'],
+        ...     np.zeros(4, dtype=np.uint8), np.arange(4), np.zeros(4),
+        ...     np.arange(4), np.ones(4, dtype=bool))
+        >>> s = segbits.feature_slice('F')
+        >>> int(s.start), int(s.stop)
+        (1, 3)
+        """
+        if feature in self.ppips:
+            return None
+
+        idx = self.feature_index[feature, address]
+        return slice(self.offsets[idx], self.offsets[idx + 1])
+
+    def feature_bits(self, feature, address=0):
+        """ Return tuple of (block_type, frame_offset, word_offset, bit_index, isset).
+
+        Raises KeyError if the feature is unknown.
+        """
+        key = feature, address
+        bits = self.bits_cache.get(key)
+        if bits is not None:
+            return bits
+
+        with self.lock:
+            bits = self.bits_cache.get(key)
+            if bits is None:
+                s = self.feature_slice(feature, address)
+                if s is None:
+                    bits = ()
+                else:
+                    bits = tuple(
+                        zip([
+                            self.block_type_enums[idx]
+                            for idx in self.block_types[s].tolist()
+                        ], self.frame_offsets[s].tolist(),
+                            self.word_offsets[s].tolist(),
+                            self.bit_indices[s].tolist(),
+                            self.isset[s].tolist()))
+                self.bits_cache[key] = bits
+
+        return bits
+
+    def address_table(self, feature):
+        """ Return (addresses, starts, ends) of every address of a feature.
+
+        addresses is sorted, and the bits of addresses[i] are in the range
+        starts[i]:ends[i].  Raises KeyError if the feature is unknown.
+        """
+        if self.address_tables is None:
+            with self.lock:
+                if self.address_tables is None:
+                    self.address_tables = self.build_address_tables()
+
+        return self.address_tables[feature]
+
+    def build_address_tables(self):
+        ''' Return map of feature to its address_table. '''
+        grouped = {}
+        for (base, address), idx in self.feature_index.items():
+            grouped.setdefault(base, []).append((address, idx))
+
+        address_tables = {}
+        for base, entries in grouped.items():
+            entries.sort()
+            idx = np.array([idx for _, idx in entries], dtype=np.int64)
+            address_tables[base] = (
+                np.array([address for address, _ in entries], dtype=np.int64),
+                self.offsets[idx],
+                self.offsets[idx + 1],
+            )
+
+        return address_tables
+
+    def address_bits(self, feature, addresses):
+        """ Return the bits of a feature at each of addresses.
+
+        Vectorized feature_slice, returns (missing, bit_idx) where missing
+        are the addresses the feature has no entry for, and bit_idx indexes
+        the bits of the other addresses, in the order of addresses.
+
+        >>> segbits = CompiledSegbits(
+        ...     'T', ['F[0]', 'F[1]', 'F[3]'], np.zeros(3, dtype=np.uint8),
+        ...     [], np.array([0, 1, 3, 4]), ['CLB_IO_CLK'],
+        ...     np.zeros(4, dtype=np.uint8), np.arange(4), np.zeros(4),
+        ...     np.arange(4), np.ones(4, dtype=bool))
+        >>> missing, bit_idx = segbits.address_bits('F', np.array([1, 2, 3]))
+        >>> missing.tolist(), bit_idx.tolist()
+        ([2], [1, 2, 3])
+        """
+        addresses = np.asarray(addresses, dtype=np.int64)
+        if feature in self.ppips:
+            return addresses[:0], np.zeros(0, dtype=np.int64)
+
+        table_addresses, starts, ends = self.address_table(feature)
+
+        pos = np.searchsorted(table_addresses, addresses)
+        pos[pos == len(table_addresses)] = 0
+        found = table_addresses[pos] == addresses
+
+        starts = starts[pos[found]]
+        lengths = ends[pos[found]] - starts
+
+        return addresses[~found], expand_ranges(starts, lengths)
+
+    def match_table(self, block_type_idx):
+        """ Return list of (feature, bits) for features of a block type.
+
+        bits is a tuple of (frame_offset, word_bit, isset), with word_bit
+        relative to the tile word offset.
+        """
+        table = self.match_tables.get(block_type_idx)
+        if table is not None:
+            return table
+
+        with self.lock:
+            table = self.match_tables.get(block_type_idx)
+            if table is None:
+                table = self.build_match_table(block_type_idx)
+                self.match_tables[block_type_idx] = table
+
+        return table
+
+    def build_match_table(self, block_type_idx):
+        ''' Return the match_table of a block type. '''
+        word_bits = (
+            self.word_offsets.astype(np.int64) * bitstream.WORD_SIZE_BITS +
+            self.bit_indices).tolist()
+        frame_offsets = self.frame_offsets.tolist()
+        isset = self.isset.tolist()
+        offsets = self.offsets.tolist()
+
+        table = []
+        for idx in np.flatnonzero(
+                self.feature_block_types == block_type_idx).tolist():
+            start, end = offsets[idx], offsets[idx + 1]
+            table.append(('{}.{}'.format(self.tile_type, self.features[idx]),
+                          tuple(
+                              zip(frame_offsets[start:end],
+                                  word_bits[start:end], isset[start:end]))))
+
+        return table
+
+    def match_bitdata(self, block_type, bits, bitdata):
+        """ Return matching features for tile bits data and bitdata.
+
+        Equivalent to TileSegbits.match_bitdata for a bitstream.BitData,
+        yields (ones_matched, feature) tuples where feature includes the tile
+        type prefix.
+        """
+        if block_type.name not in self.block_type_names:
+            return
+
+        table = self.match_table(self.block_type_names.index(block_type.name))
+        bit_offset = bits.offset * bitstream.WORD_SIZE_BITS
+
+        for feature, feature_bits in table:
+            match = True
+            ones_matched = []
+            for frame_offset, word_bit, isset in feature_bits:
+                frame = bits.base_address + frame_offset
+                bitidx = bit_offset + word_bit
+                found = (frame, bitidx) in bitdata
+                if found != isset:
+                    match = False
+                    break
+
+                if isset:
+                    ones_matched.append((frame, bitidx))
+
+            if match:
+                yield tuple(ones_matched), feature
+
+    def match_frames(self,
+                     block_type,
+                     bases,
+                     word_offsets,
+                     frame_addrs,
+                     frame_rows,
+                     frame_words,
+                     chunk_size=256):
+        """ Vectorized match_bitdata of many tiles of this tile type.
+
+        bases and word_offsets are the base address and word offset of the
+        block_type bits of each tile.  frame_addrs are sorted frame
+        addresses, frame frame_addrs[i] being row frame_rows[i] of
+        frame_words, the 16-bit frame words (see
+        bitstream.BitData.frame_array).
+
+        Returns a list with, for each tile, the indices into
+        match_table(block_type) of its matching features, in table order.
+
+        Tile bits of all features are gathered into a tile x bit array, and
+        a feature matches where all of its bits equal their isset value.
+        """
+        bases = np.asarray(bases, dtype=np.int64)
+        word_offsets = np.asarray(word_offsets, dtype=np.int64)
+        if block_type.name not in self.block_type_names:
+            return [[] for _ in range(len(bases))]
+
+        block_type_idx = self.block_type_names.index(block_type.name)
+        feature_idx = np.flatnonzero(
+            self.feature_block_types == block_type_idx)
+        lengths = self.offsets[feature_idx + 1] - self.offsets[feature_idx]
+        bit_idx = expand_ranges(self.offsets[feature_idx], lengths)
+
+        # Features without bits always match, the others match where the
+        # logical and of their bits is true.
+        has_bits = lengths > 0
+        reduce_starts = (np.cumsum(lengths) - lengths)[has_bits]
+
+        feature_frames, bit_frame_idx = np.unique(
+            self.frame_offsets[bit_idx].astype(np.int64), return_inverse=True)
+        bit_words = self.word_offsets[bit_idx].astype(np.int64)
+        bit_indices = self.bit_indices[bit_idx]
+        bit_isset = self.isset[bit_idx]
+
+        # Frame row of every frame of every tile, frames missing from
+        # frame_addrs read as zero.
+        frame_addrs = np.asarray(frame_addrs, dtype=np.int64)
+        tile_frames = bases[:, np.newaxis] + feature_frames
+        slots = np.searchsorted(frame_addrs, tile_frames)
+        found = slots < len(frame_addrs)
+        found[found] = frame_addrs[slots[found]] == tile_frames[found]
+        slots[~found] = 0
+        tile_rows = slots
+        if len(frame_addrs):
+            tile_rows = np.asarray(frame_rows, dtype=np.int64)[slots]
+
+        # Tiles without any of the frames match like an all zero tile.
+        zero_match = np.ones(len(feature_idx), dtype=bool)
+        if len(reduce_starts):
+            zero_match[has_bits] = np.logical_and.reduceat(
+                ~bit_isset, reduce_starts)
+        matches = [np.flatnonzero(zero_match).tolist()] * len(bases)
+
+        present = np.flatnonzero(found.any(axis=1))
+        for start in range(0, len(present), chunk_size):
+            tiles = present[start:start + chunk_size]
+
+            # Bits past the end of the frame are not set.
+            words = word_offsets[tiles, np.newaxis] + bit_words
+            in_frame = (words <
+                        frame_words.shape[1]) & found[tiles][:, bit_frame_idx]
+            words[~in_frame] = 0
+            bits = ((frame_words[tile_rows[tiles][:, bit_frame_idx], words] >>
+                     bit_indices) & 1) & in_frame
+
+            match = np.ones((len(tiles), len(feature_idx)), dtype=bool)
+            if len(reduce_starts):
+                match[:, has_bits] = np.logical_and.reduceat(
+                    bits.astype(bool) == bit_isset, reduce_starts, axis=1)
+
+            tile_idx, match_idx = np.nonzero(match)
+            split_matches = np.split(
+                match_idx, np.searchsorted(tile_idx, np.arange(1, len(tiles))))
+            for tile, tile_matches in zip(tiles.tolist(), split_matches):
+                matches[tile] = tile_matches.tolist()
+
+        return matches
+
+    def is_zero_feature(self, feature):
+        """ Return True if feature at address 0 sets no bits.
+
+        Raises KeyError if the feature is unknown.
+        """
+        return self.zero_features[feature]
+
+
+class SegbitsCache(object):
+    """ Compiled segbits of all tile types of a database, loaded on demand.
+    """
+
+    def __init__(self, db, cache_dir=None):
+        self.db = db
+        self.cache_dir = cache_dir
+        if self.cache_dir is None:
+            self.cache_dir = default_cache_dir()
+
+        # Shared by the threads of fasm_server, tile types are loaded under
+        # lock.
+        self.lock = threading.Lock()
+        self.compiled = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, tile_type):
+        compiled = self.compiled.get(tile_type)
+        if compiled is not None:
+            return compiled
+
+        with self.lock:
+            compiled = self.compiled.get(tile_type)
+            if compiled is None:
+                compiled = self.load_or_compile(tile_type)
+                self.compiled[tile_type] = compiled
+
+        return compiled
+
+    def load_or_compile(self, tile_type):
+        fns = segbits_files(self.db.db_root, tile_type)
+        if not self.cache_dir or not fns:
+            return CompiledSegbits.compile(tile_type,
+                                           self.db.get_tile_segbits(tile_type))
+
+        cache_fn = os.path.join(
+            self.cache_dir, '{}_{}.npz'.format(tile_type.lower(),
+                                               segbits_hash(fns)))
+        if os.path.exists(cache_fn):
+            self.hits += 1
+            return CompiledSegbits.load(cache_fn)
+
+        self.misses += 1
+        compiled = CompiledSegbits.compile(tile_type,
+                                           self.db.get_tile_segbits(tile_type))
+
+        # Write to a temporary file first, so concurrent runs never see a
+        # partially written cache entry.
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_fn = tempfile.mkstemp(suffix='.npz', dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                compiled.save(f)
+            os.replace(tmp_fn, cache_fn)
+        except BaseException:
+            os.unlink(tmp_fn)
+            raise
+
+        return compiled
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Precompile segbits of all tile types into the cache.')
+
+    util.db_root_arg(parser)
+    util.part_arg(parser)
+    parser.add_argument(
+        '--cache_dir',
+        default=None,
+        help='Cache directory, default is URAY_SEGBITS_CACHE.')
+
+    args = parser.parse_args()
+
+    db = Database(args.db_root, args.part)
+    cache = SegbitsCache(db, cache_dir=args.cache_dir)
+    for tile_type in sorted(db.get_tile_types()):
+        compiled = cache.get(tile_type)
+        print('{}: {} features, {} bits'.format(tile_type,
+                                                len(compiled.features),
+                                                len(compiled.isset)))
+
+    print('Compiled {} tile types, {} already cached.'.format(
+        cache.misses, cache.hits))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright 2020-2022 F4PGA Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+'''
+Binary, append-only segdata store, holding the segdata of one tile type
+from all specimens of a fuzzer.
+
+Specimens append their segments to the store (see Segmaker.write) instead
+of writing segdata_<type>.txt files, and the store is read back in one
+sequential pass.  Tag names are interned: each name is stored once per
+source, and segments refer to tags by id.
+
+All values are little-endian.  The file starts with:
+
+  offset   size           content
+  0        8              magic b'URAYSEG\\0'
+  8        4              format version
+  12       4              reserved
+
+followed by records, each starting with a record kind (1 byte) and the
+length of its name (4 bytes), and the UTF-8 name:
+
+  SOURCE   segdata text file of the following records, e.g.
+           specimen_001/segdata_int.txt
+  TAG      name of the next tag id of the source, ids count up from 0
+  SEGMENT  segment name, then the bit count B and tag count T (4 bytes
+           each), B bit ids (4 bytes each), T tag ids (4 bytes each) and
+           T tag values (1 byte each)
+
+Bit ids are frame << 16 | bit of segdata bit names "<frame>_<bit>".
+Each source has its own tag table, so appending never reads the store.
+Writing a source again supersedes its earlier records, so specimens can be
+regenerated, and compact() drops the superseded records.
+
+Run as a script, converts a store to a segdata text file for segmatch (see
+segmatch_all_types.py), or appends text files to a store.  Both compact
+the store.
+'''
+
+import argparse
+import contextlib
+import fcntl
+import os
+import re
+import struct
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+MAGIC = b'URAYSEG\0'
+VERSION = 2
+
+HEADER = struct.Struct('<8sI4x')
+RECORD = struct.Struct('<BI')
+SEGMENT = struct.Struct('<II')
+
+RECORD_TAG = 1
+RECORD_SOURCE = 2
+RECORD_SEGMENT = 3
+
+BIT_NAME_RE = re.compile(r'^([0-9]+)_([0-9]+)$')
+
+# Segment of a store: bits is a list of bit names and tags a list of
+# (tag name, value).
+Segment = namedtuple('Segment', 'source name bits tags')
+
+
+def bit_id(bit_name):
+    """ Return id of a segdata bit name.
+
+    >>> hex(bit_id('02_15'))
+    '0x2000f'
+    """
+    m = BIT_NAME_RE.match(bit_name)
+    if m is None:
+        raise ValueError('Invalid segdata bit name "{}"'.format(bit_name))
+
+    frame, bit = int(m.group(1)), int(m.group(2))
+    if frame > 0xFFFF or bit > 0xFFFF:
+        raise ValueError('Segdata bit {} is out of range'.format(bit_name))
+
+    return frame << 16 | bit
+
+
+def bit_name(bit_id):
+    """ Return segdata bit name of a bit id, as written by Segmaker.
+
+    >>> bit_name(0x2000f)
+    '02_15'
+    """
+    return "%02d_%02d" % (bit_id >> 16, bit_id & 0xFFFF)
+
+
+def iter_records(data, fn=''):
+    """ Yield (kind, name, bit ids, tag ids, tag values) of store contents.
+
+    Arrays are views into data, and empty for TAG and SOURCE records.
+    """
+    if len(data) < HEADER.size:
+        raise ValueError('{} is too short for a segdata store'.format(fn))
+
+    magic, version = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError('{} is not a segdata store'.format(fn))
+    if version != VERSION:
+        raise ValueError('{} has unsupported segdata store version {}'.format(
+            fn, version))
+
+    def check_size(pos, size):
+        if pos + size > len(data):
+            raise ValueError('{} is truncated'.format(fn))
+
+    empty = np.zeros(0, dtype='<u4')
+    pos = HEADER.size
+    while pos < len(data):
+        check_size(pos, RECORD.size)
+        kind, name_length = RECORD.unpack_from(data, pos)
+        pos += RECORD.size
+        check_size(pos, name_length)
+        name = bytes(data[pos:pos + name_length]).decode()
+        pos += name_length
+
+        if kind in (RECORD_TAG, RECORD_SOURCE):
+            yield kind, name, empty, empty, empty
+            continue
+        elif kind != RECORD_SEGMENT:
+            raise ValueError('{} has unknown record kind {}'.format(fn, kind))
+
+        check_size(pos, SEGMENT.size)
+        bit_count, tag_count = SEGMENT.unpack_from(data, pos)
+        pos += SEGMENT.size
+        check_size(pos, 4 * bit_count + 5 * tag_count)
+        bits = np.frombuffer(data, dtype='<u4', count=bit_count, offset=pos)
+        pos += 4 * bit_count
+        tags = np.frombuffer(data, dtype='<u4', count=tag_count, offset=pos)
+        pos += 4 * tag_count
+        values = np.frombuffer(
+            data, dtype=np.uint8, count=tag_count, offset=pos)
+        pos += tag_count
+
+        yield kind, name, bits, tags, values
+
+
+def parse_segments(data, fn=''):
+    """ Return (Segments, superseded) of store contents.
+
+    Segments are by source in the order written, only the segments of the
+    last write of each source are returned.  superseded is True if the
+    store has records of earlier writes of a source.
+    """
+    tag_names = None
+    sources = OrderedDict()
+    superseded = False
+    segments = None
+    for kind, name, bits, tags, values in iter_records(data, fn):
+        if kind == RECORD_SOURCE:
+            source = name
+            superseded |= sources.pop(source, None) is not None
+            segments = sources[source] = []
+            tag_names = []
+        elif segments is None:
+            raise ValueError('{} has a record without source'.format(fn))
+        elif kind == RECORD_TAG:
+            tag_names.append(name)
+        else:
+            segments.append(
+                Segment(
+                    source, name, [bit_name(bit) for bit in bits.tolist()],
+                    [(tag_names[tag], value)
+                     for tag, value in zip(tags.tolist(), values.tolist())]))
+
+    return [segment for segments in sources.values()
+            for segment in segments], superseded
+
+
+def read_segments(fn):
+    """ Return the Segments of a store, see parse_segments. """
+    with open(fn, 'rb') as f:
+        return parse_segments(f.read(), fn)[0]
+
+
+def source_records(source, segments):
+    """ Return the records of a write of segments of a source.
+
+    segments is an iterable of (name, bit names, tags), tags a map of tag
+    name to value.
+    """
+    buf = bytearray()
+
+    def add_record(kind, name):
+        name = name.encode()
+        buf.extend(RECORD.pack(kind, len(name)))
+        buf.extend(name)
+
+    add_record(RECORD_SOURCE, source)
+    tag_ids = {}
+    for name, bits, tags in segments:
+        tags = sorted(tags.items())
+        for tag, _ in tags:
+            if tag not in tag_ids:
+                add_record(RECORD_TAG, tag)
+                tag_ids[tag] = len(tag_ids)
+
+        add_record(RECORD_SEGMENT, name)
+        buf.extend(SEGMENT.pack(len(bits), len(tags)))
+        buf.extend(
+            np.array(sorted(bit_id(bit) for bit in bits),
+                     dtype='<u4').tobytes())
+        buf.extend(
+            np.array([tag_ids[tag] for tag, _ in tags], dtype='<u4').tobytes())
+        buf.extend(
+            np.array([value for _, value in tags], dtype=np.uint8).tobytes())
+
+    return buf
+
+
+@contextlib.contextmanager
+def locked_store(fn):
+    """ Open a store for appending and hold its lock, creating it if needed.
+
+    compact replaces the store file, so a file replaced while waiting for
+    the lock is opened again.
+    """
+    while True:
+        with open(fn, 'a+b') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if os.stat(fn).st_ino == os.fstat(f.fileno()).st_ino:
+                yield f
+                return
+
+
+def append_segments(fn, source, segments):
+    """ Append segments of a source to a store, creating it if needed.
+
+    segments is an iterable of (name, bit names, tags), tags a map of tag
+    name to value.  The store is locked while appending, so specimens built
+    in parallel can append to the same store.
+    """
+    buf = source_records(source, segments)
+    with locked_store(fn) as f:
+        # The file is opened for appending, so this writes at the end.
+        if f.seek(0, os.SEEK_END) == 0:
+            f.write(HEADER.pack(MAGIC, VERSION))
+        f.write(buf)
+
+
+def compact(fn):
+    """ Drop superseded records from a store, and return its Segments.
+
+    The compacted store replaces the store file, so appends to the store
+    can run at the same time.
+    """
+    with locked_store(fn) as f:
+        f.seek(0)
+        segments, superseded = parse_segments(f.read(), fn)
+        if not superseded:
+            return segments
+
+        sources = OrderedDict()
+        for segment in segments:
+            tags = dict(segment.tags)
+            sources.setdefault(segment.source, []).append((segment.name,
+                                                           segment.bits, tags))
+
+        tmp_fn = fn + '.compact'
+        with open(tmp_fn, 'wb') as f_out:
+            f_out.write(HEADER.pack(MAGIC, VERSION))
+            for source, source_segments in sources.items():
+                f_out.write(source_records(source, source_segments))
+        os.replace(tmp_fn, fn)
+
+    return segments
+
+
+def write_text(f, segments):
+    ''' Write segments to text file object f, in segdata text format. '''
+    for segment in segments:
+        print("seg %s" % segment.name, file=f)
+        for bit in sorted(segment.bits):
+            print("bit %s" % bit, file=f)
+        for tag, value in segment.tags:
+            print("tag %s %d" % (tag, value), file=f)
+
+
+def read_text(fn):
+    """ Return (name, bit names, tags) of the segments of a text file.
+
+    tags is a map of tag name to value, as taken by append_segments.
+    """
+    segments = []
+    with open(fn) as f:
+        for line in f:
+            fields = line.split()
+            if not fields:
+                continue
+
+            if fields[0] == 'seg':
+                segment = (fields[1], [], {})
+                segments.append(segment)
+            elif fields[0] == 'bit':
+                segment[1].append(fields[1])
+            elif fields[0] == 'tag':
+                segment[2][fields[1]] = int(fields[2])
+            else:
+                raise ValueError('Invalid segdata line "{}" in {}'.format(
+                    line.strip(), fn))
+
+    return segments
+
+
+def store_to_text(fn, text_fn):
+    """ Compact a store and write its segments to one segdata text file.
+
+    Segment names are prefixed with their source ("<source>:<name>"), so
+    that they stay unique as in separate text files.
+    """
+    segments = [
+        segment._replace(name='{}:{}'.format(segment.source, segment.name))
+        for segment in compact(fn)
+    ]
+
+    os.makedirs(os.path.dirname(text_fn) or '.', exist_ok=True)
+    with open(text_fn, 'w') as f:
+        write_text(f, segments)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest='op')
+    subparsers.required = True
+
+    to_text = subparsers.add_parser(
+        'to_text', help='Write the segdata text file of a store')
+    to_text.add_argument('store', help='Segdata store file')
+    to_text.add_argument(
+        '--output',
+        help='Segdata text file, default is the store file name with a .txt '
+        'extension')
+
+    from_text = subparsers.add_parser(
+        'from_text', help='Append segdata text files to a store')
+    from_text.add_argument('store', help='Segdata store file')
+    from_text.add_argument(
+        'segdata_files',
+        nargs='+',
+        help='Segdata text files, stored under their names as given')
+
+    args = parser.parse_args()
+
+    if args.op == 'to_text':
+        output = args.output
+        if output is None:
+            output = os.path.splitext(args.store)[0] + '.txt'
+        store_to_text(args.store, output)
+    else:
+        for fn in args.segdata_files:
+            append_segments(args.store, os.path.normpath(fn), read_text(fn))
+        compact(args.store)
+
+
+if __name__ == '__main__':
+    main()
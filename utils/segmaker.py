@@ -31,8 +31,13 @@ tag CLB.SLICE.BFF.DMUX.BX 0
 tilegrid.json provides tile addresses
 '''
 
+import functools
 import os, json, re
-from utils import util
+
+import numpy as np
+
+from utils import segdata_file, util
+from utils.bitstream import parse_bits
 
 BLOCK_TYPES = set(('CLB_IO_CLK', 'BLOCK_RAM', 'CFG_CLB'))
 
@@ -89,7 +94,136 @@ def add_site_group_zero(segmk, site, prefix, vals, zero_val, val):
             segmk.add_site_tag(site, tag, False)
 
 
-class Segmaker:
+# Tile types sharing the segment bits of another tile type.
+TILE_TYPE_NORM = {
+    'CLEL_L': 'CLE',
+    'CLEL_R': 'CLE',
+    'CLEM': 'CLE',
+    'CLEM_R': 'CLE',
+    'RCLK_INT_L': 'RCLK_INT',
+    'RCLK_INT_R': 'RCLK_INT',
+    'RCLK_CLEL_L_L': 'RCLK_CLE',
+    'RCLK_CLEM_R': 'RCLK_CLE',
+    'RCLK_CLEM_L': 'RCLK_CLE',
+    'RCLK_BRAM_INTF_L': 'RCLK_BRAM_INTF',
+    'RCLK_BRAM_INTF_TD_L': 'RCLK_BRAM_INTF',
+    'RCLK_BRAM_INTF_TD_R': 'RCLK_BRAM_INTF',
+    'RCLK_DSP_INTF_L': 'RCLK_DSP_INTF',
+    'RCLK_DSP_INTF_R': 'RCLK_DSP_INTF',
+}
+
+SLICE_RE = re.compile(r"SLICE_X[0-9]*[0123456789]Y")
+RAMB18_Y0_RE = re.compile(r"^RAMB18_X.*Y[0-9]*[02468]$")
+RAMB18_Y1_RE = re.compile(r"^RAMB18_X.*Y[0-9]*[13579]$")
+SITE_Y0_RE = re.compile(r"^(.*)_X.*Y[0-9]*[02468]$")
+SITE_Y1_RE = re.compile(r"^(.*)_X.*Y[0-9]*[13579]$")
+
+
+@functools.lru_cache(maxsize=None)
+def site_key(site):
+    '''
+    Return the name of a site within its tile, as used in tags
+
+    >>> site_key('SLICE_X12Y102'), site_key('RAMB18_X0Y41')
+    ('SLICE', 'RAMB18_Y1')
+    >>> site_key('IOB_X0Y12'), site_key('BUFCE_ROW_X0Y3')
+    ('IOB_Y0', 'BUFCE')
+    '''
+    site_prefix = site.split('_')[0]
+
+    if site_prefix == 'SLICE':
+        # SLICE_X12Y102 => SLICE
+        assert SLICE_RE.match(site), "Invalid name in %s" % site
+        return "SLICE"
+    elif site_prefix == 'RAMB18':
+        # RAMB18_X0Y41 => RAMB18_Y1
+        if RAMB18_Y0_RE.match(site):
+            return "RAMB18_Y0"
+        elif RAMB18_Y1_RE.match(site):
+            return "RAMB18_Y1"
+        else:
+            assert False, "Invalid name in %s" % site
+    elif site_prefix in ('IOB', 'IDELAY', 'ILOGIC', 'OLOGIC'):
+        m = SITE_Y0_RE.match(site)
+        if m:
+            return "%s_Y0" % m.group(1)
+
+        m = SITE_Y1_RE.match(site)
+        if m:
+            return "%s_Y1" % m.group(1)
+
+        assert 0, site
+    else:
+        # most sites are unique within their tile
+        # TODO: maybe verify against DB?
+        return site_prefix
+
+
+class BaseFrameBits:
+    """ Set bits of a bitstream, indexed by base frame and word.
+
+    frames, words and bits are compact integer arrays with one entry per set
+    bit, sorted by base frame, word, frame and bit.  The base frame of a frame address is the address
+    of the first frame of its column (frame & ~base_mask).  The bits of
+    base frame base_frames[i] are the range
+    [base_offsets[i], base_offsets[i + 1]) of the arrays.
+    """
+
+    def __init__(self, frames, words, bits, base_mask):
+        bases = frames & ~base_mask
+        order = np.lexsort((bits, frames, words, bases))
+        bases = bases[order]
+        frames = frames[order]
+        words = words[order]
+        bits = bits[order]
+
+        # Drop repeated bits.
+        unique = np.ones(len(order), dtype=bool)
+        unique[1:] = ((frames[1:] != frames[:-1]) | (words[1:] != words[:-1])
+                      | (bits[1:] != bits[:-1]))
+        bases = bases[unique]
+        self.frames = frames[unique].astype(np.uint32)
+        self.words = words[unique].astype(np.uint16)
+        self.bits = bits[unique].astype(np.uint8)
+
+        self.base_frames, base_offsets = np.unique(bases, return_index=True)
+        self.base_offsets = np.append(base_offsets, len(bases))
+
+    def __len__(self):
+        return len(self.frames)
+
+    def bits_in_words(self, base_frame, word_start, word_end):
+        """ Return (frames, words, bits) of the bits in a range of words.
+
+        Bits are those of the frames of base_frame, in words
+        [word_start, word_end).
+
+        >>> bits = BaseFrameBits(np.array([0x101, 0x100, 0x201]),
+        ...                      np.array([3, 5, 3]), np.array([1, 2, 3]), 0xff)
+        >>> [a.tolist() for a in bits.bits_in_words(0x100, 0, 5)]
+        [[257], [3], [1]]
+        """
+        idx = np.searchsorted(self.base_frames, base_frame)
+        if idx == len(self.base_frames) or self.base_frames[idx] != base_frame:
+            return self.frames[:0], self.words[:0], self.bits[:0]
+
+        start = self.base_offsets[idx]
+        end = self.base_offsets[idx + 1]
+        lo, hi = start + np.searchsorted(self.words[start:end],
+                                         [word_start, word_end])
+
+        return self.frames[lo:hi], self.words[lo:hi], self.bits[lo:hi]
+
+
+class SegmakerContext:
+    """ Tile grid, site index and bits of a bitstream, shared by Segmakers.
+
+    Loading tilegrid.json and the .bits file dominates the cost of creating
+    a Segmaker, so tools creating several Segmakers for the same bitstream
+    (e.g. one per tile type) load them once here and pass the context to
+    each Segmaker.  The context is not modified by the Segmakers.
+    """
+
     def __init__(self,
                  bitsfile,
                  verbose=False,
@@ -110,36 +244,18 @@ class Segmaker:
         self.bits_per_word = bits_per_word
         self.load_grid()
         self.load_bits(bitsfile)
-        '''
-        self.tags[site][name] = value
-        Where:
-        -site: ex 'SLICE_X13Y101'
-        -name: ex 'CLB.SLICE_X0.AFF.DMUX.CY'
-        '''
-        self.site_tags = dict()
-        self.tile_tags = dict()
-
-        # output after compiling
-        self.segments_by_type = None
-
-        # hacky...improve if we encounter this more
-        self.def_bt = 'CLB_IO_CLK'
         self.index_sites()
 
     def index_sites(self):
         self.verbose and print("Indexing sites")
         self.sites = {}
-        for tilename, tiledata in self.grid.items():
+        self.tile_order = {}
+        for idx, (tilename, tiledata) in enumerate(self.grid.items()):
+            self.tile_order[tilename] = idx
             for site in tiledata["sites"]:
                 self.sites[site] = tilename
         self.verbose and print("Sites indexed")
 
-    def set_def_bt(self, block_type):
-        '''Set default block type when more than one block present'''
-        assert block_type in BLOCK_TYPES, (
-            "Unknown block type %r (known %r)" % (block_type, BLOCK_TYPES))
-        self.def_bt = block_type
-
     def load_grid(self):
         '''Load self.grid holding tile addresses'''
         with open(os.path.join(self.db_root, self.part, "tilegrid.json"),
@@ -148,44 +264,84 @@ class Segmaker:
         assert "segments" not in self.grid, "Old format tilegrid.json"
 
     def load_bits(self, bitsfile):
-        '''Load self.bits holding the bits that occured in the bitstream'''
         '''
-        Format:
-        self.bits[base_frame][bit_wordidx] = set()
-        Where elements are (bit_frame, bit_wordidx, bit_bitidx))
-        bit_frame is a relatively large number forming the FDRI address
-        base_frame is a truncated bit_frame address of related FDRI addresses
-        0 <= bit_wordidx <= 100
-        0 <= bit_bitidx < 31
+        Load self.bits, a BaseFrameBits of the bits that occured in the bitstream
 
         Sample bits input
         bit_00020500_000_08
         bit_00020500_000_14
         bit_00020500_000_17
         '''
-        self.bits = dict()
         print("Loading bits from %s." % bitsfile)
-        with open(bitsfile, "r") as f:
-            for line in f:
-                # ex: bit_00020500_000_17
-                line = line.split("_")
-                bit_frame = int(line[1], 16)
-                # Word indexes in the .bits file for US+/US assume 32-bits per word
-                bit_wordidx = int(line[2],
-                                  10) * (32 / self.bits_per_word) + int(
-                                      line[3], 10) // self.bits_per_word
-                bit_bitidx = int(line[3], 10) % self.bits_per_word
-                # Bit ranges in the Frame Address Register Description differs between US+ and US devices
-                # For US the ranges are identical to 7-series, but US+ is shifted 1 bit left
-                # Refer to UG570 Table 9-21
-                base_frame = bit_frame & (~0xff if os.getenv("URAY_ARCH") in
-                                          "UltraScalePlus" else ~0x7f)
-                self.bits.setdefault(base_frame, dict()).setdefault(
-                    bit_wordidx, set()).add((bit_frame, bit_wordidx,
-                                             bit_bitidx))
+        with open(bitsfile, "rb") as f:
+            frames, words, bits = parse_bits(f.read())
+
+        # Word indexes in the .bits file for US+/US assume 32-bits per word
+        words = words * (32 // self.bits_per_word) + bits // self.bits_per_word
+        bits = bits % self.bits_per_word
+
+        # Bit ranges in the Frame Address Register Description differs between US+ and US devices
+        # For US the ranges are identical to 7-series, but US+ is shifted 1 bit left
+        # Refer to UG570 Table 9-21
+        base_mask = 0xff if os.getenv(
+            "URAY_ARCH") in "UltraScalePlus" else 0x7f
+        self.bits = BaseFrameBits(frames, words, bits, base_mask)
+
         if self.verbose:
-            print('Loaded bits: %u bits in %u base frames' % (recurse_sum(
-                self.bits), len(self.bits)))
+            print('Loaded bits: %u bits in %u base frames' % (len(
+                self.bits), len(self.bits.base_frames)))
+
+
+class Segmaker:
+    def __init__(self,
+                 bitsfile,
+                 verbose=False,
+                 db_root=None,
+                 part=None,
+                 bits_per_word=32,
+                 context=None):
+        """ Segmaker of the bits in bitsfile.
+
+        context is an optional SegmakerContext of bitsfile, shared with
+        other Segmakers instead of loading the grid and bits again.
+        """
+        if context is None:
+            context = SegmakerContext(
+                bitsfile,
+                verbose=verbose,
+                db_root=db_root,
+                part=part,
+                bits_per_word=bits_per_word)
+
+        self.db_root = context.db_root
+        self.part = context.part
+        self.verbose = verbose if verbose is not None else os.getenv(
+            'VERBOSE', 'N') == 'Y'
+        self.bits_per_word = context.bits_per_word
+        self.grid = context.grid
+        self.bits = context.bits
+        self.sites = context.sites
+        self.tile_order = context.tile_order
+        '''
+        self.tags[site][name] = value
+        Where:
+        -site: ex 'SLICE_X13Y101'
+        -name: ex 'CLB.SLICE_X0.AFF.DMUX.CY'
+        '''
+        self.site_tags = dict()
+        self.tile_tags = dict()
+
+        # output after compiling
+        self.segments_by_type = None
+
+        # hacky...improve if we encounter this more
+        self.def_bt = 'CLB_IO_CLK'
+
+    def set_def_bt(self, block_type):
+        '''Set default block type when more than one block present'''
+        assert block_type in BLOCK_TYPES, (
+            "Unknown block type %r (known %r)" % (block_type, BLOCK_TYPES))
+        self.def_bt = block_type
 
     def add_site_tag(self, site, name, value):
         '''
@@ -222,7 +378,7 @@ class Segmaker:
 
         self.segments_by_type = dict()
 
-        def add_segbits(segments, segname, tilename, tiledata, bitfilter=None):
+        def add_segbits(segments, segname, tilename, tile_type_norm, bitj):
             '''
             Add and populate segments[segname]["bits"]
             Gives all of the bits that could exist for the space we are exploring
@@ -234,7 +390,7 @@ class Segmaker:
             segments[segname]["tags"][tag] = value
 
             segname: FDRI address + word offset string
-            tiledata: tilegrid info for this tile
+            bitj: tilegrid bits info of the default block type of this tile
             '''
             assert segname not in segments
             segment = segments.setdefault(
@@ -251,147 +407,49 @@ class Segmaker:
                 })
 
             base_frame = json_hex2i(bitj["baseaddr"])
-            for wordidx in range(bitj["offset"],
-                                 bitj["offset"] + bitj["words"]):
-                if base_frame not in self.bits:
-                    continue
-                if wordidx not in self.bits[base_frame]:
-                    continue
-                for bit_frame, bit_wordidx, bit_bitidx in self.bits[
-                        base_frame][wordidx]:
-                    bitname_frame = bit_frame - base_frame
-                    bitname_bit = self.bits_per_word * (
-                        bit_wordidx - bitj["offset"]) + bit_bitidx
-
-                    # Skip bits above the frame limit.
-                    if bitname_frame >= bitj["frames"]:
-                        continue
-
-                    # some bits are hard to de-correlate
-                    # allow force dropping some bits from search space for practicality
-                    if bitfilter is None or bitfilter(bitname_frame,
-                                                      bitname_bit):
-                        bitname = "%02d_%02d" % (bitname_frame, bitname_bit)
-                        segment["bits"].add(bitname)
+            frames, words, bits = self.bits.bits_in_words(
+                base_frame, bitj["offset"], bitj["offset"] + bitj["words"])
+            bitname_frames = frames.astype(np.int64) - base_frame
+            bitname_bits = self.bits_per_word * (
+                words.astype(np.int64) - bitj["offset"]) + bits
+
+            # Skip bits above the frame limit.
+            keep = bitname_frames < bitj["frames"]
+
+            for bitname_frame, bitname_bit in zip(
+                    bitname_frames[keep].tolist(),
+                    bitname_bits[keep].tolist()):
+                # some bits are hard to de-correlate
+                # allow force dropping some bits from search space for practicality
+                if bitfilter is None or bitfilter(bitname_frame, bitname_bit):
+                    bitname = "%02d_%02d" % (bitname_frame, bitname_bit)
+                    segment["bits"].add(bitname)
 
             return segment
 
-        '''
-        XXX: wouldn't it be better to iterate over tags? Easy to drop tags
-        For now, add a check that all tags are used
-        '''
-        for tilename, tiledata in self.grid.items():
-
-            def getseg(segname):
-                if not segname in segments:
-                    return add_segbits(
-                        segments,
-                        segname,
-                        tilename,
-                        tiledata,
-                        bitfilter=bitfilter)
-                else:
-                    segment = segments[segname]
-                    assert segment["offset"] == bitj["offset"]
-                    assert segment["words"] == bitj["words"]
-                    assert segment["frames"] == bitj["frames"]
-                    return segment
-
-            def add_tilename_tags():
-                self.verbose and print("Tile %s: check tags" % tilename)
-                segment = getseg(segname)
-
-                for name, value in self.tile_tags[tilename].items():
-                    tags_used.add((tilename, name))
-                    tag = "%s.%s" % (tile_type_norm, name)
-                    segment["tags"][tag] = value
-
-            def add_site_tags():
-                site_prefix = site.split('_')[0]
-
-                def name_slice():
-                    '''
-                    Simplify SLICE names like:
-                    -SLICE_X12Y102 => SLICE
-                    '''
-                    if re.match(r"SLICE_X[0-9]*[0123456789]Y", site):
-                        return "SLICE"
-                    else:
-                        assert False, "Invalid name in %s" % site
-
-                def name_bram18():
-                    # RAMB18_X0Y41
-                    if re.match(r"^RAMB18_X.*Y[0-9]*[02468]$", site):
-                        return "RAMB18_Y0"
-                    elif re.match(r"^RAMB18_X.*Y[0-9]*[13579]$", site):
-                        return "RAMB18_Y1"
-                    else:
-                        assert False, "Invalid name in %s" % site
-
-                def name_y0y1():
-                    # RAMB18_X0Y41
-                    m = re.match(r"^(.*)_X.*Y[0-9]*[02468]$", site)
-                    if m:
-                        return "%s_Y0" % m.group(1)
-
-                    m = re.match(r"^(.*)_X.*Y[0-9]*[13579]$", site)
-                    if m:
-                        return "%s_Y1" % m.group(1)
-
-                    assert 0, site
-
-                def name_default():
-                    # most sites are unique within their tile
-                    # TODO: maybe verify against DB?
-                    return site_prefix
-
-                sitekey = {
-                    'SLICE': name_slice,
-                    'RAMB18': name_bram18,
-                    'IOB': name_y0y1,
-                    'IDELAY': name_y0y1,
-                    'ILOGIC': name_y0y1,
-                    'OLOGIC': name_y0y1,
-                }.get(site_prefix, name_default)()
-                self.verbose and print('site %s w/ %s prefix => tag %s' %
-                                       (site, site_prefix, sitekey))
-
-                for name, value in self.site_tags[site].items():
-                    self.verbose and print("Site %s: check tags" % site)
-
-                    tags_used.add((site, name))
-                    tag = "%s.%s.%s" % (tile_type_norm, sitekey, name)
-                    # XXX: does this come from name?
-                    tag = tag.replace(".SLICEM.", ".")
-                    tag = tag.replace(".SLICEL.", ".")
-                    segment = getseg(segname)
-                    segment["tags"][tag] = value
-                sites_used.add(site)
-
+        def getseg(segments, segname, tilename, tile_type_norm, bitj):
+            if not segname in segments:
+                return add_segbits(segments, segname, tilename, tile_type_norm,
+                                   bitj)
+            else:
+                segment = segments[segname]
+                assert segment["offset"] == bitj["offset"]
+                assert segment["words"] == bitj["words"]
+                assert segment["frames"] == bitj["frames"]
+                return segment
+
+        # Only tagged tiles contribute segments.  Visit them in grid order,
+        # as tiles sharing a segment may set the same tag.
+        tagged_tiles = set(
+            tilename for tilename in self.tile_tags if tilename in self.grid)
+        tagged_tiles.update(self.sites[site] for site in self.site_tags)
+
+        for tilename in sorted(tagged_tiles, key=self.tile_order.get):
+            tiledata = self.grid[tilename]
             tile_type = tiledata["type"]
             tile_types_found.add(tile_type)
             segments = self.segments_by_type.setdefault(tile_type, dict())
-
-            tile_type_norm = tile_type
-            if tile_type_norm in ['CLEL_L', 'CLEL_R', 'CLEM', 'CLEM_R']:
-                tile_type_norm = 'CLE'
-
-            if tile_type_norm in ['RCLK_INT_L', 'RCLK_INT_R']:
-                tile_type_norm = 'RCLK_INT'
-
-            if tile_type_norm in [
-                    'RCLK_CLEL_L_L', 'RCLK_CLEM_R', 'RCLK_CLEM_L'
-            ]:
-                tile_type_norm = 'RCLK_CLE'
-
-            if tile_type_norm in [
-                    'RCLK_BRAM_INTF_L', 'RCLK_BRAM_INTF_TD_L',
-                    'RCLK_BRAM_INTF_TD_R'
-            ]:
-                tile_type_norm = 'RCLK_BRAM_INTF'
-
-            if tile_type_norm in ['RCLK_DSP_INTF_L', 'RCLK_DSP_INTF_R']:
-                tile_type_norm = 'RCLK_DSP_INTF'
+            tile_type_norm = TILE_TYPE_NORM.get(tile_type, tile_type)
 
             # ignore dummy tiles (ex: VBRK)
             if len(tiledata['bits']) == 0:
@@ -417,13 +475,36 @@ class Segmaker:
 
             # process tile name tags
             if tilename in self.tile_tags:
-                add_tilename_tags()
+                self.verbose and print("Tile %s: check tags" % tilename)
+                segment = getseg(segments, segname, tilename, tile_type_norm,
+                                 bitj)
+
+                for name, value in self.tile_tags[tilename].items():
+                    tags_used.add((tilename, name))
+                    tag = "%s.%s" % (tile_type_norm, name)
+                    segment["tags"][tag] = value
 
             # process site name tags
             for site in tiledata["sites"]:
                 if site not in self.site_tags:
                     continue
-                add_site_tags()
+
+                sitekey = site_key(site)
+                self.verbose and print('site %s w/ %s prefix => tag %s' %
+                                       (site, site.split('_')[0], sitekey))
+
+                for name, value in self.site_tags[site].items():
+                    self.verbose and print("Site %s: check tags" % site)
+
+                    tags_used.add((site, name))
+                    tag = "%s.%s.%s" % (tile_type_norm, sitekey, name)
+                    # XXX: does this come from name?
+                    tag = tag.replace(".SLICEM.", ".")
+                    tag = tag.replace(".SLICEL.", ".")
+                    segment = getseg(segments, segname, tilename,
+                                     tile_type_norm, bitj)
+                    segment["tags"][tag] = value
+                sites_used.add(site)
 
         n_site_tags = recurse_sum(self.site_tags)
         n_tile_tags = recurse_sum(self.tile_tags)
@@ -436,13 +517,23 @@ class Segmaker:
                 print('  Ex: %s' % list(self.site_tags.keys())[0])
             print("Tag tiles: %u" % (n_tile_tags, ))
             print("Used %u sites" % len(sites_used))
-            print("Grid DB had %u tile types" % len(tile_types_found))
+            print("Tags in %u tile types" % len(tile_types_found))
         assert ntags == len(tags_used), "Unused tags, %s used out of %s" % (
             len(tags_used), ntags)
 
-    def write(self, suffix=None, roi=False, allow_empty=False,
-              extra_tags=None):
-        assert self.segments_by_type, 'No data to write'
+    def write(self,
+              suffix=None,
+              roi=False,
+              allow_empty=False,
+              extra_tags=None,
+              store_dir=None):
+        """ Write segdata_<type>[_<suffix>].txt of each tile type.
+
+        With store_dir, the segments are appended to the segdata store
+        store_dir/segdata_<type>.sdb instead (see segdata_file.py), under
+        the name of the text file relative to store_dir.
+        """
+        assert self.segments_by_type is not None, 'No data to write'
 
         if not allow_empty:
             assert sum([
@@ -456,19 +547,32 @@ class Segmaker:
                 filename = "segdata_%s.txt" % (segtype.lower())
 
             segments = self.segments_by_type[segtype]
-            if segments:
-                print("Writing %s." % filename)
-                with open(filename, "w") as f:
-                    for segname, segdata in sorted(segments.items()):
-                        # seg 00020300_010
-                        print("seg %s" % segname, file=f)
-                        for bitname in sorted(segdata["bits"]):
-                            print("bit %s" % bitname, file=f)
-
-                        if extra_tags is not None:
-                            for tagname, tagval in extra_tags(segdata['name']):
-                                segdata["tags"]['{}.{}'.format(
-                                    segdata['tile_type_norm'],
-                                    tagname)] = tagval
-                        for tagname, tagval in sorted(segdata["tags"].items()):
-                            print("tag %s %d" % (tagname, tagval), file=f)
+            if not segments:
+                continue
+
+            if extra_tags is not None:
+                for segdata in segments.values():
+                    for tagname, tagval in extra_tags(segdata['name']):
+                        segdata["tags"]['{}.{}'.format(
+                            segdata['tile_type_norm'], tagname)] = tagval
+
+            if store_dir is not None:
+                store = os.path.join(store_dir,
+                                     "segdata_%s.sdb" % segtype.lower())
+                print("Appending %s to %s." % (filename, store))
+                segdata_file.append_segments(
+                    store, os.path.relpath(filename, store_dir),
+                    ((segname, segdata["bits"], segdata["tags"])
+                     for segname, segdata in sorted(segments.items())))
+                continue
+
+            print("Writing %s." % filename)
+            with open(filename, "w") as f:
+                for segname, segdata in sorted(segments.items()):
+                    # seg 00020300_010
+                    print("seg %s" % segname, file=f)
+                    for bitname in sorted(segdata["bits"]):
+                        print("bit %s" % bitname, file=f)
+
+                    for tagname, tagval in sorted(segdata["tags"].items()):
+                        print("tag %s %d" % (tagname, tagval), file=f)
@@ -16,11 +16,36 @@
 # limitations under the License.
 #
 # SPDX-License-Identifier: Apache-2.0
+'''
+Solve the segdata of every tile type of a fuzzer with segmatch, and post
+process the solutions into segbits_<type>.db.
+
+Tile types sharing bits (see unify_tile_types) are solved together.  Up
+to --jobs segmatch processes run at once, largest inputs first, and with
+--mem_budget only as many as fit the budget by their estimated memory
+use.  The estimate is the size of the segdata input times the largest
+ratio of peak memory to input size seen so far, starting from
+MEM_PER_INPUT_BYTE.  Each tile type is post processed (groups, filters and
+dbfixup) in this process as soon as its segmatch finishes, and its wall
+and CPU time are reported.
+'''
 
 import argparse
+import contextlib
 import glob
 import os
 import subprocess
+import sys
+import time
+
+from utils import (dbfixup, filter_features, filter_solution_width,
+                   iob_cleanup, segdata_file, util)
+
+# Directory of the segdata text files written from the segdata stores.
+SEGDATA_TEXT_DIR = 'segdata_text'
+
+# Initial estimate of segmatch peak memory per byte of segdata input.
+MEM_PER_INPUT_BYTE = 16
 
 
 def unify_tile_types(tile):
@@ -46,8 +71,194 @@ def unify_tile_types(tile):
     return tile
 
 
+def segdata_type(fn):
+    """ Return the tile type of a segdata_<type>.txt file.
+
+    >>> segdata_type('build/specimen_001/segdata_clem_r.txt')
+    'clem_r'
+    """
+    s = os.path.basename(fn)
+    return s[s.find('_') + 1:-4]
+
+
+class SegmatchJob(object):
+    """ segmatch and post processing of one unified tile type. """
+
+    def __init__(self, tile_type, input_files):
+        self.tile_type = tile_type
+        self.input_files = sorted(input_files)
+        self.input_bytes = sum(os.path.getsize(fn) for fn in self.input_files)
+        self.mem_estimate = 0
+        self.proc = None
+        self.start = None
+        self.returncode = None
+        self.cpu_time = 0.0
+        self.max_rss = 0
+        self.wall_time = None
+
+    def start_segmatch(self, max_count):
+        segmatch_opts = ''
+        if max_count is not None:
+            segmatch_opts = '-c {}'.format(max_count)
+
+        cmd = '$URAY_SEGMATCH {} -o segbits_{}.rdb {}'.format(
+            segmatch_opts, self.tile_type, ' '.join(self.input_files))
+
+        self.start = time.monotonic()
+        with open('segmatch_{}.txt'.format(self.tile_type), 'wb') as f:
+            self.proc = subprocess.Popen(cmd, shell=True, stdout=f)
+
+    def segmatch_done(self, status, rusage):
+        """ Record the exit status and resource usage of segmatch. """
+        if os.WIFEXITED(status):
+            self.returncode = os.WEXITSTATUS(status)
+        else:
+            self.returncode = -os.WTERMSIG(status)
+
+        # The process was waited for by os.wait4, not by Popen.
+        self.proc.returncode = self.returncode
+        self.cpu_time += rusage.ru_utime + rusage.ru_stime
+        self.max_rss = rusage.ru_maxrss * 1024
+
+
+def write_groups(t):
+    root_to_group = {}
+    with open('segbits_{}.rdb'.format(t)) as f:
+        for l in f:
+            l = l.strip()
+            feature = l.split(' ')[0]
+            if '[' in feature:
+                continue
+
+            parts = feature.split('.')
+            if len(parts) > 2:
+                root = '.'.join(parts[:-1])
+
+                if root not in root_to_group:
+                    root_to_group[root] = set()
+
+                root_to_group[root].add(feature)
+
+    with open('{}_groups.txt'.format(t), 'w') as fout:
+        for group in root_to_group.values():
+            if len(group) > 1:
+                print(' '.join(group), file=fout)
+
+
+def post_process(t, args):
+    """ Turn segbits_<t>.rdb into segbits_<t>.db. """
+    write_groups(t)
+
+    rdb_ext = 'rdb'
+
+    if args.filter_solution_width:
+        filter_solution_width.filter_solution_width(
+            input_rdb='segbits_{}.{}'.format(t, rdb_ext),
+            solution_widths=args.filter_solution_width,
+            output_rdb='segbits_{}.rdb2'.format(t),
+            filtered_features='segbits_{}.filtered'.format(t))
+        rdb_ext = 'rdb2'
+
+    if args.filter_out:
+        filter_features.filter_features(
+            input_rdb='segbits_{}.{}'.format(t, rdb_ext),
+            output_rdb='segbits_{}.rdb3'.format(t),
+            filters=args.filter_out)
+        rdb_ext = 'rdb3'
+
+    if args.iob_features:
+        with open('iob_cleanup_{}.txt'.format(t), 'w') as f, \
+                contextlib.redirect_stdout(f):
+            iob_cleanup.iob_cleanup(
+                rdb_in='segbits_{}.{}'.format(t, rdb_ext),
+                rdb_out='segbits_{}.rdb4'.format(t),
+                iob_features_file=args.iob_features)
+        rdb_ext = 'rdb4'
+
+    with open('dbfixup_{}.txt'.format(t), 'w') as f, \
+            contextlib.redirect_stdout(f):
+        dbfixup.run(
+            args.db_root,
+            seg_fn_in='segbits_{}.{}'.format(t, rdb_ext),
+            seg_fn_out='segbits_{}.db'.format(t),
+            groups_fn_in='{}_groups.txt'.format(t),
+            filter_across_groups=args.filter_across_groups)
+
+
+def run_jobs(jobs, args):
+    """ Run segmatch and post processing of jobs, return the failed jobs.
+
+    Post processing runs in this process between waits for segmatch, after
+    starting the segmatch jobs that fit in the freed slots.
+    """
+    pending = sorted(jobs, key=lambda job: -job.input_bytes)
+    running = {}
+    failed = []
+    mem_per_input_byte = MEM_PER_INPUT_BYTE
+
+    def start_jobs():
+        while pending and len(running) < args.jobs:
+            job = pending[0]
+            job.mem_estimate = job.input_bytes * mem_per_input_byte
+            mem_used = sum(job.mem_estimate for job in running.values())
+            # Always run at least one job, even if it exceeds the budget.
+            if (running and args.mem_budget is not None
+                    and mem_used + job.mem_estimate > args.mem_budget):
+                break
+
+            pending.pop(0)
+            job.start_segmatch(args.max_count)
+            running[job.proc.pid] = job
+
+    start_jobs()
+    while running:
+        pid, status, rusage = os.wait4(-1, 0)
+        job = running.pop(pid, None)
+        if job is None:
+            continue
+
+        job.segmatch_done(status, rusage)
+        if job.input_bytes:
+            mem_per_input_byte = max(mem_per_input_byte,
+                                     job.max_rss / job.input_bytes)
+
+        start_jobs()
+
+        if job.returncode != 0:
+            print(
+                'segmatch of {} failed with exit code {}, see segmatch_{}.txt'.
+                format(job.tile_type, job.returncode, job.tile_type),
+                file=sys.stderr)
+            failed.append(job)
+            continue
+
+        cpu_start = time.process_time()
+        try:
+            post_process(job.tile_type, args)
+        except Exception as e:
+            print(
+                'Post processing of {} failed: {}: {}'.format(
+                    job.tile_type,
+                    type(e).__name__, e),
+                file=sys.stderr)
+            failed.append(job)
+        finally:
+            job.cpu_time += time.process_time() - cpu_start
+            job.wall_time = time.monotonic() - job.start
+
+        print('{}: wall {:.1f}s, CPU {:.1f}s, segmatch peak memory {:.0f} MB'.
+              format(job.tile_type, job.wall_time, job.cpu_time,
+                     job.max_rss / 2**20))
+
+    return failed
+
+
 def main():
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    util.db_root_arg(parser)
     parser.add_argument(
         '--filter_across_groups',
         help='Filter out bits that match between groups',
@@ -64,109 +275,65 @@ def main():
         'Cleanup IOB features using a regular expressions to identify IOB features.'
     )
     parser.add_argument('-c', '--max_count', type=int, default=None)
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=os.cpu_count(),
+        help='Number of segmatch processes to run at once, default is the '
+        'number of CPUs.')
+    parser.add_argument(
+        '--mem_budget',
+        type=float,
+        default=None,
+        help='Memory budget of the running segmatch processes, in MB.')
 
     args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if args.mem_budget is not None:
+        args.mem_budget *= 2**20
+
+    type_files = {}
 
-    types = set()
+    # segmatch reads text files, so each segdata store of the specimens
+    # (see segdata_file.py) is written out as one text file.
+    for p in glob.glob('**/segdata_*.sdb', recursive=True):
+        text_file = os.path.join(SEGDATA_TEXT_DIR, p[:-len('.sdb')] + '.txt')
+        segdata_file.store_to_text(p, text_file)
+        type_files.setdefault(segdata_type(text_file), []).append(text_file)
 
     for p in glob.glob('**/segdata_*.txt', recursive=True):
-        s = os.path.basename(p)
-        types.add(s[s.find('_') + 1:-4])
+        if not p.startswith(SEGDATA_TEXT_DIR + os.sep):
+            type_files.setdefault(segdata_type(p), []).append(p)
 
-    procs = []
     unified_tile_types = {}
-    for t in sorted(types):
-        input_files = glob.glob('**/segdata_{}.txt'.format(t), recursive=True)
-
+    for t in sorted(type_files):
         unified_type = unify_tile_types(t)
 
         if unified_type not in unified_tile_types:
             unified_tile_types[unified_type] = []
 
-        unified_tile_types[unified_type].extend(input_files)
+        unified_tile_types[unified_type].extend(type_files[t])
 
-    segmatch_opts = ''
-    if args.max_count is not None:
-        segmatch_opts = '-c {}'.format(args.max_count)
+    jobs = [
+        SegmatchJob(t, input_files)
+        for t, input_files in sorted(unified_tile_types.items())
+    ]
 
-    for t in sorted(unified_tile_types.keys()):
-        cmd = '$URAY_SEGMATCH {} -o segbits_{}.rdb {}'.format(
-            segmatch_opts, t, ' '.join(sorted(unified_tile_types[t])))
-        procs.append(
-            subprocess.Popen(
-                cmd,
-                shell=True,
-                stdout=open('segmatch_{}.txt'.format(t), 'wb')))
-
-    for p in procs:
-        p.wait()
-
-    procs = []
-
-    for t in sorted(unified_tile_types.keys()):
-        root_to_group = {}
-        with open('segbits_{}.rdb'.format(t)) as f:
-            for l in f:
-                l = l.strip()
-                feature = l.split(' ')[0]
-                if '[' in feature:
-                    continue
-
-                parts = feature.split('.')
-                if len(parts) > 2:
-                    root = '.'.join(parts[:-1])
-
-                    if root not in root_to_group:
-                        root_to_group[root] = set()
-
-                    root_to_group[root].add(feature)
-
-        with open('{}_groups.txt'.format(t), 'w') as fout:
-            for group in root_to_group.values():
-                if len(group) > 1:
-                    print(' '.join(group), file=fout)
-
-        extra_args = []
-
-        rdb_ext = 'rdb'
-
-        if args.filter_solution_width:
-            subprocess.check_call(
-                'python3 $URAY_UTILS_DIR/filter_solution_width.py --input_rdb segbits_{t}.{rdb_ext} --output_rdb segbits_{t}.rdb2 --solution_widths {filter_solution_width} --filtered_features segbits_{t}.filtered'
-                .format(
-                    t=t,
-                    rdb_ext=rdb_ext,
-                    filter_solution_width=args.filter_solution_width),
-                shell=True)
-            rdb_ext = 'rdb2'
-
-        if args.filter_out:
-            subprocess.check_call(
-                'python3 $URAY_UTILS_DIR/filter_features.py --input_rdb segbits_{t}.{rdb_ext}  --output_rdb segbits_{t}.rdb3 --filters {filter_out}'
-                .format(t=t, rdb_ext=rdb_ext, filter_out=args.filter_out),
-                shell=True)
-            rdb_ext = 'rdb3'
-
-        if args.iob_features:
-            subprocess.check_call(
-                'python3 $URAY_UTILS_DIR/iob_cleanup.py --rdb_in segbits_{t}.{rdb_ext} --rdb_out segbits_{t}.rdb4 --iob_features {iob_features}'
-                .format(t=t, rdb_ext=rdb_ext, iob_features=args.iob_features),
-                shell=True,
-                stdout=open('iob_cleanup_{}.txt'.format(t), 'wb'))
-            rdb_ext = 'rdb4'
-
-        if args.filter_across_groups:
-            extra_args.append('--filter_across_groups')
-
-        procs.append(
-            subprocess.Popen(
-                'python3 $URAY_UTILS_DIR/dbfixup.py --seg-fn-in segbits_{t}.{rdb_ext} --seg-fn-out segbits_{t}.db -g {t}_groups.txt {extra_args}'
-                .format(t=t, rdb_ext=rdb_ext, extra_args=' '.join(extra_args)),
-                shell=True,
-                stdout=open('dbfixup_{}.txt'.format(t), 'wb')))
-
-    for p in procs:
-        p.wait()
+    start = time.monotonic()
+    failed = run_jobs(jobs, args)
+
+    print('Solved {} of {} tile types in {:.1f}s, CPU {:.1f}s'.format(
+        len(jobs) - len(failed), len(jobs),
+        time.monotonic() - start, sum(job.cpu_time for job in jobs)))
+
+    if failed:
+        print(
+            'Failed tile types: {}'.format(' '.join(
+                job.tile_type for job in failed)),
+            file=sys.stderr)
+        sys.exit(1)
 
 
 if __name__ == "__main__":